@@ -0,0 +1,61 @@
+"""Drug name / class -> allergen group mapping used to cross-check prescriptions.
+
+Both the prescribed medication and the patient's recorded allergens are mapped
+to groups; a shared group means the prescription may trigger the allergy.
+"""
+from pathlib import Path
+from typing import Dict, FrozenSet, Set
+
+from icd10 import normalize_text
+
+MIN_TERM_LENGTH = 3
+
+
+class AllergenIndex:
+    def __init__(self):
+        # Single-word terms in base form: "амоксициллин" -> {"penicillins", "beta_lactams"}
+        self.terms: Dict[str, FrozenSet[str]] = {}
+        self.max_term_length = 0
+
+    def __len__(self):
+        return len(self.terms)
+
+    @classmethod
+    def load(cls, path: Path) -> "AllergenIndex":
+        """Load a tab-separated file: term, comma-separated allergen groups"""
+        index = cls()
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip() or line.startswith("#"):
+                    continue
+                term, groups = line.rstrip("\n").split("\t")[:2]
+                index.add(term, [group.strip() for group in groups.split(",") if group.strip()])
+        return index
+
+    def add(self, term: str, groups):
+        term = normalize_text(term)
+        if len(term) < MIN_TERM_LENGTH or " " in term:
+            raise ValueError(f"Allergen term must be a single word: {term!r}")
+        self.terms[term] = self.terms.get(term, frozenset()) | frozenset(groups)
+        self.max_term_length = max(self.max_term_length, len(term))
+
+    def groups(self, text: str) -> Set[str]:
+        """Groups of every word in the text; inflected forms match by their base-form prefix"""
+        found = set()
+        for word in normalize_text(text).split():
+            for length in range(MIN_TERM_LENGTH, min(len(word), self.max_term_length) + 1):
+                groups = self.terms.get(word[:length])
+                if groups:
+                    found |= groups
+        return found
+
+    def shared_groups(self, medication_name: str, allergen: str) -> Set[str]:
+        """Groups linking a medication to an allergen, or {allergen} if the names match directly"""
+        shared = self.groups(medication_name) & self.groups(allergen)
+        if shared:
+            return shared
+        # Allergen outside the mapping: fall back to the name itself
+        allergen_text = normalize_text(allergen)
+        if len(allergen_text) >= MIN_TERM_LENGTH and allergen_text in normalize_text(medication_name):
+            return {allergen_text}
+        return set()
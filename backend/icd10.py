@@ -0,0 +1,142 @@
+"""МКБ-10 (ICD-10) dictionary kept in memory for code lookup and name search.
+
+Codes live in a prefix trie, names (Russian and Kazakh) in a trigram index.
+"""
+import heapq
+import re
+from array import array
+from collections import Counter
+from pathlib import Path
+from typing import List, Optional
+
+# Cyrillic letters that look like Latin ones, typed by mistake in codes
+CODE_LOOKALIKES = str.maketrans("АВЕКМНОРСТХ", "ABEKMHOPCTX")
+CODE_PATTERN = re.compile(r"^[A-Z]\d{2}(\.\d{1,2})?$")
+WORD_SPLIT = re.compile(r"[^0-9a-zа-яәғқңөұүһі]+")
+
+
+def normalize_code(code: str) -> str:
+    """Canonical form of a user-typed code: 'к02,1 ' -> 'K02.1'"""
+    code = code.strip().upper().translate(CODE_LOOKALIKES)
+    return code.replace(",", ".").replace(" ", "").rstrip("+*")
+
+
+def is_valid_code_format(code: str) -> bool:
+    return bool(CODE_PATTERN.match(code))
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(WORD_SPLIT.split(text.lower().replace("ё", "е"))).strip()
+
+
+def trigrams(text: str):
+    grams = set()
+    for word in normalize_text(text).split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class TrieNode:
+    __slots__ = ("children", "entry")
+
+    def __init__(self):
+        self.children = {}
+        self.entry = -1  # Index into Icd10Dictionary.codes, -1 if no code ends here
+
+
+class Icd10Dictionary:
+    def __init__(self):
+        self.codes: List[str] = []
+        self.names_ru: List[str] = []
+        self.names_kk: List[str] = []
+        self.root = TrieNode()
+        self.trigram_index = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    def load(cls, path: Path) -> "Icd10Dictionary":
+        """Load a tab-separated file: code, Russian name, optional Kazakh name"""
+        dictionary = cls()
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip() or line.startswith("#"):
+                    continue
+                parts = line.rstrip("\n").split("\t")
+                dictionary.add(parts[0], parts[1], parts[2] if len(parts) > 2 else "")
+        # Postings were collected as lists, freeze them into compact arrays
+        dictionary.trigram_index = {
+            gram: array("I", postings) for gram, postings in dictionary.trigram_index.items()
+        }
+        return dictionary
+
+    def add(self, code: str, name_ru: str, name_kk: str = ""):
+        code = normalize_code(code)
+        index = len(self.codes)
+        self.codes.append(code)
+        self.names_ru.append(name_ru)
+        self.names_kk.append(name_kk)
+
+        node = self.root
+        for char in code:
+            node = node.children.setdefault(char, TrieNode())
+        node.entry = index
+
+        for gram in trigrams(f"{name_ru} {name_kk}"):
+            self.trigram_index.setdefault(gram, []).append(index)
+
+    def entry(self, index: int) -> dict:
+        return {"code": self.codes[index], "name_ru": self.names_ru[index], "name_kk": self.names_kk[index] or None}
+
+    def get(self, code: str) -> Optional[dict]:
+        node = self.root
+        for char in normalize_code(code):
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return self.entry(node.entry) if node.entry >= 0 else None
+
+    def search_code_prefix(self, prefix: str, limit: int = 20) -> List[dict]:
+        node = self.root
+        for char in normalize_code(prefix):
+            node = node.children.get(char)
+            if node is None:
+                return []
+
+        # Depth-first in code order, stops as soon as the limit is reached
+        results = []
+        stack = [node]
+        while stack and len(results) < limit:
+            current = stack.pop()
+            if current.entry >= 0:
+                results.append(self.entry(current.entry))
+            stack.extend(current.children[char] for char in sorted(current.children, reverse=True))
+        return results
+
+    def search_name(self, query: str, limit: int = 20) -> List[dict]:
+        query_grams = trigrams(query)
+        if not query_grams:
+            return []
+
+        hits = Counter()
+        for gram in query_grams:
+            hits.update(self.trigram_index.get(gram, ()))
+
+        # At least half of the query trigrams must be present
+        threshold = max(1, len(query_grams) // 2)
+        # Most trigrams matched first; ties go to shorter names
+        best = heapq.nsmallest(
+            limit,
+            (index for index, count in hits.items() if count >= threshold),
+            key=lambda index: (-hits[index], len(self.names_ru[index]), self.codes[index])
+        )
+        return [self.entry(index) for index in best]
+
+    def search(self, query: str, limit: int = 20) -> List[dict]:
+        """Code prefix search when the query looks like a code, name search otherwise"""
+        code = normalize_code(query)
+        if re.match(r"^[A-Z]\d", code):
+            return self.search_code_prefix(code, limit)
+        return self.search_name(query, limit)
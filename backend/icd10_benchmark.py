@@ -0,0 +1,77 @@
+"""Measure load time, memory footprint and lookup latency of the ICD-10 dictionary.
+
+Usage: python icd10_benchmark.py [path/to/icd10.tsv] [--scale N]
+
+--scale N adds N-1 synthetic copies of the file (own codes, names
+recombined from the same vocabulary), so the bundled subset can stand in
+for the full dictionary (~14 000 codes).
+"""
+import argparse
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from icd10 import Icd10Dictionary
+
+DEFAULT_PATH = Path(__file__).parent / "data" / "icd10.tsv"
+QUERIES = ["K02", "k04.", "К05.3", "Z0", "кариес", "пульпит", "хронический пародонтит", "болезнь языка", "дерматит"]
+
+
+def scaled_copy(path: Path, scale: int) -> Path:
+    rows = [line.rstrip("\n").split("\t") for line in open(path, encoding="utf-8")
+            if line.strip() and not line.startswith("#")]
+    vocabulary = sorted({word for row in rows for word in row[1].split()})
+    rng = random.Random(42)
+    out = tempfile.NamedTemporaryFile("w", suffix=".tsv", delete=False, encoding="utf-8")
+    with out:
+        for copy in range(scale):
+            for code, name_ru, *rest in rows:
+                if copy:
+                    # Synthetic code in its own range and a distinct name built from the same vocabulary
+                    code = f"{chr(ord('A') + copy % 26)}{copy // 26:01d}{code[2]}.{rng.randrange(100):02d}"
+                    name_ru = " ".join(rng.sample(vocabulary, rng.randint(2, 6)))
+                out.write("\t".join([code, name_ru, *rest]) + "\n")
+    return Path(out.name)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", nargs="?", type=Path, default=DEFAULT_PATH)
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    path = scaled_copy(args.path, args.scale) if args.scale > 1 else args.path
+
+    started = time.perf_counter()
+    dictionary = Icd10Dictionary.load(path)
+    load_ms = (time.perf_counter() - started) * 1000
+
+    # Second load under tracemalloc, which would distort the timing above
+    tracemalloc.start()
+    traced = Icd10Dictionary.load(path)
+    memory_kb = tracemalloc.get_traced_memory()[0] / 1024
+    tracemalloc.stop()
+    del traced
+
+    print(f"Codes:        {len(dictionary)}")
+    print(f"Trigrams:     {len(dictionary.trigram_index)}")
+    print(f"Load time:    {load_ms:.1f} ms")
+    print(f"Memory:       {memory_kb:.0f} KiB")
+
+    for query in QUERIES:
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            results = dictionary.search(query)
+            timings.append((time.perf_counter() - started) * 1_000_000)
+        timings.sort()
+        print(f"{query!r:28} {len(results):3} hits  "
+              f"p50 {statistics.median(timings):7.1f} us  p99 {timings[int(len(timings) * 0.99)]:7.1f} us")
+
+
+if __name__ == "__main__":
+    main()
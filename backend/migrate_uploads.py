@@ -0,0 +1,139 @@
+"""Move files from the flat uploads directory into the sharded ab/cd/<name> layout.
+
+Usage: python migrate_uploads.py [--uploads-dir uploads] [--batch-size 500] [--pause 0.5]
+                                 [--to-storage] [--dry-run]
+
+Safe to interrupt and re-run: every batch moves its files first and then
+points their documents at the new location. Files already moved are no
+longer in the flat directory, and a final pass fixes any document rows left
+behind by an interrupted run. Downloads keep working throughout, since the
+server looks in the sharded location first and falls back to the flat one.
+
+With --to-storage, every local file, flat or sharded, is instead copied into
+the backend STORAGE_BACKEND selects (S3), and documents are pointed at the
+copy. Run it before switching the server to S3, which does not read the
+uploads directory, and again right after the switch for uploads made in
+between. Local files are left in place until the copy is verified.
+"""
+import argparse
+import os
+import shutil
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateMany
+
+from storage import LocalStorage, shard_path, storage_from_env
+
+ROOT_DIR = Path(__file__).parent
+
+
+def flat_files(uploads_dir: Path, batch_size: int):
+    # Listed up front: the directory must not change under a running scan
+    names = sorted(
+        entry.name for entry in os.scandir(uploads_dir)
+        # Hidden files are uploads still being written
+        if entry.is_file() and not entry.name.startswith(".")
+        and shard_path(uploads_dir, entry.name).parent != uploads_dir
+    )
+    for start in range(0, len(names), batch_size):
+        yield names[start:start + batch_size]
+
+
+def move_file(uploads_dir: Path, name: str):
+    source = uploads_dir / name
+    target = shard_path(uploads_dir, name)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if target.exists() and target.stat().st_size == source.stat().st_size:
+        # Already in place, e.g. restored from a backup: drop the flat copy
+        source.unlink()
+    else:
+        os.replace(source, target)
+
+
+def copy_to_storage(db, uploads_dir: Path, storage, args) -> int:
+    local = LocalStorage(uploads_dir)
+    names = sorted(local.names())
+    copied = 0
+    for start in range(0, len(names), args.batch_size):
+        batch = [
+            name for name in names[start:start + args.batch_size]
+            if (storage.stat(name) or (None,))[0] != local.stat(name)[0]
+        ]
+        if batch and not args.dry_run:
+            for name in batch:
+                # save() takes the file over, so it gets a hidden copy
+                copy = uploads_dir / f".{name}.copy"
+                shutil.copyfile(local.path(name), copy)
+                storage.save(name, copy)
+            # Deduplicated files are named by their blob, not by the document
+            db.documents.bulk_write([
+                UpdateMany(
+                    {"$or": [{"filename": name}, {"storage_key": name}]},
+                    {"$set": {"file_path": storage.location(name)}}
+                )
+                for name in batch
+            ], ordered=False)
+        copied += len(batch)
+        print(f"Copied {copied} files")
+        time.sleep(args.pause)
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--uploads-dir", type=Path, default=Path("uploads"))
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--pause", type=float, default=0.5, help="seconds to sleep between batches")
+    parser.add_argument("--to-storage", action="store_true",
+                        help="copy local files into the storage backend configured by STORAGE_BACKEND")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    load_dotenv(ROOT_DIR / ".env")
+    db = MongoClient(os.environ["MONGO_URL"])[os.environ["DB_NAME"]]
+
+    if args.to_storage:
+        storage = storage_from_env(args.uploads_dir)
+        if isinstance(storage, LocalStorage):
+            parser.error("--to-storage needs STORAGE_BACKEND=s3")
+        copied = copy_to_storage(db, args.uploads_dir, storage, args)
+        print(f"{'Would copy' if args.dry_run else 'Copied'} {copied} files to {storage.location('')}")
+        return
+
+    moved = 0
+    for batch in flat_files(args.uploads_dir, args.batch_size):
+        if args.dry_run:
+            moved += len(batch)
+            continue
+        for name in batch:
+            move_file(args.uploads_dir, name)
+        # Thumbnails (<name>.thumb.webp) move too but have no document of their own
+        updates = [
+            UpdateMany({"filename": name}, {"$set": {"file_path": str(shard_path(args.uploads_dir, name))}})
+            for name in batch
+        ]
+        db.documents.bulk_write(updates, ordered=False)
+        moved += len(batch)
+        print(f"Moved {moved} files")
+        time.sleep(args.pause)
+
+    # Rows of files moved by a run interrupted before its database update
+    fixed = 0
+    stale = db.documents.find(
+        {"file_path": {"$regex": r"^[^/]+/[^/]+$"}}, {"_id": 0, "id": 1, "filename": 1, "file_path": 1}
+    )
+    for document in stale:
+        target = shard_path(args.uploads_dir, document["filename"])
+        if target.exists() and str(target) != document["file_path"]:
+            if not args.dry_run:
+                db.documents.update_one({"id": document["id"]}, {"$set": {"file_path": str(target)}})
+            fixed += 1
+
+    action = "Would move" if args.dry_run else "Moved"
+    print(f"{action} {moved} files, fixed {fixed} document paths")
+
+
+if __name__ == "__main__":
+    main()
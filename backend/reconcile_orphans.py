@@ -0,0 +1,295 @@
+"""Find and remove data left behind by deleted patients, and documents out of sync with their files.
+
+Usage: python reconcile_orphans.py [--uploads-dir uploads] [--upload-sessions-dir upload_sessions]
+                                   [--batch-size 500] [--pause 0.5] [--min-age-minutes 60]
+                                   [--purge-revisions] [--purge-missing-files] [--dry-run]
+
+Checks, in this order:
+
+1. Rows of patient-owned collections whose patient no longer exists. Each
+   collection is read in _id order in batches, and every batch is anti-joined
+   against patients with one indexed $in query. Orphan documents give back
+   their blob reference, deleting the file with the last one, and orphan
+   appointments leave tombstones for calendar feeds and change feed
+   subscribers, as deleting them through the API does. The waitlist
+   is left alone: the server keeps it indexed in memory, so deleting a
+   patient cancels their entries there instead.
+2. Revisions of records that no longer exist, anti-joined the same way. They
+   are the audit trail of those records, so they are only counted unless
+   --purge-revisions is given. A dry run cannot see the records step 1 would
+   remove, so it undercounts these.
+3. Document rows whose file is missing from storage. These are only reported
+   unless --purge-missing-files is given, since a misconfigured storage
+   would make every document look missing.
+4. Files in storage that no document refers to. Files younger than
+   --min-age-minutes, or whose blob still counts references, are left
+   alone, as they may belong to an upload that has not written its
+   document row yet.
+5. Part directories of resumable upload sessions whose row is gone, e.g.
+   expired through the TTL index, and older than --min-age-minutes.
+
+Every batch is followed by --pause seconds of sleep, so the job can run
+during clinic hours. With --dry-run nothing is changed and the report
+shows what would be removed.
+"""
+import argparse
+import itertools
+import os
+import shutil
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from dotenv import load_dotenv
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from storage import storage_from_env
+from thumbnails import THUMBNAIL_SUFFIX
+
+ROOT_DIR = Path(__file__).parent
+
+PATIENT_COLLECTIONS = [
+    "appointments", "medical_records", "medical_entries", "allergies", "medications", "diagnoses",
+    "treatment_plans", "upload_sessions", "documents"
+]
+REVISIONED_COLLECTIONS = ["appointments", "medical_records", "treatment_plans"]
+# Fields needed to remove an orphan of these collections
+PROJECTIONS = {
+    "appointments": {"id": 1, "patient_id": 1, "doctor_id": 1, "appointment_date": 1},
+    "documents": {"patient_id": 1, "filename": 1, "sha256": 1, "storage_key": 1},
+}
+
+
+def batches(collection, query: dict, projection: dict, batch_size: int):
+    """Rows of a collection in _id order, a batch at a time (keyset, so deletions do not shift it)"""
+    last = None
+    while True:
+        page_query = {**query, "_id": {"$gt": last}} if last is not None else query
+        rows = list(collection.find(page_query, projection).sort("_id", 1).limit(batch_size))
+        if not rows:
+            return
+        last = rows[-1]["_id"]
+        yield rows
+
+
+def existing_ids(collection, ids) -> set:
+    return {row["id"] for row in collection.find({"id": {"$in": list(ids)}}, {"_id": 0, "id": 1})}
+
+
+def stored_name(document: dict) -> str:
+    return document.get("storage_key") or document["filename"]
+
+
+def release_document_file(db, storage, document: dict):
+    """Same bookkeeping as release_blob in server.py: the file goes with its last reference"""
+    blob = None
+    if document.get("sha256"):
+        blob = db.blobs.find_one_and_update(
+            {"id": document["sha256"], "filename": stored_name(document)},
+            {"$inc": {"refcount": -1}},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+    if blob is None:
+        storage.delete(stored_name(document))
+        storage.delete(stored_name(document) + THUMBNAIL_SUFFIX)
+    elif blob["refcount"] <= 0:
+        delete_blob(db, storage, {"id": blob["id"], "refcount": {"$lte": 0}})
+
+
+def delete_blob(db, storage, query: dict) -> bool:
+    """Delete a blob's file the way release_blob does: marked as deleting until it is gone"""
+    try:
+        blob = db.blobs.find_one_and_update(
+            {**query, "deleting": {"$ne": True}},
+            {"$set": {"deleting": True}},
+            return_document=ReturnDocument.AFTER,
+            upsert="filename" in query
+        )
+    except DuplicateKeyError:
+        # The blob was taken again, or another release is deleting it
+        return False
+    if blob is None:
+        return False
+    try:
+        storage.delete(blob["filename"])
+        storage.delete(blob["filename"] + THUMBNAIL_SUFFIX)
+    finally:
+        db.blobs.delete_one({"id": blob["id"], "deleting": True})
+    return True
+
+
+def record_appointment_removal(db, appointments: list):
+    """Same tombstones as record_appointment_removal in server.py"""
+    now = datetime.utcnow()
+    db.appointment_tombstones.insert_many([
+        {
+            "id": a["id"],
+            "patient_id": a["patient_id"],
+            "doctor_id": a["doctor_id"],
+            "appointment_date": a["appointment_date"],
+            "deleted_at": now
+        }
+        for a in appointments
+    ])
+
+
+def delete_documents(db, storage, documents: list):
+    db.documents.delete_many({"_id": {"$in": [document["_id"] for document in documents]}})
+    for document in documents:
+        release_document_file(db, storage, document)
+
+
+def reconcile_patient_data(db, storage, args) -> dict:
+    found = {}
+    for name in PATIENT_COLLECTIONS:
+        projection = PROJECTIONS.get(name, {"patient_id": 1})
+        found[name] = 0
+        for rows in batches(db[name], {"patient_id": {"$type": "string"}}, projection, args.batch_size):
+            patients = existing_ids(db.patients, {row["patient_id"] for row in rows})
+            orphans = [row for row in rows if row["patient_id"] not in patients]
+            if orphans and not args.dry_run:
+                if name == "documents":
+                    delete_documents(db, storage, orphans)
+                else:
+                    if name == "appointments":
+                        # Tombstones first: a run stopped in between repeats one, never loses it
+                        record_appointment_removal(db, orphans)
+                    db[name].delete_many({"_id": {"$in": [row["_id"] for row in orphans]}})
+            found[name] += len(orphans)
+            time.sleep(args.pause)
+    return found
+
+
+def reconcile_revisions(db, args) -> int:
+    found = 0
+    for rows in batches(db.revisions, {}, {"collection": 1, "record_id": 1}, args.batch_size):
+        orphans = []
+        for name in REVISIONED_COLLECTIONS:
+            record_ids = {row["record_id"] for row in rows if row["collection"] == name}
+            if record_ids:
+                records = existing_ids(db[name], record_ids)
+                orphans += [row["_id"] for row in rows if row["collection"] == name and row["record_id"] not in records]
+        if orphans and args.purge_revisions and not args.dry_run:
+            db.revisions.delete_many({"_id": {"$in": orphans}})
+        found += len(orphans)
+        time.sleep(args.pause)
+    return found
+
+
+def reconcile_missing_files(db, storage, args) -> list:
+    missing = []
+    projection = {"id": 1, "filename": 1, "sha256": 1, "storage_key": 1}
+    for rows in batches(db.documents, {}, projection, args.batch_size):
+        lost = [row for row in rows if not storage.exists(stored_name(row))]
+        if lost and args.purge_missing_files and not args.dry_run:
+            delete_documents(db, storage, lost)
+        missing += [row["id"] for row in lost]
+        time.sleep(args.pause)
+    return missing
+
+
+def reconcile_unreferenced_files(db, storage, args) -> list:
+    unreferenced = []
+    cutoff = datetime.now(timezone.utc) - timedelta(minutes=args.min_age_minutes)
+    names = storage.names()
+    while True:
+        batch = list(itertools.islice(names, args.batch_size))
+        if not batch:
+            return unreferenced
+        # A thumbnail belongs to the file it was made from
+        originals = {name: name.removesuffix(THUMBNAIL_SUFFIX) for name in batch}
+        candidates = list(set(originals.values()))
+        referenced = {
+            stored_name(row) for row in db.documents.find(
+                {"$or": [{"filename": {"$in": candidates}}, {"storage_key": {"$in": candidates}}]},
+                {"_id": 0, "filename": 1, "storage_key": 1}
+            )
+        }
+        # A blob still holding references may be mid-upload, its document row not written yet
+        referenced |= {
+            row["filename"] for row in
+            db.blobs.find({"filename": {"$in": candidates}, "refcount": {"$gt": 0}}, {"_id": 0, "filename": 1})
+        }
+        for name, original in originals.items():
+            if original in referenced:
+                continue
+            stat = storage.stat(name)
+            if stat is None or stat[1] > cutoff:
+                continue
+            if not args.dry_run:
+                if name != original:
+                    storage.delete(name)
+                # Blobs are stored as <sha256><ext>; claiming the id also keeps store_blob from reusing the file
+                elif not delete_blob(db, storage, {"id": name.split(".")[0], "filename": name, "refcount": {"$lte": 0}}):
+                    continue
+            unreferenced.append(name)
+        time.sleep(args.pause)
+
+
+def reconcile_upload_session_dirs(db, args) -> list:
+    abandoned = []
+    cutoff = time.time() - args.min_age_minutes * 60
+    if not args.upload_sessions_dir.is_dir():
+        return abandoned
+    directories = (path for path in args.upload_sessions_dir.iterdir() if path.is_dir())
+    while True:
+        batch = list(itertools.islice(directories, args.batch_size))
+        if not batch:
+            return abandoned
+        live = existing_ids(db.upload_sessions, {path.name for path in batch})
+        for path in batch:
+            if path.name in live or path.stat().st_mtime > cutoff:
+                continue
+            if not args.dry_run:
+                shutil.rmtree(path, ignore_errors=True)
+            abandoned.append(path.name)
+        time.sleep(args.pause)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--uploads-dir", type=Path, default=Path("uploads"))
+    parser.add_argument("--upload-sessions-dir", type=Path, default=Path("upload_sessions"))
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--pause", type=float, default=0.5, help="seconds to sleep between batches")
+    parser.add_argument("--min-age-minutes", type=float, default=60,
+                        help="leave unreferenced files and upload session directories younger than this alone")
+    parser.add_argument("--purge-revisions", action="store_true",
+                        help="delete revisions of deleted records instead of only counting them")
+    parser.add_argument("--purge-missing-files", action="store_true",
+                        help="delete document rows whose file is missing from storage")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    load_dotenv(ROOT_DIR / ".env")
+    db = MongoClient(os.environ["MONGO_URL"])[os.environ["DB_NAME"]]
+    storage = storage_from_env(args.uploads_dir)
+    action = "Would delete" if args.dry_run else "Deleted"
+
+    for name, count in reconcile_patient_data(db, storage, args).items():
+        print(f"{action} {count} {name} of deleted patients")
+    revisions = reconcile_revisions(db, args)
+    purged = args.purge_revisions and not args.dry_run
+    print(f"{'Deleted' if purged else 'Found'} {revisions} revisions of deleted records")
+
+    missing = reconcile_missing_files(db, storage, args)
+    purged = args.purge_missing_files and not args.dry_run
+    print(f"{'Deleted' if purged else 'Found'} {len(missing)} documents whose file is missing")
+    for document_id in missing:
+        print(f"  {document_id}")
+
+    unreferenced = reconcile_unreferenced_files(db, storage, args)
+    print(f"{action} {len(unreferenced)} files no document refers to")
+    for name in unreferenced:
+        print(f"  {name}")
+
+    abandoned = reconcile_upload_session_dirs(db, args)
+    print(f"{action} {len(abandoned)} part directories of expired upload sessions")
+    for session_id in abandoned:
+        print(f"  {session_id}")
+
+
+if __name__ == "__main__":
+    main()
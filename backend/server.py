@@ -1,20 +1,40 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, File, UploadFile, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, File, UploadFile, Form, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import os
+import asyncio
+import json
+import base64
+import csv
+import io
+import hashlib
+import shutil
+import heapq
+import itertools
+import re
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
 from typing import List, Optional, Union
 import uuid
-from datetime import datetime, timedelta
+import zipfile
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
 from enum import Enum
 from passlib.context import CryptContext
 from jose import JWTError, jwt
-import shutil
+from icd10 import Icd10Dictionary, is_valid_code_format, normalize_code
+from allergens import AllergenIndex
+from storage import storage_from_env
+from thumbnails import THUMBNAIL_SUFFIX, can_thumbnail
 
 
 ROOT_DIR = Path(__file__).parent
@@ -43,8 +63,70 @@ api_router = APIRouter(prefix="/api")
 UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
 
-# Mount static files for serving uploaded documents
-app.mount("/uploads", StaticFiles(directory=str(UPLOAD_DIR)), name="uploads")
+# Document files live in the uploads directory or, with STORAGE_BACKEND=s3, in a bucket.
+# Uploads are always received into UPLOAD_DIR first and handed to the storage when complete.
+# Files are only served through GET /api/uploads/{filename}, which resolves the sharded path.
+storage = storage_from_env(UPLOAD_DIR)
+
+# Document uploads are copied to disk in chunks off the event loop
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(100 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+BLOB_DELETE_WAIT_ATTEMPTS = 100  # 50 ms apart: how long store_blob waits for a blob being deleted
+
+# Thumbnails are generated after the upload response, in a small thread pool
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", "2"))
+thumbnail_executor = ThreadPoolExecutor(THUMBNAIL_WORKERS, thread_name_prefix="thumbnail")
+
+# Resumable upload sessions keep their parts outside the publicly mounted uploads directory
+UPLOAD_SESSIONS_DIR = Path("upload_sessions")
+UPLOAD_SESSIONS_DIR.mkdir(exist_ok=True)
+UPLOAD_SESSION_MAX_BYTES = int(os.environ.get("UPLOAD_SESSION_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+UPLOAD_SESSION_MAX_CHUNK_BYTES = 64 * 1024 * 1024
+UPLOAD_SESSION_TTL_HOURS = 24
+
+# Appointment change feed
+APPOINTMENT_FEED_POLL_SECONDS = float(os.environ.get("APPOINTMENT_FEED_POLL_SECONDS", "2"))
+APPOINTMENT_FEED_HEARTBEAT_SECONDS = 15
+# None until the first subscriber finds out whether mongod supports change streams
+change_streams_available: Optional[bool] = None
+
+# Doctor calendar (ICS) feed window, relative to today
+CALENDAR_FEED_DAYS_BACK = int(os.environ.get("CALENDAR_FEED_DAYS_BACK", "30"))
+CALENDAR_FEED_DAYS_AHEAD = int(os.environ.get("CALENDAR_FEED_DAYS_AHEAD", "180"))
+
+# МКБ-10 dictionary, loaded at startup
+ICD10_PATH = Path(os.environ.get("ICD10_PATH", str(ROOT_DIR / "data" / "icd10.tsv")))
+# Reject diagnosis codes missing from the dictionary (needs the full dictionary file)
+ICD10_STRICT = os.environ.get("ICD10_STRICT", "false").lower() == "true"
+icd10_dictionary = Icd10Dictionary()
+
+# Drug name/class -> allergen groups for prescription checks
+ALLERGENS_PATH = Path(os.environ.get("ALLERGENS_PATH", str(ROOT_DIR / "data" / "allergens.tsv")))
+allergen_index = AllergenIndex()
+
+# Serialized medical summaries kept in memory, bounded by total size. Off by default:
+# the cache is per process, so only enable it when the app runs as a single worker
+MEDICAL_SUMMARY_CACHE_BYTES = int(os.environ.get("MEDICAL_SUMMARY_CACHE_BYTES", "0"))
+
+# Medications past their end_date are deactivated by a background job
+MEDICATION_EXPIRY_INTERVAL_SECONDS = float(os.environ.get("MEDICATION_EXPIRY_INTERVAL_SECONDS", "3600"))
+MEDICATION_EXPIRY_BATCH_SIZE = 500
+medication_expiry_task: Optional[asyncio.Task] = None
+
+# Revision history of clinical records: a full snapshot every N revisions, diffs in between
+REVISION_SNAPSHOT_INTERVAL = int(os.environ.get("REVISION_SNAPSHOT_INTERVAL", "20"))
+REVISION_BATCH_SIZE = 200
+REVISION_FLUSH_SECONDS = 0.5
+REVISION_POLL_SECONDS = 5  # also the retry delay after a failed batch
+REVISION_LEASE_SECONDS = 60  # pending changes of a worker that stopped are taken over after this
+REVISIONED_COLLECTIONS = {"appointments", "medical_records", "treatment_plans"}
+
+# Full-text search over clinical notes
+SEARCH_MAX_RESULTS = int(os.environ.get("SEARCH_MAX_RESULTS", "200"))
+
+# Waitlist
+WAITLIST_MAX_OFFERS = int(os.environ.get("WAITLIST_MAX_OFFERS", "3"))
+WAITLIST_SYNC_OVERLAP_SECONDS = 5
 
 # Enums
 class UserRole(str, Enum):
@@ -127,6 +209,7 @@ class MedicalRecord(BaseModel):
     emergency_contact: Optional[str] = None
     emergency_phone: Optional[str] = None
     insurance_number: Optional[str] = None
+    created_by: Optional[str] = None  # User ID who created the record
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -166,6 +249,7 @@ class Medication(BaseModel):
     end_date: Optional[datetime] = None
     instructions: Optional[str] = None
     is_active: bool = True
+    expired_at: Optional[datetime] = None  # Set when the course is closed by end_date
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -213,6 +297,32 @@ class MedicationCreate(BaseModel):
     frequency: str
     end_date: Optional[datetime] = None
     instructions: Optional[str] = None
+    # Allergies the prescriber has seen warnings for and confirmed; any other match rejects the prescription
+    acknowledged_allergy_ids: List[str] = []
+
+class AllergyWarning(BaseModel):
+    allergy_id: str
+    allergen: str
+    reaction: str
+    severity: SeverityLevel
+    allergen_groups: List[str]
+
+class MedicationCreateResult(Medication):
+    allergy_warnings: List[AllergyWarning] = []
+
+class ExpiredMedication(BaseModel):
+    id: str
+    patient_id: str
+    expired_at: datetime
+
+class ExpiredMedicationsDelta(BaseModel):
+    items: List[ExpiredMedication]
+    cursor: str  # Pass back on the next call to get only newer expiries
+
+class Icd10Code(BaseModel):
+    code: str
+    name_ru: str
+    name_kk: Optional[str] = None
 
 class DiagnosisCreate(BaseModel):
     patient_id: str
@@ -237,6 +347,22 @@ class MedicalEntryWithDetails(BaseModel):
     doctor_name: str
     patient_name: str
 
+class MedicalEntriesPage(BaseModel):
+    items: List[MedicalEntryWithDetails]
+    next_cursor: Optional[str] = None  # Pass back as ?cursor= to get the next page
+
+class TimelineItem(BaseModel):
+    kind: str  # appointment, medical_entry, diagnosis, medication, document, treatment_plan
+    id: str
+    date: datetime
+    title: str
+    status: Optional[str] = None
+    details: dict = {}
+
+class TimelinePage(BaseModel):
+    items: List[TimelineItem]
+    next_cursor: Optional[str] = None
+
 class MedicationWithDetails(BaseModel):
     id: str
     patient_id: str
@@ -330,6 +456,7 @@ class Doctor(BaseModel):
     calendar_color: str = "#3B82F6"  # Default blue color
     is_active: bool = True
     user_id: Optional[str] = None  # Link to User if doctor has account
+    calendar_token_version: int = 0  # Bumped to revoke issued calendar feed URLs
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -381,6 +508,21 @@ class DoctorWithSchedule(BaseModel):
     updated_at: datetime
     schedule: List[DoctorSchedule] = []
 
+# Search models
+class SearchHit(BaseModel):
+    kind: str  # medical_entry, diagnosis, appointment, patient
+    id: str
+    patient_id: str
+    patient_name: Optional[str] = None
+    title: str
+    snippet: Optional[str] = None
+    date: Optional[str] = None
+    score: float
+
+class SearchPage(BaseModel):
+    items: List[SearchHit]
+    next_cursor: Optional[str] = None
+
 # Service Price Directory Models
 class ServicePrice(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -478,6 +620,7 @@ class Appointment(BaseModel):
     reason: Optional[str] = None
     notes: Optional[str] = None
     patient_notes: Optional[str] = None  # Notes about the patient (separate from appointment notes)
+    created_by: Optional[str] = None  # User ID who created the appointment
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -506,6 +649,101 @@ class AppointmentUpdate(BaseModel):
     notes: Optional[str] = None
     patient_notes: Optional[str] = None
 
+class AppointmentBulkMove(BaseModel):
+    # Select appointments either explicitly by id or by doctor + day
+    appointment_ids: Optional[List[str]] = None
+    source_doctor_id: Optional[str] = None
+    source_date: Optional[str] = None  # YYYY-MM-DD
+    # Where to move them; at least one of these must be set
+    target_doctor_id: Optional[str] = None
+    target_date: Optional[str] = None  # YYYY-MM-DD
+
+class AppointmentBulkMoveFailure(BaseModel):
+    appointment_id: str
+    reason: str
+
+class AppointmentBulkMoveResult(BaseModel):
+    moved: List[str] = []
+    failed: List[AppointmentBulkMoveFailure] = []
+
+# Visit models
+class VisitEntry(BaseModel):
+    entry_type: EntryType = EntryType.VISIT
+    title: str
+    description: str
+    severity: Optional[SeverityLevel] = None
+
+class VisitDiagnosis(BaseModel):
+    diagnosis_code: Optional[str] = None
+    diagnosis_name: str
+    description: Optional[str] = None
+
+class VisitMedication(BaseModel):
+    medication_name: str
+    dosage: str
+    frequency: str
+    end_date: Optional[datetime] = None
+    instructions: Optional[str] = None
+
+class VisitComplete(BaseModel):
+    entry: Optional[VisitEntry] = None
+    diagnoses: List[VisitDiagnosis] = []
+    medications: List[VisitMedication] = []
+    status: AppointmentStatus = AppointmentStatus.COMPLETED
+
+class VisitCompleteResult(BaseModel):
+    appointment: Appointment
+    entry: Optional[MedicalEntry] = None
+    diagnoses: List[Diagnosis]
+    medications: List[Medication]
+    allergy_warnings: List[AllergyWarning] = []
+
+# Waitlist models
+class WaitlistStatus(str, Enum):
+    WAITING = "waiting"
+    BOOKED = "booked"
+    CANCELLED = "cancelled"
+    EXPIRED = "expired"  # latest_date has passed
+
+class WaitlistTimeWindow(BaseModel):
+    start_time: str  # Format: "HH:MM"
+    end_time: str    # Format: "HH:MM"
+    days_of_week: Optional[List[int]] = None  # 0 = Понедельник ... 6 = Воскресенье, None = любой день
+
+class WaitlistEntry(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    patient_id: str
+    doctor_id: Optional[str] = None  # Preferred doctor
+    specialty: Optional[str] = None  # Any doctor of this specialty
+    time_windows: List[WaitlistTimeWindow] = []  # Empty = any time
+    earliest_date: str  # YYYY-MM-DD
+    latest_date: Optional[str] = None  # YYYY-MM-DD
+    reason: Optional[str] = None
+    status: WaitlistStatus = WaitlistStatus.WAITING
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class WaitlistEntryCreate(BaseModel):
+    patient_id: str
+    doctor_id: Optional[str] = None
+    specialty: Optional[str] = None
+    time_windows: List[WaitlistTimeWindow] = []
+    earliest_date: str
+    latest_date: Optional[str] = None
+    reason: Optional[str] = None
+
+class WaitlistOffer(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    waitlist_entry_id: str
+    patient_id: str
+    doctor_id: str
+    appointment_date: str
+    appointment_time: str
+    end_time: Optional[str] = None
+    rank: int
+    status: str = "pending"  # pending, accepted, expired
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
 class AppointmentWithDetails(BaseModel):
     id: str
     patient_id: str
@@ -538,8 +776,26 @@ class Document(BaseModel):
     uploaded_by: str  # User ID who uploaded the file
     uploaded_by_name: str  # Name of the user who uploaded
     description: Optional[str] = None
+    sha256: Optional[str] = None  # Hex digest of the content, computed while uploading
+    # Content-addressed blob holding the file; None for files stored under their own filename
+    storage_key: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+class DocumentListItem(BaseModel):
+    id: str
+    patient_id: str
+    filename: str
+    original_filename: str
+    file_size: int
+    file_type: str
+    uploaded_by_name: str
+    description: Optional[str] = None
+    created_at: datetime
+
+class DocumentsPage(BaseModel):
+    items: List[DocumentListItem]
+    next_cursor: Optional[str] = None  # Pass back as ?cursor= to get the next page
+
 class DocumentCreate(BaseModel):
     patient_id: str
     description: Optional[str] = None
@@ -547,6 +803,32 @@ class DocumentCreate(BaseModel):
 class DocumentUpdate(BaseModel):
     description: Optional[str] = None
 
+class UploadSessionStatus(str, Enum):
+    OPEN = "open"
+    FINALIZING = "finalizing"
+    COMPLETED = "completed"
+
+class UploadSession(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    patient_id: str
+    original_filename: str
+    file_type: str
+    total_size: int
+    description: Optional[str] = None
+    parts: dict = {}  # Offset (as string) -> size of each received chunk
+    bytes_received: int = 0
+    status: UploadSessionStatus = UploadSessionStatus.OPEN
+    document_id: Optional[str] = None
+    created_by: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    expires_at: datetime = Field(default_factory=lambda: datetime.utcnow() + timedelta(hours=UPLOAD_SESSION_TTL_HOURS))
+
+class UploadSessionCreate(BaseModel):
+    filename: str
+    file_type: Optional[str] = None
+    total_size: int
+    description: Optional[str] = None
+
 # Treatment Plan models
 class Service(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -637,6 +919,53 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def create_calendar_token(doctor: dict):
+    # Calendar apps keep the subscription URL forever, so the token does not expire;
+    # it is revoked by bumping the doctor's calendar_token_version instead
+    payload = {"sub": doctor["id"], "scope": "calendar", "ver": doctor.get("calendar_token_version", 0)}
+    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+
+def verify_calendar_token(token: str, doctor: dict):
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return False
+    return (
+        payload.get("scope") == "calendar"
+        and payload.get("sub") == doctor["id"]
+        and payload.get("ver", 0) == doctor.get("calendar_token_version", 0)
+    )
+
+def encode_cursor(position: dict):
+    """Opaque keyset pagination cursor"""
+    return base64.urlsafe_b64encode(json.dumps(jsonable_encoder(position)).encode()).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def ics_escape(text: str):
+    return (text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\r\n", "\\n").replace("\n", "\\n"))
+
+def ics_fold(line: str):
+    """Fold a content line at 75 octets as required by RFC 5545"""
+    encoded = line.encode("utf-8")
+    if len(encoded) <= 75:
+        return line
+    parts = []
+    while encoded:
+        limit = 75 if not parts else 74
+        cut = min(limit, len(encoded))
+        # Never split a multi-byte UTF-8 sequence
+        while cut < len(encoded) and (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut].decode("utf-8"))
+        encoded = encoded[cut:]
+    return "\r\n ".join(parts)
+
 async def get_user_by_email(email: str):
     user = await db.users.find_one({"email": email})
     if user:
@@ -651,14 +980,13 @@ async def authenticate_user(email: str, password: str):
         return False
     return user
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def get_user_from_token(token: str):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
         if email is None:
@@ -672,6 +1000,9 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         raise credentials_exception
     return user
 
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await get_user_from_token(credentials.credentials)
+
 async def get_current_active_user(current_user: UserInDB = Depends(get_current_user)):
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
@@ -687,6 +1018,21 @@ def require_role(allowed_roles: List[UserRole]):
         return current_user
     return role_checker
 
+def schedule_allows(schedule: Optional[dict], appointment_time: str):
+    """(available, message) for a time against the doctor's schedule row for that weekday"""
+    if not schedule:
+        return False, f"Врач не работает в этот день недели"
+    
+    # Check if appointment time is within working hours
+    appointment_time_obj = datetime.strptime(appointment_time, "%H:%M").time()
+    start_time_obj = datetime.strptime(schedule["start_time"], "%H:%M").time()
+    end_time_obj = datetime.strptime(schedule["end_time"], "%H:%M").time()
+    
+    if not (start_time_obj <= appointment_time_obj <= end_time_obj):
+        return False, f"Врач не работает в это время. Рабочие часы: {schedule['start_time']}-{schedule['end_time']}"
+    
+    return True, "Врач доступен"
+
 async def check_doctor_availability(doctor_id: str, appointment_date: str, appointment_time: str):
     """Check if doctor is available on the given date and time"""
     try:
@@ -700,23 +1046,473 @@ async def check_doctor_availability(doctor_id: str, appointment_date: str, appoi
             "day_of_week": day_of_week,
             "is_active": True
         })
-        
-        if not schedule:
-            return False, f"Врач не работает в этот день недели"
-        
-        # Check if appointment time is within working hours
-        appointment_time_obj = datetime.strptime(appointment_time, "%H:%M").time()
-        start_time_obj = datetime.strptime(schedule["start_time"], "%H:%M").time()
-        end_time_obj = datetime.strptime(schedule["end_time"], "%H:%M").time()
-        
-        if not (start_time_obj <= appointment_time_obj <= end_time_obj):
-            return False, f"Врач не работает в это время. Рабочие часы: {schedule['start_time']}-{schedule['end_time']}"
-        
-        return True, "Врач доступен"
+        return schedule_allows(schedule, appointment_time)
         
     except Exception as e:
         return False, f"Ошибка при проверке расписания: {str(e)}"
 
+async def check_slots_availability(slots) -> dict:
+    """check_doctor_availability for many (doctor_id, date, time) slots with one schedule query"""
+    weekdays = {}
+    for doctor_id, appointment_date, _ in slots:
+        try:
+            weekdays[appointment_date] = datetime.strptime(appointment_date, "%Y-%m-%d").weekday()
+        except ValueError:
+            pass
+    keys = {(doctor_id, weekdays[day]) for doctor_id, day, _ in slots if day in weekdays}
+    schedules = {}
+    if keys:
+        rows = await db.doctor_schedules.find({
+            "is_active": True,
+            "$or": [{"doctor_id": doctor_id, "day_of_week": day_of_week} for doctor_id, day_of_week in keys]
+        }, {"_id": 0}).to_list(None)
+        schedules = {(row["doctor_id"], row["day_of_week"]): row for row in rows}
+    
+    availability = {}
+    for slot in slots:
+        doctor_id, appointment_date, appointment_time = slot
+        try:
+            if appointment_date not in weekdays:
+                raise ValueError(f"invalid date {appointment_date}")
+            availability[slot] = schedule_allows(schedules.get((doctor_id, weekdays[appointment_date])), appointment_time)
+        except Exception as e:
+            availability[slot] = (False, f"Ошибка при проверке расписания: {str(e)}")
+    return availability
+
+async def run_in_transaction(operation):
+    """Run operation(session) inside a MongoDB transaction.
+
+    Standalone mongod does not support transactions, in that case the
+    operation is executed with a plain session instead.
+    """
+    async with await client.start_session() as session:
+        try:
+            async with session.start_transaction():
+                return await operation(session)
+        except OperationFailure as e:
+            if e.code != 20:  # IllegalOperation - not a replica set member
+                raise
+        return await operation(session)
+
+class WaitlistIndex:
+    """In-memory index of waiting entries, bucketed by preferred doctor and specialty.
+
+    A freed slot only looks at the bucket of its doctor, the bucket of the
+    doctor's specialty and entries without any preference, never at the
+    whole waitlist. Every app worker keeps its own copy; sync_waitlist_index
+    applies the entries changed in Mongo since the last sync before each use,
+    so entries added or closed through another worker are seen too.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.by_doctor = {}
+        self.by_specialty = {}
+        self.any_doctor = set()
+        self.deadlines = []  # Heap of (latest_date, entry_id), stale pairs are skipped
+        self.synced_at: Optional[datetime] = None
+
+    def _bucket(self, entry: WaitlistEntry):
+        if entry.doctor_id:
+            return self.by_doctor.setdefault(entry.doctor_id, set())
+        if entry.specialty:
+            return self.by_specialty.setdefault(entry.specialty, set())
+        return self.any_doctor
+
+    def add(self, entry: WaitlistEntry):
+        self.remove(entry.id)
+        self.entries[entry.id] = entry
+        self._bucket(entry).add(entry.id)
+        if entry.latest_date:
+            heapq.heappush(self.deadlines, (entry.latest_date, entry.id))
+
+    def remove(self, entry_id: str):
+        entry = self.entries.pop(entry_id, None)
+        if entry:
+            self._bucket(entry).discard(entry_id)
+
+    def apply(self, entry: WaitlistEntry):
+        """Take over the stored state of an entry: index it while waiting, drop it otherwise"""
+        if entry.status == WaitlistStatus.WAITING:
+            self.add(entry)
+        else:
+            self.remove(entry.id)
+
+    def prune(self, today: str) -> List[str]:
+        """Drop entries whose latest_date is before today; returns their ids"""
+        expired = []
+        while self.deadlines and self.deadlines[0][0] < today:
+            latest_date, entry_id = heapq.heappop(self.deadlines)
+            entry = self.entries.get(entry_id)
+            if entry and entry.latest_date == latest_date:
+                self.remove(entry_id)
+                expired.append(entry_id)
+        return expired
+
+    def match(self, doctor_id: str, specialty: Optional[str], appointment_date: str, appointment_time: str, limit: int):
+        """Rank waiting entries for a slot: preferred doctor first, then specialty, then FIFO"""
+        day_of_week = datetime.strptime(appointment_date, "%Y-%m-%d").weekday()
+        candidates = [(0, entry_id) for entry_id in self.by_doctor.get(doctor_id, ())]
+        candidates += [(1, entry_id) for entry_id in self.by_specialty.get(specialty, ())]
+        candidates += [(2, entry_id) for entry_id in self.any_doctor]
+
+        ranked = []
+        for priority, entry_id in candidates:
+            entry = self.entries[entry_id]
+            if appointment_date < entry.earliest_date:
+                continue
+            if entry.latest_date and appointment_date > entry.latest_date:
+                continue
+            if entry.time_windows and not any(
+                window.start_time <= appointment_time < window.end_time
+                and (window.days_of_week is None or day_of_week in window.days_of_week)
+                for window in entry.time_windows
+            ):
+                continue
+            ranked.append((priority, entry.created_at, entry))
+        ranked.sort(key=lambda item: item[:2])
+        return [entry for _, _, entry in ranked[:limit]]
+
+waitlist_index = WaitlistIndex()
+
+class SummaryCache:
+    """LRU cache of serialized per-patient payloads, bounded by their total size in bytes.
+
+    A rebuild takes a version (the current tick of a counter) before reading
+    and hands it back to put(). Invalidating a patient records the tick it
+    happened at, and clear() starts a new generation; a payload whose version
+    predates either is not stored, so a write racing with a rebuild cannot
+    leave a stale snapshot behind. Invalidation ticks are only kept until
+    MAX_INVALIDATIONS of them pile up, then a new generation replaces them.
+
+    The cache lives in one process: with several app workers, a write served
+    by one worker does not invalidate the others and they would keep serving
+    stale allergies and medications. It is therefore disabled unless
+    MEDICAL_SUMMARY_CACHE_BYTES is set, which is only safe with one worker.
+    """
+
+    MAX_INVALIDATIONS = 10_000
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # patient_id -> bytes, least recently used first
+        self.tick = 0
+        self.generation = 0  # payloads built before this tick are not stored
+        self.invalidated = {}  # patient_id -> tick of its last invalidation in this generation
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, patient_id: str) -> Optional[bytes]:
+        if not self.max_bytes:
+            return None
+        payload = self.entries.get(patient_id)
+        if payload is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(patient_id)
+        self.hits += 1
+        return payload
+
+    def version(self) -> int:
+        """Taken before a rebuild reads from the database, handed back to put()"""
+        return self.tick
+
+    def put(self, patient_id: str, payload: bytes, version: int):
+        if version < self.generation or self.invalidated.get(patient_id, -1) > version:
+            return
+        if len(payload) > self.max_bytes:
+            return
+        self._drop(patient_id)
+        self.entries[patient_id] = payload
+        self.size += len(payload)
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def invalidate(self, patient_id: str):
+        self.tick += 1
+        if len(self.invalidated) >= self.MAX_INVALIDATIONS:
+            self._new_generation()
+        else:
+            self.invalidated[patient_id] = self.tick
+        self._drop(patient_id)
+
+    def clear(self):
+        self.tick += 1
+        self._new_generation()
+        self.entries.clear()
+        self.size = 0
+
+    def _new_generation(self):
+        self.generation = self.tick
+        self.invalidated.clear()
+
+    def _drop(self, patient_id: str):
+        payload = self.entries.pop(patient_id, None)
+        if payload is not None:
+            self.size -= len(payload)
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / requests, 4) if requests else None,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes
+        }
+
+medical_summary_cache = SummaryCache(MEDICAL_SUMMARY_CACHE_BYTES)
+
+def record_diff(before: dict, after: dict):
+    """Fields set or changed by a write, and fields it removed"""
+    changes = {k: v for k, v in after.items() if k != "_id" and (k not in before or before[k] != v)}
+    removed = sorted(k for k in before if k != "_id" and k not in after)
+    return changes, removed
+
+class RevisionWriter:
+    """Appends revisions of updated records to the `revisions` collection off the request path.
+
+    A write records its change in `revision_outbox` with the session it runs
+    in, so within a transaction the change and its pending revision commit
+    together. A background task numbers pending changes per record, writes
+    them with one insert_many per batch and only then removes them from the
+    outbox; a batch that fails stays there and is retried. Each worker leases
+    the changes it recorded, and changes of a worker that died are taken over
+    once their lease runs out. Version 0 is the record as first seen,
+    attributed to whoever created it; every REVISION_SNAPSHOT_INTERVAL-th
+    version carries a full snapshot, the rest only the changed fields.
+    """
+
+    def __init__(self):
+        self.worker_id = str(uuid.uuid4())
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+        self.versions = {}  # (collection, record_id) -> last written version
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.stopping = False
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.stopping = True
+            self.wakeup.set()
+            await self.task
+
+    async def record(self, collection: str, before: dict, after: dict, changed_by: Optional[str] = None, session=None):
+        await self.record_many(collection, [(before, after)], changed_by, session)
+
+    async def record_many(self, collection: str, pairs, changed_by: Optional[str] = None, session=None):
+        now = datetime.utcnow()
+        pending = []
+        for before, after in pairs:
+            changes, removed = record_diff(before, after)
+            if set(changes) - {"updated_at"} or removed:
+                pending.append({
+                    "id": str(uuid.uuid4()),
+                    "collection": collection,
+                    "record_id": after["id"],
+                    "before": {k: v for k, v in before.items() if k != "_id"},
+                    "after": {k: v for k, v in after.items() if k != "_id"},
+                    "changes": changes,
+                    "removed": removed,
+                    "changed_by": changed_by,
+                    "created_at": now,
+                    "claimed_by": self.worker_id,
+                    "claimed_until": now + timedelta(seconds=REVISION_LEASE_SECONDS)
+                })
+        if pending:
+            await db.revision_outbox.insert_many(pending, session=session)
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), REVISION_POLL_SECONDS)
+                if not self.stopping:
+                    # Let more changes arrive, and the transactions that recorded them commit
+                    await asyncio.sleep(REVISION_FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                while await self.flush():
+                    pass
+            except Exception as e:
+                # The changes stay in the outbox for the next round
+                logger.error(f"Writing revisions failed, retrying in {REVISION_POLL_SECONDS}s: {e}")
+                self.versions.clear()
+            if self.stopping:
+                return
+
+    async def flush(self) -> bool:
+        """Write one batch of leased changes; True when a full batch was written and more may wait"""
+        now = datetime.utcnow()
+        await db.revision_outbox.update_many(
+            {"$or": [{"claimed_by": self.worker_id}, {"claimed_until": {"$lt": now}}]},
+            {"$set": {"claimed_by": self.worker_id, "claimed_until": now + timedelta(seconds=REVISION_LEASE_SECONDS)}}
+        )
+        batch = await db.revision_outbox.find(
+            {"claimed_by": self.worker_id}, {"_id": 0}
+        ).sort("created_at", 1).limit(REVISION_BATCH_SIZE).to_list(None)
+        if not batch:
+            return False
+        await self.write(batch)
+        await db.revision_outbox.delete_many({"id": {"$in": [change["id"] for change in batch]}})
+        return len(batch) == REVISION_BATCH_SIZE
+
+    async def write(self, batch, attempts: int = 3):
+        # Changes written by an earlier attempt whose outbox cleanup did not go through
+        written = set(await db.revisions.distinct("change_id", {"change_id": {"$in": [c["id"] for c in batch]}}))
+        batch = [change for change in batch if change["id"] not in written]
+        documents, owners = [], []
+        try:
+            await self.load_versions({(change["collection"], change["record_id"]) for change in batch})
+            for position, change in enumerate(batch):
+                for document in self.revision(change):
+                    documents.append(document)
+                    owners.append(position)
+            if documents:
+                await db.revisions.insert_many(documents, ordered=True)
+        except BulkWriteError as e:
+            # Another process took the same version: re-read versions and retry from the failed item
+            self.versions.clear()
+            if attempts <= 1:
+                raise
+            await self.write(batch[owners[e.details.get("nInserted", 0)]:], attempts - 1)
+
+    async def load_versions(self, keys):
+        missing = [key for key in keys if key not in self.versions]
+        if len(self.versions) > 100_000:
+            self.versions.clear()
+        for collection in {c for c, _ in missing}:
+            record_ids = [record_id for c, record_id in missing if c == collection]
+            latest = await db.revisions.aggregate([
+                {"$match": {"collection": collection, "record_id": {"$in": record_ids}}},
+                {"$group": {"_id": "$record_id", "version": {"$max": "$version"}}}
+            ]).to_list(None)
+            found = {r["_id"]: r["version"] for r in latest}
+            for record_id in record_ids:
+                self.versions[(collection, record_id)] = found.get(record_id)
+
+    def revision(self, change: dict):
+        key = (change["collection"], change["record_id"])
+        # None when the record has no history yet: its pre-write state becomes version 0
+        version = self.versions[key]
+        documents = []
+        if version is None:
+            version = 0
+            before = change["before"]
+            documents.append(self._document(
+                change, 0, None, before, [], before.get("created_by"), before.get("created_at", change["created_at"])
+            ))
+        version += 1
+        self.versions[key] = version
+        snapshot = change["after"] if version % REVISION_SNAPSHOT_INTERVAL == 0 else None
+        documents.append(self._document(
+            change, version, change["changes"], snapshot, change["removed"], change["changed_by"], change["created_at"]
+        ))
+        return documents
+
+    @staticmethod
+    def _document(change, version, changes, snapshot, removed, changed_by, created_at):
+        document = {
+            "id": str(uuid.uuid4()),
+            "change_id": change["id"],
+            "collection": change["collection"],
+            "record_id": change["record_id"],
+            "version": version,
+            "changes": changes,
+            "removed": removed,
+            "changed_by": changed_by,
+            "created_at": created_at
+        }
+        if snapshot is not None:
+            document["snapshot"] = snapshot
+        return document
+
+revision_writer = RevisionWriter()
+
+async def sync_waitlist_index():
+    """Apply waitlist entries written since the last sync, by this or any other worker"""
+    now = datetime.utcnow()
+    query = {}
+    if waitlist_index.synced_at:
+        # A little overlap for writes stamped just before the last sync but not yet visible to it
+        query["updated_at"] = {"$gte": waitlist_index.synced_at - timedelta(seconds=WAITLIST_SYNC_OVERLAP_SECONDS)}
+    else:
+        query["status"] = WaitlistStatus.WAITING.value
+    async for entry in db.waitlist.find(query, {"_id": 0}):
+        waitlist_index.apply(WaitlistEntry(**entry))
+    waitlist_index.synced_at = now
+
+async def prune_waitlist(today: str):
+    """Mark waiting entries past their latest_date as expired and drop them from the index"""
+    expired = waitlist_index.prune(today)
+    if expired:
+        await db.waitlist.update_many(
+            {"id": {"$in": expired}, "status": WaitlistStatus.WAITING.value},
+            {"$set": {"status": WaitlistStatus.EXPIRED.value, "updated_at": datetime.utcnow()}}
+        )
+        await db.waitlist_offers.update_many(
+            {"waitlist_entry_id": {"$in": expired}, "status": "pending"}, {"$set": {"status": "expired"}}
+        )
+
+async def offer_freed_slot(appointment: dict):
+    """Offer a slot freed by a cancellation or no-show to the best waitlist matches"""
+    today = datetime.utcnow().strftime("%Y-%m-%d")
+    if appointment["appointment_date"] < today:
+        return []
+    await sync_waitlist_index()
+    await prune_waitlist(today)
+    doctor = await db.doctors.find_one({"id": appointment["doctor_id"]}, {"_id": 0, "specialty": 1})
+    matches = waitlist_index.match(
+        appointment["doctor_id"],
+        doctor["specialty"] if doctor else None,
+        appointment["appointment_date"],
+        appointment["appointment_time"],
+        WAITLIST_MAX_OFFERS
+    )
+    offers = [
+        WaitlistOffer(
+            waitlist_entry_id=entry.id,
+            patient_id=entry.patient_id,
+            doctor_id=appointment["doctor_id"],
+            appointment_date=appointment["appointment_date"],
+            appointment_time=appointment["appointment_time"],
+            end_time=appointment.get("end_time"),
+            rank=rank
+        )
+        for rank, entry in enumerate(matches, start=1)
+    ]
+    if offers:
+        await db.waitlist_offers.insert_many([offer.dict() for offer in offers])
+        logger.info(f"Offered freed slot {appointment['appointment_date']} {appointment['appointment_time']} to {len(offers)} waitlist entries")
+    return offers
+
+async def record_appointment_removal(appointments, session=None):
+    """Leave tombstones so change feed subscribers learn that appointments left
+    their window (deleted, or moved to another doctor, date or patient)"""
+    if not appointments:
+        return
+    now = datetime.utcnow()
+    await db.appointment_tombstones.insert_many([
+        {
+            "id": a["id"],
+            "patient_id": a["patient_id"],
+            "doctor_id": a["doctor_id"],
+            "appointment_date": a["appointment_date"],
+            "deleted_at": now
+        }
+        for a in appointments
+    ], session=session)
+
 # Auth endpoints
 @api_router.post("/auth/register", response_model=Token)
 async def register(user: UserCreate):
@@ -793,7 +1589,7 @@ async def create_patient(
     
     # Automatically create an empty medical record for the new patient
     try:
-        medical_record = MedicalRecord(patient_id=patient_obj.id)
+        medical_record = MedicalRecord(patient_id=patient_obj.id, created_by=current_user.id)
         await db.medical_records.insert_one(medical_record.dict())
         print(f"✅ Auto-created medical record for patient {patient_obj.id}")
     except Exception as e:
@@ -850,6 +1646,7 @@ async def update_patient(
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Patient not found")
+    medical_summary_cache.invalidate(patient_id)
     
     updated_patient = await db.patients.find_one({"id": patient_id})
     return Patient(**updated_patient)
@@ -862,6 +1659,23 @@ async def delete_patient(
     result = await db.patients.delete_one({"id": patient_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Patient not found")
+    medical_summary_cache.invalidate(patient_id)
+    
+    # The waitlist is indexed in memory, so its entries are cancelled here rather than by reconcile_orphans.py
+    entries = await db.waitlist.find(
+        {"patient_id": patient_id, "status": WaitlistStatus.WAITING.value}, {"_id": 0, "id": 1}
+    ).to_list(None)
+    if entries:
+        entry_ids = [entry["id"] for entry in entries]
+        await db.waitlist.update_many(
+            {"id": {"$in": entry_ids}, "status": WaitlistStatus.WAITING.value},
+            {"$set": {"status": WaitlistStatus.CANCELLED.value, "updated_at": datetime.utcnow()}}
+        )
+        for entry_id in entry_ids:
+            waitlist_index.remove(entry_id)
+        await db.waitlist_offers.update_many(
+            {"waitlist_entry_id": {"$in": entry_ids}, "status": "pending"}, {"$set": {"status": "expired"}}
+        )
     return {"message": "Patient deleted successfully"}
 
 # Protected Doctor endpoints
@@ -1212,6 +2026,9 @@ async def update_doctor(
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Doctor not found")
+    if "full_name" in update_dict:
+        # Doctor names are part of every cached summary
+        medical_summary_cache.clear()
     
     updated_doctor = await db.doctors.find_one({"id": doctor_id})
     return Doctor(**updated_doctor)
@@ -1230,6 +2047,153 @@ async def delete_doctor(
         raise HTTPException(status_code=404, detail="Doctor not found")
     return {"message": "Doctor deactivated successfully"}
 
+@api_router.get("/doctors/{doctor_id}/calendar-token")
+async def get_doctor_calendar_token(
+    doctor_id: str,
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
+):
+    """Get the signed subscription URL of a doctor's ICS feed"""
+    if current_user.role == UserRole.DOCTOR and current_user.doctor_id != doctor_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    doctor = await db.doctors.find_one({"id": doctor_id})
+    if not doctor:
+        raise HTTPException(status_code=404, detail="Doctor not found")
+    
+    token = create_calendar_token(doctor)
+    return {"token": token, "url": f"/api/doctors/{doctor_id}/calendar.ics?token={token}"}
+
+@api_router.post("/doctors/{doctor_id}/calendar-token/rotate")
+async def rotate_doctor_calendar_token(
+    doctor_id: str,
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
+):
+    """Revoke every issued subscription URL of a doctor's ICS feed and return a new one"""
+    if current_user.role == UserRole.DOCTOR and current_user.doctor_id != doctor_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    doctor = await db.doctors.find_one_and_update(
+        {"id": doctor_id},
+        {"$inc": {"calendar_token_version": 1}},
+        projection={"_id": 0, "id": 1, "calendar_token_version": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if not doctor:
+        raise HTTPException(status_code=404, detail="Doctor not found")
+    
+    token = create_calendar_token(doctor)
+    return {"token": token, "url": f"/api/doctors/{doctor_id}/calendar.ics?token={token}"}
+
+@api_router.get("/doctors/{doctor_id}/calendar.ics")
+async def get_doctor_calendar_feed(doctor_id: str, token: str, request: Request):
+    """iCalendar feed of a doctor's appointments for phone calendar subscriptions"""
+    doctor = await db.doctors.find_one({"id": doctor_id})
+    # Unknown doctors get the same answer as bad tokens
+    if not doctor or not verify_calendar_token(token, doctor):
+        raise HTTPException(status_code=403, detail="Invalid calendar token")
+    
+    today = datetime.utcnow().date()
+    window_start = (today - timedelta(days=CALENDAR_FEED_DAYS_BACK)).isoformat()
+    window_end = (today + timedelta(days=CALENDAR_FEED_DAYS_AHEAD)).isoformat()
+    inactive_statuses = [AppointmentStatus.CANCELLED.value, AppointmentStatus.NO_SHOW.value]
+    window = {"doctor_id": doctor_id, "appointment_date": {"$gte": window_start, "$lte": window_end}}
+    query = {**window, "status": {"$nin": inactive_statuses}}
+    
+    # Validators come from a small aggregate, the feed is only built when they changed.
+    # Cancelled and no-show appointments count towards last_updated: they just left the feed.
+    versions = await db.appointments.aggregate([
+        {"$match": window},
+        {"$group": {
+            "_id": None,
+            "last_updated": {"$max": "$updated_at"},
+            "count": {"$sum": {"$cond": [{"$in": ["$status", inactive_statuses]}, 0, 1]}},
+            "patient_ids": {"$addToSet": "$patient_id"}
+        }}
+    ]).to_list(1)
+    last_removal = await db.appointment_tombstones.find_one(
+        {"doctor_id": doctor_id}, {"_id": 0, "deleted_at": 1}, sort=[("deleted_at", -1)]
+    )
+    last_updated = versions[0]["last_updated"] if versions else None
+    count = versions[0]["count"] if versions else 0
+    # Event summaries carry patient names, so renaming a patient changes the feed too
+    last_patient_change = await db.patients.find_one(
+        {"id": {"$in": versions[0]["patient_ids"] if versions else []}},
+        {"_id": 0, "updated_at": 1}, sort=[("updated_at", -1)]
+    )
+    last_patient_update = last_patient_change and last_patient_change.get("updated_at")
+    last_modified = max(
+        [t for t in (
+            last_updated, last_removal and last_removal["deleted_at"], doctor["updated_at"], last_patient_update
+        ) if t]
+    ).replace(microsecond=0)
+    
+    version = f"{doctor_id}:{window_start}:{window_end}:{count}:{last_updated}:{last_patient_update}:{last_modified}"
+    etag = f'"{hashlib.sha256(version.encode()).hexdigest()[:32]}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified.replace(tzinfo=timezone.utc), usegmt=True),
+        "Cache-Control": "private, no-cache"
+    }
+    
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match:
+        if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+            return Response(status_code=304, headers=headers)
+    elif if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).astimezone(timezone.utc).replace(tzinfo=None)
+            if last_modified <= since:
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+    
+    appointments = await db.appointments.find(query, {"_id": 0}).sort(
+        [("appointment_date", 1), ("appointment_time", 1)]
+    ).to_list(None)
+    patients = {
+        p["id"]: p["full_name"] for p in await db.patients.find(
+            {"id": {"$in": list({a["patient_id"] for a in appointments})}}, {"_id": 0, "id": 1, "full_name": 1}
+        ).to_list(None)
+    }
+    
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//Clinic Management System//RU",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        f"X-WR-CALNAME:{ics_escape(doctor['full_name'])}"
+    ]
+    for appointment in appointments:
+        start = datetime.strptime(f"{appointment['appointment_date']} {appointment['appointment_time']}", "%Y-%m-%d %H:%M")
+        try:
+            end = datetime.strptime(f"{appointment['appointment_date']} {appointment['end_time']}", "%Y-%m-%d %H:%M")
+        except (TypeError, ValueError):
+            end = start + timedelta(minutes=30)  # Default 30 minutes if no end time
+        summary = patients.get(appointment["patient_id"], "Пациент")
+        if appointment.get("reason"):
+            summary = f"{summary} — {appointment['reason']}"
+        
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:{appointment['id']}@clinic",
+            f"DTSTAMP:{appointment['updated_at'].strftime('%Y%m%dT%H%M%SZ')}",
+            f"DTSTART:{start.strftime('%Y%m%dT%H%M%S')}",
+            f"DTEND:{end.strftime('%Y%m%dT%H%M%S')}",
+            f"SUMMARY:{ics_escape(summary)}",
+            "STATUS:" + ("TENTATIVE" if appointment["status"] == AppointmentStatus.UNCONFIRMED.value else "CONFIRMED")
+        ]
+        if appointment.get("chair_number"):
+            lines.append(f"LOCATION:{ics_escape('Кресло ' + appointment['chair_number'])}")
+        if appointment.get("notes"):
+            lines.append(f"DESCRIPTION:{ics_escape(appointment['notes'])}")
+        lines.append("END:VEVENT")
+    lines.append("END:VCALENDAR")
+    
+    body = "\r\n".join(ics_fold(line) for line in lines) + "\r\n"
+    return Response(content=body, media_type="text/calendar; charset=utf-8", headers=headers)
+
 # Doctor Schedule endpoints
 @api_router.post("/doctors/{doctor_id}/schedule", response_model=DoctorSchedule)
 async def create_doctor_schedule(
@@ -1776,10 +2740,156 @@ async def create_appointment(
         raise HTTPException(status_code=400, detail="Time slot already booked")
     
     appointment_dict = appointment.dict()
-    appointment_obj = Appointment(**appointment_dict)
+    appointment_obj = Appointment(**appointment_dict, created_by=current_user.id)
     await db.appointments.insert_one(appointment_obj.dict())
     return appointment_obj
 
+INACTIVE_APPOINTMENT_STATUSES = [AppointmentStatus.CANCELLED.value, AppointmentStatus.NO_SHOW.value]
+BULK_MOVE_CLOSED_STATUSES = [AppointmentStatus.COMPLETED.value] + INACTIVE_APPOINTMENT_STATUSES
+
+def appointment_slot(appointment: dict):
+    return appointment["doctor_id"], appointment["appointment_date"], appointment["appointment_time"]
+
+def resolve_bulk_move(appointments: List[dict], targets: dict, occupied: set, unavailable: dict) -> dict:
+    """Reasons, by appointment id, why appointments of a bulk move cannot go to their target slots.
+
+    occupied holds slots booked outside the batch, unavailable the schedule
+    failures. Inside the batch a slot stays taken by its current holder
+    unless that holder is moved away, so this resolves until nothing changes.
+    """
+    failed_reasons = dict(unavailable)
+    changed = True
+    while changed:
+        changed = False
+        taken = set(occupied)
+        for a in appointments:
+            if a["id"] in failed_reasons and a["status"] not in INACTIVE_APPOINTMENT_STATUSES:
+                taken.add(appointment_slot(a))
+        for a in appointments:
+            if a["id"] in failed_reasons:
+                continue
+            if a["status"] == AppointmentStatus.COMPLETED.value:
+                reason = "Appointment is already completed"
+            elif a["status"] in INACTIVE_APPOINTMENT_STATUSES:
+                reason = "Appointment is cancelled or marked as no-show"
+            elif targets[a["id"]] in taken:
+                reason = "Time slot already booked"
+            else:
+                taken.add(targets[a["id"]])
+                continue
+            failed_reasons[a["id"]] = reason
+            changed = True
+    return failed_reasons
+
+@api_router.post("/appointments/bulk-move", response_model=AppointmentBulkMoveResult)
+async def bulk_move_appointments(
+    move: AppointmentBulkMove,
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN]))
+):
+    """Move or reassign a set of appointments to another doctor and/or date"""
+    if not move.target_doctor_id and not move.target_date:
+        raise HTTPException(status_code=400, detail="target_doctor_id or target_date is required")
+    
+    if move.target_date:
+        try:
+            datetime.strptime(move.target_date, "%Y-%m-%d")
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+    
+    if move.target_doctor_id:
+        doctor = await db.doctors.find_one({"id": move.target_doctor_id, "is_active": True})
+        if not doctor:
+            raise HTTPException(status_code=404, detail="Doctor not found")
+    
+    if move.appointment_ids:
+        query = {"id": {"$in": move.appointment_ids}}
+    elif move.source_doctor_id and move.source_date:
+        query = {
+            "doctor_id": move.source_doctor_id,
+            "appointment_date": move.source_date,
+            "status": {"$nin": BULK_MOVE_CLOSED_STATUSES}
+        }
+    else:
+        raise HTTPException(status_code=400, detail="Provide appointment_ids or source_doctor_id and source_date")
+    
+    appointments = await db.appointments.find(query, {"_id": 0}).sort("appointment_time", 1).to_list(None)
+    result = AppointmentBulkMoveResult()
+    
+    if move.appointment_ids:
+        found_ids = {a["id"] for a in appointments}
+        for appointment_id in move.appointment_ids:
+            if appointment_id not in found_ids:
+                result.failed.append(AppointmentBulkMoveFailure(appointment_id=appointment_id, reason="Appointment not found"))
+    
+    targets = {
+        a["id"]: (
+            move.target_doctor_id or a["doctor_id"],
+            move.target_date or a["appointment_date"],
+            a["appointment_time"]
+        )
+        for a in appointments
+    }
+    # Target slots must lie within the target doctor's working hours, as for single bookings
+    availability = await check_slots_availability(set(targets.values()))
+    unavailable = {
+        a["id"]: availability[targets[a["id"]]][1]
+        for a in appointments
+        if a["status"] not in BULK_MOVE_CLOSED_STATUSES and not availability[targets[a["id"]]][0]
+    }
+    
+    async def apply_moves(session):
+        # Checked inside the transaction, so the slots cannot be booked between check and write
+        occupied = set()
+        if targets:
+            conflicts = await db.appointments.find(
+                {
+                    "id": {"$nin": list(targets)},
+                    "status": {"$nin": INACTIVE_APPOINTMENT_STATUSES},
+                    "$or": [
+                        {"doctor_id": d, "appointment_date": day, "appointment_time": t}
+                        for d, day, t in set(targets.values())
+                    ]
+                },
+                {"_id": 0, "doctor_id": 1, "appointment_date": 1, "appointment_time": 1},
+                session=session
+            ).to_list(None)
+            occupied = {appointment_slot(c) for c in conflicts}
+        failed_reasons = resolve_bulk_move(appointments, targets, occupied, unavailable)
+        
+        now = datetime.utcnow()
+        moved = []
+        for a in appointments:
+            if a["id"] in failed_reasons:
+                continue
+            doctor_id, appointment_date, _ = targets[a["id"]]
+            moved.append((a, {**a, "doctor_id": doctor_id, "appointment_date": appointment_date, "updated_at": now}))
+        if moved:
+            await record_appointment_removal([before for before, _ in moved], session=session)
+            await db.appointments.bulk_write([
+                UpdateOne(
+                    {"id": before["id"]},
+                    {"$set": {"doctor_id": after["doctor_id"], "appointment_date": after["appointment_date"], "updated_at": now}}
+                )
+                for before, after in moved
+            ], ordered=False, session=session)
+            await revision_writer.record_many("appointments", moved, current_user.id, session=session)
+        return failed_reasons, moved
+    
+    try:
+        failed_reasons, moved = await run_in_transaction(apply_moves)
+    except (BulkWriteError, OperationFailure) as e:
+        logger.error(f"Bulk appointment move failed: {e}")
+        failed_reasons, moved = {a["id"]: "Database write failed" for a in appointments}, []
+    
+    for a in appointments:
+        if a["id"] in failed_reasons:
+            result.failed.append(AppointmentBulkMoveFailure(appointment_id=a["id"], reason=failed_reasons[a["id"]]))
+    for before, after in moved:
+        result.moved.append(before["id"])
+    
+    logger.info(f"Bulk move: {len(result.moved)} moved, {len(result.failed)} failed")
+    return result
+
 @api_router.get("/appointments", response_model=List[AppointmentWithDetails])
 async def get_appointments(
     date_from: Optional[str] = None, 
@@ -1853,6 +2963,225 @@ async def get_appointments(
     appointments = await db.appointments.aggregate(pipeline).to_list(None)  # Убираем лимит
     return [AppointmentWithDetails(**appointment) for appointment in appointments]
 
+@api_router.get("/appointments/calendar-summary")
+async def get_appointments_calendar_summary(
+    month: str,
+    doctor_id: Optional[str] = None,
+    current_user: UserInDB = Depends(get_current_active_user)
+):
+    """Per-day appointment counts by status for the month grid: {date: {status: count}}"""
+    try:
+        month_start = datetime.strptime(month, "%Y-%m")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid month format. Use YYYY-MM")
+    
+    query = {}
+    
+    # Role-based filtering
+    if current_user.role == UserRole.PATIENT:
+        query["patient_id"] = current_user.patient_id
+    elif current_user.role == UserRole.DOCTOR:
+        query["doctor_id"] = current_user.doctor_id
+    elif doctor_id:
+        query["doctor_id"] = doctor_id
+    
+    # Dates are stored as YYYY-MM-DD strings, so "-31" bounds every month
+    query["appointment_date"] = {"$gte": month_start.strftime("%Y-%m-01"), "$lte": month_start.strftime("%Y-%m-31")}
+    
+    # Only indexed fields are referenced, so the status/date indexes cover the whole aggregation
+    pipeline = [
+        {"$match": query},
+        {"$group": {"_id": {"date": "$appointment_date", "status": "$status"}, "count": {"$sum": 1}}}
+    ]
+    
+    summary = {}
+    async for group in db.appointments.aggregate(pipeline):
+        summary.setdefault(group["_id"]["date"], {})[group["_id"]["status"]] = group["count"]
+    return dict(sorted(summary.items()))
+
+async def add_appointment_details(appointments):
+    """Attach patient and doctor display fields using one batched query per collection"""
+    patient_ids = list({a["patient_id"] for a in appointments})
+    doctor_ids = list({a["doctor_id"] for a in appointments})
+    patients = {
+        p["id"]: p for p in await db.patients.find(
+            {"id": {"$in": patient_ids}}, {"_id": 0, "id": 1, "full_name": 1}
+        ).to_list(None)
+    }
+    doctors = {
+        d["id"]: d for d in await db.doctors.find(
+            {"id": {"$in": doctor_ids}}, {"_id": 0, "id": 1, "full_name": 1, "specialty": 1, "calendar_color": 1}
+        ).to_list(None)
+    }
+    
+    detailed = []
+    for appointment in appointments:
+        patient = patients.get(appointment["patient_id"])
+        doctor = doctors.get(appointment["doctor_id"])
+        if not patient or not doctor:
+            continue
+        detailed.append(AppointmentWithDetails(**{
+            "end_time": None,
+            "chair_number": None,
+            "price": None,
+            "patient_notes": None,
+            **appointment,
+            "patient_name": patient["full_name"],
+            "doctor_name": doctor["full_name"],
+            "doctor_specialty": doctor["specialty"],
+            "doctor_color": doctor["calendar_color"]
+        }))
+    return detailed
+
+async def watch_appointment_changes(query):
+    """Yield batches of (event, document) from a MongoDB change stream, or None as a heartbeat"""
+    match = {
+        "operationType": {"$in": ["insert", "update", "replace"]},
+        "ns.coll": {"$in": ["appointments", "appointment_tombstones"]}
+    }
+    match.update({f"fullDocument.{field}": value for field, value in query.items()})
+    
+    async with db.watch(
+        [{"$match": match}],
+        full_document="updateLookup",
+        max_await_time_ms=APPOINTMENT_FEED_HEARTBEAT_SECONDS * 1000
+    ) as stream:
+        while stream.alive:
+            change = await stream.try_next()
+            if change is None:
+                yield None
+                continue
+            document = change["fullDocument"]
+            if document is None:
+                # Deleted before the lookup; its tombstone carries the delete
+                continue
+            if change["ns"]["coll"] == "appointment_tombstones":
+                yield [("delete", document)]
+            elif change["operationType"] == "insert":
+                yield [("create", document)]
+            else:
+                yield [("update", document)]
+
+async def poll_appointment_changes(query):
+    """Fallback for standalone mongod: poll updated_at / deleted_at for new changes"""
+    started = datetime.utcnow()
+    # Per collection: newest timestamp seen and the ids already sent for it
+    last_seen = {
+        "appointment_tombstones": (started, set()),
+        "appointments": (started, set())
+    }
+    # Appointments created since the stream started and already sent; a later change to them is an update
+    announced = set()
+    
+    async def fetch_since(collection_name, field):
+        since, sent = last_seen[collection_name]
+        documents = await db[collection_name].find(
+            {**query, field: {"$gte": since}}, {"_id": 0}
+        ).sort(field, 1).to_list(None)
+        documents = [d for d in documents if not (d[field] == since and d["id"] in sent)]
+        if documents:
+            newest = documents[-1][field]
+            newest_ids = {d["id"] for d in documents if d[field] == newest}
+            last_seen[collection_name] = (newest, newest_ids | sent if newest == since else newest_ids)
+        return documents
+    
+    idle_seconds = 0
+    while True:
+        await asyncio.sleep(APPOINTMENT_FEED_POLL_SECONDS)
+        # Tombstones first: a moved appointment is removed from its old window before it reappears
+        batch = [("delete", d) for d in await fetch_since("appointment_tombstones", "deleted_at")]
+        for d in await fetch_since("appointments", "updated_at"):
+            if d["created_at"] >= started and d["id"] not in announced:
+                announced.add(d["id"])
+                batch.append(("create", d))
+            else:
+                batch.append(("update", d))
+        if batch:
+            idle_seconds = 0
+            yield batch
+            continue
+        idle_seconds += APPOINTMENT_FEED_POLL_SECONDS
+        if idle_seconds >= APPOINTMENT_FEED_HEARTBEAT_SECONDS:
+            idle_seconds = 0
+            yield None
+
+async def appointment_changes(query):
+    global change_streams_available
+    if change_streams_available is not False:
+        try:
+            async for batch in watch_appointment_changes(query):
+                change_streams_available = True
+                yield batch
+            return
+        except OperationFailure as e:
+            # 40573: change streams are only supported on replica sets
+            if e.code not in (20, 40573):
+                raise
+            change_streams_available = False
+            logger.info("Change streams unavailable, appointment feed falls back to polling")
+    
+    async for batch in poll_appointment_changes(query):
+        yield batch
+
+@api_router.get("/appointments/changes")
+async def stream_appointment_changes(
+    token: str,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    doctor_id: Optional[str] = None
+):
+    """Server-sent events with appointment create/update/delete deltas.
+
+    The token is passed as a query parameter because EventSource cannot set
+    headers. A "delete" event is also sent when an appointment moves out of
+    the subscribed doctor/date window.
+    """
+    current_user = await get_user_from_token(token)
+    if not current_user.is_active:
+        raise HTTPException(status_code=400, detail="Inactive user")
+    
+    query = {}
+    
+    # Role-based filtering
+    if current_user.role == UserRole.PATIENT:
+        query["patient_id"] = current_user.patient_id
+    elif current_user.role == UserRole.DOCTOR:
+        query["doctor_id"] = current_user.doctor_id
+    elif doctor_id:
+        query["doctor_id"] = doctor_id
+    
+    if date_from or date_to:
+        date_query = {}
+        if date_from:
+            date_query["$gte"] = date_from
+        if date_to:
+            date_query["$lte"] = date_to
+        query["appointment_date"] = date_query
+    
+    async def event_stream():
+        yield "retry: 3000\n\n"
+        async for batch in appointment_changes(query):
+            if batch is None:
+                yield ": keep-alive\n\n"
+                continue
+            detailed = {
+                a.id: a for a in await add_appointment_details([d for event, d in batch if event != "delete"])
+            }
+            for event, document in batch:
+                if event == "delete":
+                    payload = {"id": document["id"]}
+                elif document["id"] in detailed:
+                    payload = jsonable_encoder(detailed[document["id"]])
+                else:
+                    continue
+                yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @api_router.get("/appointments/{appointment_id}", response_model=AppointmentWithDetails)
 async def get_appointment(
     appointment_id: str,
@@ -1965,12 +3294,28 @@ async def update_appointment(
         if conflict:
             raise HTTPException(status_code=400, detail="Time slot already booked")
     
-    result = await db.appointments.update_one(
-        {"id": appointment_id}, 
-        {"$set": update_dict}
-    )
+    async def apply_update(session):
+        if any(k in update_dict and update_dict[k] != existing[k] for k in ("patient_id", "doctor_id", "appointment_date")):
+            await record_appointment_removal([existing], session=session)
+        updated = await db.appointments.find_one_and_update(
+            {"id": appointment_id},
+            {"$set": update_dict},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if not updated:
+            raise HTTPException(status_code=404, detail="Appointment not found")
+        await revision_writer.record("appointments", existing, updated, current_user.id, session=session)
+        return updated
+    
+    updated_appointment = await run_in_transaction(apply_update)
+    
+    # Offer the freed slot to the waitlist
+    inactive_statuses = [AppointmentStatus.CANCELLED.value, AppointmentStatus.NO_SHOW.value]
+    if updated_appointment["status"] in inactive_statuses and existing["status"] not in inactive_statuses:
+        await offer_freed_slot(updated_appointment)
     
-    updated_appointment = await db.appointments.find_one({"id": appointment_id})
     return Appointment(**updated_appointment)
 
 @api_router.delete("/appointments/{appointment_id}")
@@ -1978,12 +3323,286 @@ async def delete_appointment(
     appointment_id: str,
     current_user: UserInDB = Depends(require_role([UserRole.ADMIN]))
 ):
-    result = await db.appointments.delete_one({"id": appointment_id})
-    if result.deleted_count == 0:
+    appointment = await db.appointments.find_one({"id": appointment_id})
+    if not appointment:
         raise HTTPException(status_code=404, detail="Appointment not found")
+    
+    await record_appointment_removal([appointment])
+    await db.appointments.delete_one({"id": appointment_id})
     return {"message": "Appointment deleted successfully"}
 
-# Medical Records endpoints
+# Full-text search
+# kind -> (collection, patient id field, title field, text fields, date field)
+SEARCH_SOURCES = {
+    "appointment": ("appointments", "patient_id", "reason", ["notes", "reason"], "appointment_date"),
+    "diagnosis": ("diagnoses", "patient_id", "diagnosis_name", ["description", "diagnosis_name"], "diagnosed_date"),
+    "medical_entry": ("medical_entries", "patient_id", "title", ["description", "title"], "date"),
+    "patient": ("patients", "id", "full_name", ["notes"], "created_at"),
+}
+# Staff notes on the patient card, never searched for users with the patient role
+SEARCH_STAFF_ONLY_SOURCES = {"patient"}
+
+async def search_source(kind: str, q: str, patient_id: Optional[str], after: Optional[dict], limit: int):
+    """Ranked hits of one collection, continuing after the (score, kind, id) keyset position"""
+    collection, patient_field, title_field, text_fields, date_field = SEARCH_SOURCES[kind]
+    
+    match = {"$text": {"$search": q}}
+    if patient_id:
+        match[patient_field] = patient_id
+    pipeline = [{"$match": match}, {"$addFields": {"score": {"$meta": "textScore"}}}]
+    
+    if after:
+        # Order is score desc, then kind, then id, across all collections
+        if kind < after["kind"]:
+            keyset = {"score": {"$lt": after["score"]}}
+        elif kind == after["kind"]:
+            keyset = {"$or": [
+                {"score": {"$lt": after["score"]}},
+                {"score": after["score"], "id": {"$gt": after["id"]}}
+            ]}
+        else:
+            keyset = {"score": {"$lte": after["score"]}}
+        pipeline.append({"$match": keyset})
+    
+    pipeline += [
+        {"$sort": {"score": -1, "id": 1}},
+        {"$limit": limit},
+        {"$project": {
+            "_id": 0, "id": 1, "score": 1,
+            "patient_id": f"${patient_field}",
+            "title": f"${title_field}",
+            "date": f"${date_field}",
+            **{field: 1 for field in text_fields}
+        }}
+    ]
+    
+    hits = []
+    async for document in db[collection].aggregate(pipeline):
+        snippet = next((document[f] for f in text_fields if document.get(f)), None)
+        date = document.get("date")
+        hits.append({
+            "kind": kind,
+            "id": document["id"],
+            "patient_id": document["patient_id"],
+            "title": document.get("title") or "",
+            "snippet": snippet[:160] if snippet else None,
+            "date": date.isoformat() if isinstance(date, datetime) else date,
+            "score": document["score"]
+        })
+    return hits
+
+@api_router.get("/search", response_model=SearchPage)
+async def search_clinical_notes(
+    q: str,
+    cursor: Optional[str] = None,
+    limit: int = 20,
+    current_user: UserInDB = Depends(get_current_active_user)
+):
+    """Ranked full-text search over medical entries, diagnoses, appointment and patient notes"""
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Search query is empty")
+    limit = max(1, min(limit, 50))
+    
+    # Patients only find their own records
+    patient_id = current_user.patient_id if current_user.role == UserRole.PATIENT else None
+    if current_user.role == UserRole.PATIENT and not patient_id:
+        return SearchPage(items=[])
+    
+    after = decode_cursor(cursor) if cursor else None
+    if after is not None and not (
+        isinstance(after, dict)
+        and isinstance(after.get("score"), (int, float)) and not isinstance(after.get("score"), bool)
+        and after.get("kind") in SEARCH_SOURCES
+        and isinstance(after.get("id"), str)
+        and isinstance(after.get("returned"), int) and after["returned"] >= 0
+    ):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    returned = after["returned"] if after else 0
+    limit = min(limit, SEARCH_MAX_RESULTS - returned)
+    if limit <= 0:
+        return SearchPage(items=[])
+    
+    kinds = [
+        kind for kind in SEARCH_SOURCES
+        if current_user.role != UserRole.PATIENT or kind not in SEARCH_STAFF_ONLY_SOURCES
+    ]
+    # Every collection returns at most one page; merging them gives the next page overall
+    results = await asyncio.gather(*[
+        search_source(kind, q, patient_id, after, limit + 1) for kind in kinds
+    ])
+    merged = sorted(
+        (hit for hits in results for hit in hits),
+        key=lambda hit: (-hit["score"], hit["kind"], hit["id"])
+    )
+    page = merged[:limit]
+    
+    patients = {
+        p["id"]: p["full_name"] for p in await db.patients.find(
+            {"id": {"$in": list({hit["patient_id"] for hit in page})}}, {"_id": 0, "id": 1, "full_name": 1}
+        ).to_list(None)
+    }
+    
+    next_cursor = None
+    if len(merged) > limit and returned + len(page) < SEARCH_MAX_RESULTS:
+        last = page[-1]
+        next_cursor = encode_cursor({
+            "score": last["score"], "kind": last["kind"], "id": last["id"], "returned": returned + len(page)
+        })
+    
+    return SearchPage(
+        items=[SearchHit(**hit, patient_name=patients.get(hit["patient_id"])) for hit in page],
+        next_cursor=next_cursor
+    )
+
+# Waitlist endpoints
+@api_router.post("/waitlist", response_model=WaitlistEntry)
+async def create_waitlist_entry(
+    entry: WaitlistEntryCreate,
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
+):
+    """Add a patient to the waitlist"""
+    patient = await db.patients.find_one({"id": entry.patient_id})
+    if not patient:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    
+    if entry.doctor_id:
+        doctor = await db.doctors.find_one({"id": entry.doctor_id})
+        if not doctor:
+            raise HTTPException(status_code=404, detail="Doctor not found")
+    
+    try:
+        datetime.strptime(entry.earliest_date, "%Y-%m-%d")
+        if entry.latest_date:
+            datetime.strptime(entry.latest_date, "%Y-%m-%d")
+        for window in entry.time_windows:
+            datetime.strptime(window.start_time, "%H:%M")
+            datetime.strptime(window.end_time, "%H:%M")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date or time format. Use YYYY-MM-DD and HH:MM")
+    
+    entry_obj = WaitlistEntry(**entry.dict())
+    await db.waitlist.insert_one(entry_obj.dict())
+    waitlist_index.add(entry_obj)
+    return entry_obj
+
+@api_router.get("/waitlist", response_model=List[WaitlistEntry])
+async def get_waitlist(
+    doctor_id: Optional[str] = None,
+    status: WaitlistStatus = WaitlistStatus.WAITING,
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
+):
+    """Get waitlist entries"""
+    query = {"status": status.value}
+    if doctor_id:
+        query["doctor_id"] = doctor_id
+    
+    entries = await db.waitlist.find(query).sort("created_at", 1).to_list(1000)
+    return [WaitlistEntry(**entry) for entry in entries]
+
+@api_router.delete("/waitlist/{entry_id}")
+async def delete_waitlist_entry(
+    entry_id: str,
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
+):
+    """Remove a patient from the waitlist"""
+    result = await db.waitlist.update_one(
+        {"id": entry_id, "status": WaitlistStatus.WAITING.value},
+        {"$set": {"status": WaitlistStatus.CANCELLED.value, "updated_at": datetime.utcnow()}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Waitlist entry not found")
+    
+    waitlist_index.remove(entry_id)
+    await db.waitlist_offers.update_many(
+        {"waitlist_entry_id": entry_id, "status": "pending"}, {"$set": {"status": "expired"}}
+    )
+    return {"message": "Waitlist entry cancelled successfully"}
+
+@api_router.get("/waitlist/offers", response_model=List[WaitlistOffer])
+async def get_waitlist_offers(
+    offer_status: str = "pending",
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
+):
+    """Get slot offers made to waitlisted patients"""
+    offers = await db.waitlist_offers.find({"status": offer_status}).sort([
+        ("appointment_date", 1), ("appointment_time", 1), ("rank", 1)
+    ]).to_list(1000)
+    return [WaitlistOffer(**offer) for offer in offers]
+
+@api_router.post("/waitlist/offers/{offer_id}/accept", response_model=Appointment)
+async def accept_waitlist_offer(
+    offer_id: str,
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
+):
+    """Book the offered slot for the waitlisted patient"""
+    # Claiming the offer first makes a retried or concurrent accept of the same offer a 404
+    offer = await db.waitlist_offers.find_one_and_update(
+        {"id": offer_id, "status": "pending"}, {"$set": {"status": "accepted"}}
+    )
+    if not offer:
+        raise HTTPException(status_code=404, detail="Offer not found")
+    
+    entry = await db.waitlist.find_one({"id": offer["waitlist_entry_id"]})
+    if not entry or entry["status"] != WaitlistStatus.WAITING.value:
+        await db.waitlist_offers.update_one({"id": offer_id}, {"$set": {"status": "expired"}})
+        raise HTTPException(status_code=409, detail="Waitlist entry is no longer waiting")
+    
+    # One slot is offered to several entries; a short-lived lock keeps their accepts from booking it twice
+    slot_lock = f"{offer['doctor_id']}|{offer['appointment_date']}|{offer['appointment_time']}"
+    try:
+        await db.waitlist_slot_locks.insert_one({"_id": slot_lock, "created_at": datetime.utcnow()})
+    except DuplicateKeyError:
+        await db.waitlist_offers.update_one({"id": offer_id}, {"$set": {"status": "pending"}})
+        raise HTTPException(status_code=409, detail="Time slot is being booked right now, try again")
+    
+    try:
+        conflict = await db.appointments.find_one({
+            "doctor_id": offer["doctor_id"],
+            "appointment_date": offer["appointment_date"],
+            "appointment_time": offer["appointment_time"],
+            "status": {"$nin": [AppointmentStatus.CANCELLED.value, AppointmentStatus.NO_SHOW.value]}
+        })
+        if conflict:
+            await db.waitlist_offers.update_one({"id": offer_id}, {"$set": {"status": "expired"}})
+            raise HTTPException(status_code=400, detail="Time slot already booked")
+        
+        appointment_obj = Appointment(
+            patient_id=offer["patient_id"],
+            doctor_id=offer["doctor_id"],
+            appointment_date=offer["appointment_date"],
+            appointment_time=offer["appointment_time"],
+            end_time=offer.get("end_time"),
+            reason=entry.get("reason"),
+            created_by=current_user.id
+        )
+        await db.appointments.insert_one(appointment_obj.dict())
+    finally:
+        await db.waitlist_slot_locks.delete_one({"_id": slot_lock})
+    
+    # The slot is gone for everybody else, and this patient no longer waits
+    await db.waitlist_offers.update_many(
+        {
+            "status": "pending",
+            "$or": [
+                {
+                    "doctor_id": offer["doctor_id"],
+                    "appointment_date": offer["appointment_date"],
+                    "appointment_time": offer["appointment_time"]
+                },
+                {"waitlist_entry_id": offer["waitlist_entry_id"]}
+            ]
+        },
+        {"$set": {"status": "expired"}}
+    )
+    await db.waitlist.update_one(
+        {"id": offer["waitlist_entry_id"]},
+        {"$set": {"status": WaitlistStatus.BOOKED.value, "updated_at": datetime.utcnow()}}
+    )
+    waitlist_index.remove(offer["waitlist_entry_id"])
+    
+    return appointment_obj
+
+# Medical Records endpoints
 @api_router.post("/medical-records", response_model=MedicalRecord)
 async def create_medical_record(
     record: MedicalRecordCreate,
@@ -2000,8 +3619,9 @@ async def create_medical_record(
         raise HTTPException(status_code=400, detail="Medical record already exists for this patient")
     
     record_dict = record.dict()
-    record_obj = MedicalRecord(**record_dict)
+    record_obj = MedicalRecord(**record_dict, created_by=current_user.id)
     await db.medical_records.insert_one(record_obj.dict())
+    medical_summary_cache.invalidate(record_obj.patient_id)
     return record_obj
 
 @api_router.get("/medical-records/{patient_id}", response_model=MedicalRecord)
@@ -2027,15 +3647,22 @@ async def update_medical_record(
     update_dict = {k: v for k, v in record_update.dict().items() if v is not None}
     update_dict["updated_at"] = datetime.utcnow()
     
-    result = await db.medical_records.update_one(
-        {"patient_id": patient_id}, 
-        {"$set": update_dict}
-    )
-    
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Medical record not found")
-    
-    updated_record = await db.medical_records.find_one({"patient_id": patient_id})
+    async def apply_update(session):
+        existing = await db.medical_records.find_one_and_update(
+            {"patient_id": patient_id}, 
+            {"$set": update_dict},
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE,
+            session=session
+        )
+        if not existing:
+            raise HTTPException(status_code=404, detail="Medical record not found")
+        updated = {**existing, **update_dict}
+        await revision_writer.record("medical_records", existing, updated, current_user.id, session=session)
+        return updated
+    
+    updated_record = await run_in_transaction(apply_update)
+    medical_summary_cache.invalidate(patient_id)
     return MedicalRecord(**updated_record)
 
 # Medical Entries endpoints
@@ -2060,70 +3687,92 @@ async def create_medical_entry(
     
     entry_obj = MedicalEntry(**entry_dict)
     await db.medical_entries.insert_one(entry_obj.dict())
+    medical_summary_cache.invalidate(entry_obj.patient_id)
     return entry_obj
 
-@api_router.get("/medical-entries/{patient_id}", response_model=List[MedicalEntryWithDetails])
+@api_router.get("/medical-entries/{patient_id}", response_model=MedicalEntriesPage)
 async def get_patient_medical_entries(
     patient_id: str,
+    entry_type: Optional[EntryType] = None,
+    cursor: Optional[str] = None,
+    limit: int = 50,
     current_user: UserInDB = Depends(get_current_active_user)
 ):
+    """Newest-first page of a patient's medical entries, keyset-paginated on (date, id)"""
     # Check access rights
     if current_user.role == UserRole.PATIENT and current_user.patient_id != patient_id:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    # Aggregate entries with doctor and patient details
-    pipeline = [
-        {"$match": {"patient_id": patient_id}},
-        {
-            "$lookup": {
-                "from": "patients",
-                "localField": "patient_id",
-                "foreignField": "id",
-                "as": "patient"
-            }
-        },
-        {
-            "$lookup": {
-                "from": "doctors",
-                "localField": "doctor_id",
-                "foreignField": "id",
-                "as": "doctor"
-            }
-        },
-        {"$unwind": "$patient"},
-        {"$unwind": "$doctor"},
-        {
-            "$project": {
-                "_id": 0,
-                "id": 1,
-                "patient_id": 1,
-                "doctor_id": 1,
-                "appointment_id": 1,
-                "entry_type": 1,
-                "title": 1,
-                "description": 1,
-                "severity": 1,
-                "date": 1,
-                "is_active": 1,
-                "created_at": 1,
-                "updated_at": 1,
-                "doctor_name": "$doctor.full_name",
-                "patient_name": "$patient.full_name"
-            }
-        },
-        {"$sort": {"date": -1}}
-    ]
+    limit = max(1, min(limit, 200))
+    
+    patient = await db.patients.find_one({"id": patient_id}, {"_id": 0, "full_name": 1})
+    if not patient:
+        raise HTTPException(status_code=404, detail="Patient not found")
     
-    entries = await db.medical_entries.aggregate(pipeline).to_list(1000)
-    return [MedicalEntryWithDetails(**entry) for entry in entries]
+    query = {"patient_id": patient_id}
+    if entry_type:
+        query["entry_type"] = entry_type.value
+    if cursor:
+        position = decode_cursor(cursor)
+        try:
+            after_date = datetime.fromisoformat(position["date"])
+            after_id = position["id"]
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query["$or"] = [
+            {"date": {"$lt": after_date}},
+            {"date": after_date, "id": {"$lt": after_id}}
+        ]
+    
+    # Bounded scan of the (patient_id, date, id) index; one extra row tells if there is a next page
+    entries = await db.medical_entries.find(query, {"_id": 0}).sort(
+        [("date", -1), ("id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    
+    doctors = {
+        d["id"]: d["full_name"] for d in await db.doctors.find(
+            {"id": {"$in": list({e["doctor_id"] for e in entries})}}, {"_id": 0, "id": 1, "full_name": 1}
+        ).to_list(None)
+    }
+    
+    items = [
+        MedicalEntryWithDetails(**entry, doctor_name=doctors[entry["doctor_id"]], patient_name=patient["full_name"])
+        for entry in entries if entry["doctor_id"] in doctors
+    ]
+    next_cursor = encode_cursor({"date": entries[-1]["date"], "id": entries[-1]["id"]}) if has_more else None
+    return MedicalEntriesPage(items=items, next_cursor=next_cursor)
+
+# МКБ-10 dictionary endpoints
+@api_router.get("/icd10/search", response_model=List[Icd10Code])
+async def search_icd10(
+    q: str,
+    limit: int = 20,
+    current_user: UserInDB = Depends(get_current_active_user)
+):
+    """Search МКБ-10 by code prefix (K02) or by name (кариес)"""
+    return icd10_dictionary.search(q, max(1, min(limit, 100)))
 
 # Diagnoses endpoints
+def validate_icd10_code(code: str) -> str:
+    """Normalize a МКБ-10 code, rejecting malformed (and, in strict mode, unknown) codes"""
+    code = normalize_code(code)
+    if not is_valid_code_format(code):
+        raise HTTPException(status_code=400, detail="Invalid ICD-10 code format. Use e.g. K02.1")
+    if ICD10_STRICT and not icd10_dictionary.get(code):
+        raise HTTPException(status_code=400, detail=f"Unknown ICD-10 code: {code}")
+    return code
+
 @api_router.post("/diagnoses", response_model=Diagnosis)
 async def create_diagnosis(
     diagnosis: DiagnosisCreate,
     current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
 ):
     diagnosis_dict = diagnosis.dict()
+    if diagnosis.diagnosis_code:
+        diagnosis_dict["diagnosis_code"] = validate_icd10_code(diagnosis.diagnosis_code)
+    
     # Set doctor_id based on current user
     if current_user.role == UserRole.DOCTOR and current_user.doctor_id:
         diagnosis_dict["doctor_id"] = current_user.doctor_id
@@ -2139,6 +3788,7 @@ async def create_diagnosis(
     
     diagnosis_obj = Diagnosis(**diagnosis_dict)
     await db.diagnoses.insert_one(diagnosis_obj.dict())
+    medical_summary_cache.invalidate(diagnosis_obj.patient_id)
     return diagnosis_obj
 
 @api_router.get("/diagnoses/{patient_id}", response_model=List[DiagnosisWithDetails])
@@ -2200,7 +3850,21 @@ async def get_patient_diagnoses(
     return [DiagnosisWithDetails(**diagnosis) for diagnosis in diagnoses]
 
 # Medications endpoints
-@api_router.post("/medications", response_model=Medication)
+def check_medication_allergies(medication_name: str, allergies: List[dict]) -> List[AllergyWarning]:
+    warnings = []
+    for allergy in allergies:
+        groups = allergen_index.shared_groups(medication_name, allergy["allergen"])
+        if groups:
+            warnings.append(AllergyWarning(
+                allergy_id=allergy["id"],
+                allergen=allergy["allergen"],
+                reaction=allergy["reaction"],
+                severity=allergy["severity"],
+                allergen_groups=sorted(groups)
+            ))
+    return warnings
+
+@api_router.post("/medications", response_model=MedicationCreateResult)
 async def create_medication(
     medication: MedicationCreate,
     current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
@@ -2219,9 +3883,116 @@ async def create_medication(
     else:
         raise HTTPException(status_code=400, detail="User not associated with any doctor")
     
+    # Cross-check against the patient's active allergies before anything is written,
+    # served by the (patient_id, is_active) index
+    allergies = await db.allergies.find(
+        {"patient_id": medication.patient_id, "is_active": True},
+        {"_id": 0, "id": 1, "allergen": 1, "reaction": 1, "severity": 1}
+    ).to_list(None)
+    allergy_warnings = check_medication_allergies(medication.medication_name, allergies)
+    acknowledged = set(medication_dict.pop("acknowledged_allergy_ids"))
+    if any(warning.allergy_id not in acknowledged for warning in allergy_warnings):
+        raise HTTPException(status_code=409, detail={
+            "message": "У пациента аллергия на назначаемое лекарство, требуется подтверждение",
+            "allergy_warnings": jsonable_encoder(allergy_warnings)
+        })
+    
     medication_obj = Medication(**medication_dict)
     await db.medications.insert_one(medication_obj.dict())
-    return medication_obj
+    medical_summary_cache.invalidate(medication_obj.patient_id)
+    return MedicationCreateResult(**medication_obj.dict(), allergy_warnings=allergy_warnings)
+
+def next_expiry_stamp(previous: Optional[datetime]) -> datetime:
+    stamp = datetime.utcnow()
+    stamp = stamp.replace(microsecond=stamp.microsecond // 1000 * 1000)
+    if previous is not None and stamp <= previous:
+        stamp = previous.replace(microsecond=previous.microsecond // 1000 * 1000) + timedelta(milliseconds=1)
+    return stamp
+
+async def expire_medications() -> int:
+    """Deactivate medications whose end_date has passed, in batches walking the (is_active, end_date) index.
+
+    Every batch is stamped with its own expired_at, later than any stamp
+    before it, so a poller whose cursor sits inside one batch cannot miss
+    rows of the next one sorting before it by id.
+    """
+    now = datetime.utcnow()
+    latest = await db.medications.find(
+        {"expired_at": {"$exists": True}}, {"_id": 0, "expired_at": 1}
+    ).sort("expired_at", -1).limit(1).to_list(1)
+    stamp = latest[0]["expired_at"] if latest else None
+    expired = 0
+    while True:
+        batch = await db.medications.find(
+            {"is_active": True, "end_date": {"$lt": now}},
+            {"_id": 0, "id": 1, "patient_id": 1}
+        ).sort("end_date", 1).limit(MEDICATION_EXPIRY_BATCH_SIZE).to_list(MEDICATION_EXPIRY_BATCH_SIZE)
+        if not batch:
+            break
+        
+        # Mongo keeps milliseconds, so stamps have to differ by at least one
+        stamp = next_expiry_stamp(stamp)
+        result = await db.medications.update_many(
+            {"id": {"$in": [m["id"] for m in batch]}, "is_active": True},
+            {"$set": {"is_active": False, "expired_at": stamp, "updated_at": stamp}}
+        )
+        expired += result.modified_count
+        for patient_id in {m["patient_id"] for m in batch}:
+            medical_summary_cache.invalidate(patient_id)
+        
+        if len(batch) < MEDICATION_EXPIRY_BATCH_SIZE:
+            break
+    
+    if expired:
+        logger.info(f"Expired {expired} medications past their end date")
+    return expired
+
+async def medication_expiry_loop():
+    while True:
+        try:
+            await expire_medications()
+        except Exception as e:
+            logger.error(f"Medication expiry failed: {e}")
+        await asyncio.sleep(MEDICATION_EXPIRY_INTERVAL_SECONDS)
+
+@api_router.get("/medications/expired", response_model=ExpiredMedicationsDelta)
+async def get_expired_medications(
+    since: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = 1000,
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
+):
+    """Medications deactivated by the expiry job after `since` (or after the cursor), oldest first"""
+    limit = max(1, min(limit, 5000))
+    
+    if cursor:
+        position = decode_cursor(cursor)
+        try:
+            after = (datetime.fromisoformat(position["expired_at"]), position["id"])
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    elif since:
+        if since.tzinfo:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        after = (since, "")
+    else:
+        raise HTTPException(status_code=400, detail="Either since or cursor is required")
+    
+    # One batch stamps many medications with the same expired_at, so page on (expired_at, id)
+    items = await db.medications.find(
+        {"$or": [
+            {"expired_at": {"$gt": after[0]}},
+            {"expired_at": after[0], "id": {"$gt": after[1]}}
+        ]},
+        {"_id": 0, "id": 1, "patient_id": 1, "expired_at": 1}
+    ).sort([("expired_at", 1), ("id", 1)]).limit(limit).to_list(limit)
+    
+    if items:
+        after = (items[-1]["expired_at"], items[-1]["id"])
+    return ExpiredMedicationsDelta(
+        items=[ExpiredMedication(**m) for m in items],
+        cursor=encode_cursor({"expired_at": after[0], "id": after[1]})
+    )
 
 @api_router.get("/medications/{patient_id}", response_model=List[MedicationWithDetails])
 async def get_patient_medications(
@@ -2291,6 +4062,7 @@ async def create_allergy(
 ):
     allergy_obj = Allergy(**allergy.dict())
     await db.allergies.insert_one(allergy_obj.dict())
+    medical_summary_cache.invalidate(allergy_obj.patient_id)
     return allergy_obj
 
 @api_router.get("/allergies/{patient_id}", response_model=List[Allergy])
@@ -2320,136 +4092,506 @@ async def get_patient_medical_summary(
     if current_user.role == UserRole.PATIENT and current_user.patient_id != patient_id:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    # Get patient
-    patient = await db.patients.find_one({"id": patient_id})
-    if not patient:
-        raise HTTPException(status_code=404, detail="Patient not found")
-    
-    # Get medical record
-    medical_record = await db.medical_records.find_one({"patient_id": patient_id})
-    
-    # Get active diagnoses (last 5)
-    diagnoses_pipeline = [
-        {"$match": {"patient_id": patient_id, "is_active": True}},
-        {
-            "$lookup": {
-                "from": "doctors",
-                "localField": "doctor_id",
-                "foreignField": "id",
-                "as": "doctor"
-            }
-        },
-        {"$unwind": "$doctor"},
-        {
-            "$project": {
-                "_id": 0,
-                "id": 1,
-                "patient_id": 1,
-                "doctor_id": 1,
-                "diagnosis_code": 1,
-                "diagnosis_name": 1,
-                "description": 1,
-                "diagnosed_date": 1,
-                "is_active": 1,
-                "created_at": 1,
-                "updated_at": 1,
-                "doctor_name": "$doctor.full_name",
-                "patient_name": patient["full_name"]
-            }
-        },
-        {"$sort": {"diagnosed_date": -1}},
-        {"$limit": 5}
-    ]
-    
-    diagnoses = await db.diagnoses.aggregate(diagnoses_pipeline).to_list(5)
+    cached = medical_summary_cache.get(patient_id)
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+    version = medical_summary_cache.version()
+    
+    def section(name, collection, match, sort=None, limit=None, with_doctor=False):
+        stages = [{"$match": match}]
+        if sort:
+            stages.append({"$sort": sort})
+        if with_doctor:
+            # Records of a missing doctor are dropped before the limit, so sections stay full
+            stages += [
+                {"$lookup": {
+                    "from": "doctors",
+                    "localField": "doctor_id",
+                    "foreignField": "id",
+                    "as": "doctor"
+                }},
+                {"$match": {"doctor": {"$ne": []}}}
+            ]
+        if limit:
+            stages.append({"$limit": limit})
+        stages.append({"$addFields": {"_section": name}})
+        return {"$unionWith": {"coll": collection, "pipeline": stages}}
     
-    # Get active medications (last 5)
-    medications_pipeline = [
-        {"$match": {"patient_id": patient_id, "is_active": True}},
-        {
-            "$lookup": {
-                "from": "doctors",
-                "localField": "doctor_id",
-                "foreignField": "id",
-                "as": "doctor"
-            }
-        },
-        {"$unwind": "$doctor"},
-        {
-            "$project": {
-                "_id": 0,
-                "id": 1,
-                "patient_id": 1,
-                "doctor_id": 1,
-                "medication_name": 1,
-                "dosage": 1,
-                "frequency": 1,
-                "start_date": 1,
-                "end_date": 1,
-                "instructions": 1,
-                "is_active": 1,
-                "created_at": 1,
-                "updated_at": 1,
-                "doctor_name": "$doctor.full_name",
-                "patient_name": patient["full_name"]
-            }
-        },
-        {"$sort": {"start_date": -1}},
-        {"$limit": 5}
+    # The whole chart in one round trip: every section is unioned onto the patient document
+    pipeline = [
+        {"$match": {"id": patient_id}},
+        {"$limit": 1},
+        {"$addFields": {"_section": "patient"}},
+        section("medical_record", "medical_records", {"patient_id": patient_id}, limit=1),
+        section("diagnoses", "diagnoses", {"patient_id": patient_id, "is_active": True}, {"diagnosed_date": -1}, 5, True),
+        section("medications", "medications", {"patient_id": patient_id, "is_active": True}, {"start_date": -1}, 5, True),
+        section("allergies", "allergies", {"patient_id": patient_id, "is_active": True}),
+        section("entries", "medical_entries", {"patient_id": patient_id}, {"date": -1}, 10, True),
+        {"$project": {"_id": 0, "doctor._id": 0}}
     ]
     
-    medications = await db.medications.aggregate(medications_pipeline).to_list(5)
+    sections = {"patient": [], "medical_record": [], "diagnoses": [], "medications": [], "allergies": [], "entries": []}
+    async for document in db.patients.aggregate(pipeline):
+        sections[document.pop("_section")].append(document)
     
-    # Get allergies
-    allergies = await db.allergies.find({"patient_id": patient_id, "is_active": True}).to_list(1000)
+    if not sections["patient"]:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    patient = sections["patient"][0]
     
-    # Get recent medical entries (last 10)
-    entries_pipeline = [
-        {"$match": {"patient_id": patient_id}},
-        {
-            "$lookup": {
-                "from": "doctors",
-                "localField": "doctor_id",
-                "foreignField": "id",
-                "as": "doctor"
-            }
-        },
-        {"$unwind": "$doctor"},
-        {
-            "$project": {
-                "_id": 0,
-                "id": 1,
-                "patient_id": 1,
-                "doctor_id": 1,
-                "appointment_id": 1,
-                "entry_type": 1,
-                "title": 1,
-                "description": 1,
-                "severity": 1,
-                "date": 1,
-                "is_active": 1,
-                "created_at": 1,
-                "updated_at": 1,
-                "doctor_name": "$doctor.full_name",
-                "patient_name": patient["full_name"]
-            }
-        },
-        {"$sort": {"date": -1}},
-        {"$limit": 10}
-    ]
+    def with_names(documents):
+        return [
+            {**d, "doctor_name": d["doctor"][0]["full_name"], "patient_name": patient["full_name"]}
+            for d in documents
+        ]
     
-    entries = await db.medical_entries.aggregate(entries_pipeline).to_list(10)
+    medical_record = sections["medical_record"][0] if sections["medical_record"] else None
     
-    return PatientMedicalSummary(
+    summary = PatientMedicalSummary(
         patient=Patient(**patient),
         medical_record=MedicalRecord(**medical_record) if medical_record else None,
-        active_diagnoses=[DiagnosisWithDetails(**d) for d in diagnoses],
-        active_medications=[MedicationWithDetails(**m) for m in medications],
-        allergies=[Allergy(**a) for a in allergies],
-        recent_entries=[MedicalEntryWithDetails(**e) for e in entries]
+        active_diagnoses=[DiagnosisWithDetails(**d) for d in with_names(sections["diagnoses"])],
+        active_medications=[MedicationWithDetails(**m) for m in with_names(sections["medications"])],
+        allergies=[Allergy(**a) for a in sections["allergies"]],
+        recent_entries=[MedicalEntryWithDetails(**e) for e in with_names(sections["entries"])]
+    )
+    payload = json.dumps(jsonable_encoder(summary), ensure_ascii=False).encode()
+    medical_summary_cache.put(patient_id, payload, version)
+    return Response(content=payload, media_type="application/json")
+
+@api_router.get("/metrics/medical-summary-cache")
+async def get_medical_summary_cache_metrics(
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN]))
+):
+    return medical_summary_cache.stats()
+
+# Patient timeline
+def timeline_key(value: datetime) -> str:
+    """Sort key shared by all timeline sources; fixed width, so string order is date order"""
+    return value.isoformat(timespec="microseconds")
+
+class TimelineSource:
+    """One collection feeding the timeline, newest first on its (patient_id, date, id) index"""
+
+    def __init__(self, kind, collection, date_field, title_field, status_field=None, fields=()):
+        self.kind = kind
+        self.collection = collection
+        self.date_field = date_field
+        self.title_field = title_field
+        self.status_field = status_field
+        self.fields = fields
+
+    def date_of(self, document) -> datetime:
+        return document[self.date_field]
+
+    def sort(self):
+        return [(self.date_field, -1), ("id", -1)]
+
+    def before(self, key: str, kind: str, record_id: str) -> dict:
+        """Documents after the (key, kind, id) position in the descending timeline order"""
+        date = datetime.fromisoformat(key)
+        if self.kind < kind:
+            return {self.date_field: {"$lte": date}}
+        if self.kind == kind:
+            return {"$or": [{self.date_field: {"$lt": date}}, {self.date_field: date, "id": {"$lt": record_id}}]}
+        return {self.date_field: {"$lt": date}}
+
+    def projection(self):
+        fields = [self.date_field, self.title_field, *self.fields] + ([self.status_field] if self.status_field else [])
+        return {"_id": 0, "id": 1, **{f: 1 for f in fields}}
+
+    def item(self, document) -> dict:
+        status = document.get(self.status_field) if self.status_field else None
+        if isinstance(status, bool):
+            status = "active" if status else "inactive"
+        return {
+            "kind": self.kind,
+            "id": document["id"],
+            "date": self.date_of(document),
+            "title": document.get(self.title_field) or "",
+            "status": status,
+            "details": {f: document[f] for f in self.fields if document.get(f) is not None}
+        }
+
+class AppointmentTimelineSource(TimelineSource):
+    """Appointments keep date and time as "YYYY-MM-DD" and "HH:MM" strings"""
+
+    def date_of(self, document) -> datetime:
+        return datetime.fromisoformat(f"{document['appointment_date']}T{document['appointment_time']}")
+
+    def sort(self):
+        return [("appointment_date", -1), ("appointment_time", -1), ("id", -1)]
+
+    def before(self, key: str, kind: str, record_id: str) -> dict:
+        # Compare the string fields against the position, which may sit between two minutes
+        day, minute, rest = key[:10], key[11:16], key[16:]
+        on_minute = rest == ":00.000000"
+        earlier = [
+            {"appointment_date": {"$lt": day}},
+            {"appointment_date": day, "appointment_time": {"$lt": minute}}
+        ]
+        if not on_minute or self.kind < kind:
+            earlier.append({"appointment_date": day, "appointment_time": minute})
+        elif self.kind == kind:
+            earlier.append({"appointment_date": day, "appointment_time": minute, "id": {"$lt": record_id}})
+        return {"$or": earlier}
+
+TIMELINE_SOURCES = [
+    AppointmentTimelineSource(
+        "appointment", "appointments", "appointment_date", "reason", "status",
+        ("doctor_id", "appointment_time", "end_time", "notes")
+    ),
+    TimelineSource(
+        "medical_entry", "medical_entries", "date", "title", "entry_type",
+        ("doctor_id", "appointment_id", "description", "severity")
+    ),
+    TimelineSource(
+        "diagnosis", "diagnoses", "diagnosed_date", "diagnosis_name", "is_active",
+        ("doctor_id", "diagnosis_code", "description")
+    ),
+    TimelineSource(
+        "medication", "medications", "start_date", "medication_name", "is_active",
+        ("doctor_id", "dosage", "frequency", "end_date")
+    ),
+    TimelineSource(
+        "document", "documents", "created_at", "original_filename", None,
+        ("file_type", "file_size", "description", "uploaded_by_name")
+    ),
+    TimelineSource(
+        "treatment_plan", "treatment_plans", "created_at", "title", "status",
+        ("total_cost", "payment_status", "execution_status", "created_by_name")
+    ),
+]
+
+class _Newest:
+    """Heap entry ordering the newest (key, kind, id) first"""
+    __slots__ = ("position", "source", "item")
+
+    def __init__(self, position, source, item):
+        self.position = position
+        self.source = source
+        self.item = item
+
+    def __lt__(self, other):
+        return self.position > other.position
+
+@api_router.get("/patients/{patient_id}/timeline", response_model=TimelinePage)
+async def get_patient_timeline(
+    patient_id: str,
+    cursor: Optional[str] = None,
+    limit: int = 50,
+    current_user: UserInDB = Depends(get_current_active_user)
+):
+    """Newest-first history of a patient across all clinical collections"""
+    if current_user.role == UserRole.PATIENT and current_user.patient_id != patient_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    limit = max(1, min(limit, 200))
+    
+    if not await db.patients.find_one({"id": patient_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Patient not found")
+    
+    after = None
+    if cursor:
+        position = decode_cursor(cursor)
+        try:
+            after = (timeline_key(datetime.fromisoformat(position["date"])), position["kind"], position["id"])
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    # Each source is a lazy cursor over its index, capped at one page past the position
+    cursors = []
+    for source in TIMELINE_SOURCES:
+        query = {"patient_id": patient_id}
+        if after:
+            query.update(source.before(*after))
+        cursors.append(
+            db[source.collection].find(query, source.projection())
+            .sort(source.sort()).limit(limit + 1).batch_size(limit + 1)
+        )
+    
+    async def push(heap, index):
+        try:
+            document = await cursors[index].next()
+        except StopAsyncIteration:
+            return
+        item = TIMELINE_SOURCES[index].item(document)
+        heapq.heappush(heap, _Newest((timeline_key(item["date"]), item["kind"], item["id"]), index, item))
+    
+    heap = []
+    await asyncio.gather(*[push(heap, index) for index in range(len(cursors))])
+    
+    items = []
+    while heap and len(items) <= limit:
+        newest = heapq.heappop(heap)
+        items.append(newest.item)
+        await push(heap, newest.source)
+    
+    for c in cursors:
+        await c.close()
+    
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_cursor({"date": last["date"], "kind": last["kind"], "id": last["id"]})
+    return TimelinePage(items=[TimelineItem(**item) for item in items], next_cursor=next_cursor)
+
+# Visit endpoints
+@api_router.post("/visits/{appointment_id}/complete", response_model=VisitCompleteResult)
+async def complete_visit(
+    appointment_id: str,
+    visit: VisitComplete,
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
+):
+    """Record the visit note, diagnoses and prescriptions and close the appointment in one transaction"""
+    appointment = await db.appointments.find_one({"id": appointment_id}, {"_id": 0})
+    if not appointment:
+        raise HTTPException(status_code=404, detail="Appointment not found")
+    if current_user.role == UserRole.DOCTOR and current_user.doctor_id != appointment["doctor_id"]:
+        raise HTTPException(status_code=403, detail="Access denied")
+    if visit.status != AppointmentStatus.COMPLETED:
+        # Any other status would leave the appointment open, and a retry would write the records again
+        raise HTTPException(status_code=422, detail="A visit can only be completed with status completed")
+    closed_statuses = [AppointmentStatus.COMPLETED.value, AppointmentStatus.CANCELLED.value, AppointmentStatus.NO_SHOW.value]
+    if appointment["status"] in closed_statuses:
+        raise HTTPException(status_code=409, detail=f"Appointment is already {appointment['status']}")
+    
+    # Everything is attributed to the appointment's doctor
+    patient_id = appointment["patient_id"]
+    owner = {"patient_id": patient_id, "doctor_id": appointment["doctor_id"]}
+    entry = MedicalEntry(**visit.entry.dict(), **owner, appointment_id=appointment_id) if visit.entry else None
+    diagnoses = [
+        Diagnosis(**{
+            **d.dict(),
+            "diagnosis_code": validate_icd10_code(d.diagnosis_code) if d.diagnosis_code else None
+        }, **owner)
+        for d in visit.diagnoses
+    ]
+    medications = [Medication(**m.dict(), **owner) for m in visit.medications]
+    now = datetime.utcnow()
+    completed = {**appointment, "status": visit.status.value, "updated_at": now}
+    
+    async def write_visit(session):
+        # Closing the appointment comes first and only succeeds once, so a retried
+        # or concurrent completion aborts before inserting its records a second time
+        closed = await db.appointments.update_one(
+            {"id": appointment_id, "status": {"$nin": closed_statuses}},
+            {"$set": {"status": visit.status.value, "updated_at": now}},
+            session=session
+        )
+        if closed.matched_count == 0:
+            raise HTTPException(status_code=409, detail="Appointment is already closed")
+        try:
+            if entry:
+                await db.medical_entries.insert_one(entry.dict(), session=session)
+            if diagnoses:
+                await db.diagnoses.insert_many([d.dict() for d in diagnoses], session=session)
+            if medications:
+                await db.medications.insert_many([m.dict() for m in medications], session=session)
+            await revision_writer.record("appointments", appointment, completed, current_user.id, session=session)
+        except Exception:
+            if session is not None and session.in_transaction:
+                raise
+            # Standalone mongod runs without a transaction: undo by hand so the
+            # visit is either fully recorded or the appointment stays open
+            if entry:
+                await db.medical_entries.delete_one({"id": entry.id}, session=session)
+            await db.diagnoses.delete_many({"id": {"$in": [d.id for d in diagnoses]}}, session=session)
+            await db.medications.delete_many({"id": {"$in": [m.id for m in medications]}}, session=session)
+            await db.appointments.update_one(
+                {"id": appointment_id, "status": visit.status.value, "updated_at": now},
+                {"$set": {"status": appointment["status"], "updated_at": appointment.get("updated_at", now)}},
+                session=session
+            )
+            raise
+    
+    try:
+        await run_in_transaction(write_visit)
+    except (BulkWriteError, OperationFailure) as e:
+        logger.error(f"Completing visit {appointment_id} failed: {e}")
+        raise HTTPException(status_code=500, detail="Failed to save the visit")
+    medical_summary_cache.invalidate(patient_id)
+    
+    allergy_warnings = []
+    if medications:
+        allergies = await db.allergies.find(
+            {"patient_id": patient_id, "is_active": True},
+            {"_id": 0, "id": 1, "allergen": 1, "reaction": 1, "severity": 1}
+        ).to_list(None)
+        for medication in medications:
+            allergy_warnings += check_medication_allergies(medication.medication_name, allergies)
+    
+    return VisitCompleteResult(
+        appointment=Appointment(**completed),
+        entry=entry,
+        diagnoses=diagnoses,
+        medications=medications,
+        allergy_warnings=allergy_warnings
     )
 
 # Document endpoints
+class UploadTooLarge(Exception):
+    pass
+
+UPLOAD_BODY_MAX_BYTES = UPLOAD_MAX_BYTES + UPLOAD_CHUNK_BYTES  # the file plus the rest of the form
+UPLOAD_ROUTE = re.compile(r"^/api/patients/[^/]+/documents$")
+
+class UploadSizeLimitMiddleware:
+    """Caps the request body of document uploads while it is received.
+
+    FastAPI parses (and spools) the whole multipart form before the endpoint
+    runs, so the limit has to sit on the ASGI receive stream: a declared
+    Content-Length over the limit is refused before reading, and a body that
+    grows past it stops with 413 as soon as it does.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or not UPLOAD_ROUTE.match(scope["path"]):
+            return await self.app(scope, receive, send)
+        
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > UPLOAD_BODY_MAX_BYTES:
+            response = JSONResponse({"detail": "File is too large"}, status_code=413)
+            return await response(scope, receive, send)
+        
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > UPLOAD_BODY_MAX_BYTES:
+                    # FastAPI re-raises HTTPExceptions coming out of body parsing
+                    raise HTTPException(status_code=413, detail="File is too large")
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+async def save_upload(file: UploadFile, destination: Path):
+    """Copy an upload to disk chunk by chunk, hashing as it goes.
+
+    Reads and writes run in worker threads, so the event loop stays free for
+    other requests. Returns (size, sha256 hex digest); raises UploadTooLarge
+    and removes the partial file once UPLOAD_MAX_BYTES is exceeded.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    out = await asyncio.to_thread(open, destination, "wb")
+    
+    def write_chunk(chunk):
+        # hashlib releases the GIL on large buffers, so hashing runs in parallel too
+        digest.update(chunk)
+        out.write(chunk)
+    
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > UPLOAD_MAX_BYTES:
+                raise UploadTooLarge()
+            await asyncio.to_thread(write_chunk, chunk)
+    except BaseException:
+        await asyncio.to_thread(out.close)
+        destination.unlink(missing_ok=True)
+        raise
+    await asyncio.to_thread(out.close)
+    return size, digest.hexdigest()
+
+async def store_blob(temp_path: Path, sha256: str, size: int, extension: str, content_type: Optional[str] = None) -> str:
+    """Move an uploaded file into content-addressed storage and take a reference to it.
+
+    Identical content is stored once, as <sha256><ext> of its first upload;
+    later copies only bump the blob's refcount. Returns the blob filename, the
+    document's storage_key; it is never used in URLs, where a content hash
+    would tell anyone whether a given file is on the server.
+    A blob whose last reference is being released is marked as deleting
+    until its file is gone; taking a reference waits for that to finish,
+    and the first reference always writes the content, so it never ends up
+    pointing at a file that release_blob is about to remove.
+    """
+    for attempt in itertools.count(1):
+        try:
+            blob = await db.blobs.find_one_and_update(
+                {"id": sha256, "deleting": {"$ne": True}},
+                {
+                    "$inc": {"refcount": 1},
+                    "$setOnInsert": {"filename": f"{sha256}{extension.lower()}", "size": size, "created_at": datetime.utcnow()}
+                },
+                projection={"_id": 0},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            break
+        except DuplicateKeyError:
+            if attempt < BLOB_DELETE_WAIT_ATTEMPTS:
+                await asyncio.sleep(0.05)
+                continue
+            # A release that died before removing the row: take the blob over and write it again
+            blob = await db.blobs.find_one_and_update(
+                {"id": sha256},
+                {"$inc": {"refcount": 1}, "$unset": {"deleting": ""}},
+                projection={"_id": 0},
+                return_document=ReturnDocument.AFTER
+            )
+            break
+    try:
+        if blob["refcount"] > 1 and await asyncio.to_thread(storage.exists, blob["filename"]):
+            await asyncio.to_thread(temp_path.unlink)
+        else:
+            await asyncio.to_thread(storage.save, blob["filename"], temp_path, content_type)
+    except BaseException:
+        # Give the reference back, so a failed write leaves neither a count nor a file behind
+        await release_blob({"sha256": sha256, "storage_key": blob["filename"]})
+        temp_path.unlink(missing_ok=True)
+        raise
+    return blob["filename"]
+
+def stored_name(document: dict) -> str:
+    """Name of a document's file in storage"""
+    return document.get("storage_key") or document["filename"]
+
+def schedule_thumbnail(filename: str):
+    """Queue thumbnail generation of a stored file without waiting for it"""
+    if can_thumbnail(Path(filename)):
+        thumbnail_executor.submit(storage.make_thumbnail, filename)
+
+async def release_blob(document: dict):
+    """Drop a document's reference to its file, deleting the file with the last reference"""
+    blob = None
+    if document.get("sha256"):
+        blob = await db.blobs.find_one_and_update(
+            {"id": document["sha256"], "filename": stored_name(document)},
+            {"$inc": {"refcount": -1}},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+    if blob is None:
+        # Stored before deduplication: the file belongs to this document alone
+        filename = stored_name(document)
+    elif blob["refcount"] <= 0:
+        # Keep the row, marked, until the file is gone, so store_blob cannot reuse it meanwhile
+        claimed = await db.blobs.update_one(
+            {"id": blob["id"], "refcount": {"$lte": 0}, "deleting": {"$ne": True}},
+            {"$set": {"deleting": True}}
+        )
+        if not claimed.modified_count:
+            return
+        try:
+            await asyncio.to_thread(storage.delete, blob["filename"])
+            await asyncio.to_thread(storage.delete, blob["filename"] + THUMBNAIL_SUFFIX)
+        finally:
+            await db.blobs.delete_one({"id": blob["id"], "deleting": True})
+        return
+    else:
+        return
+    await asyncio.to_thread(storage.delete, filename)
+    await asyncio.to_thread(storage.delete, filename + THUMBNAIL_SUFFIX)
+
 @api_router.post("/patients/{patient_id}/documents", response_model=Document)
 async def upload_document(
     patient_id: str,
@@ -2457,7 +4599,7 @@ async def upload_document(
     description: Optional[str] = Form(None),
     current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
 ):
-    """Upload a document for a patient"""
+    """Upload a document for a patient; UploadSizeLimitMiddleware caps the body"""
     # Check if patient exists
     patient = await db.patients.find_one({"id": patient_id})
     if not patient:
@@ -2465,57 +4607,462 @@ async def upload_document(
     
     # Generate unique filename
     file_extension = os.path.splitext(file.filename)[1]
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
-    file_path = UPLOAD_DIR / unique_filename
+    temp_path = UPLOAD_DIR / f".{uuid.uuid4()}.upload"
     
     try:
-        # Save file
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
+        file_size, sha256 = await save_upload(file, temp_path)
+    except UploadTooLarge:
+        raise HTTPException(
+            status_code=413, detail=f"File is too large, the limit is {UPLOAD_MAX_BYTES // (1024 * 1024)} MB"
+        )
+    
+    storage_key = await store_blob(temp_path, sha256, file_size, file_extension, file.content_type)
+    filename = f"{uuid.uuid4()}{file_extension}"
+    try:
         # Create document record
         document = Document(
             patient_id=patient_id,
-            filename=unique_filename,
+            filename=filename,
             original_filename=file.filename,
-            file_path=str(file_path),
-            file_size=file_path.stat().st_size,
+            file_path=storage.location(storage_key),
+            file_size=file_size,
             file_type=file.content_type or "application/octet-stream",
             uploaded_by=current_user.id,
             uploaded_by_name=current_user.full_name,
-            description=description
+            description=description,
+            sha256=sha256,
+            storage_key=storage_key
         )
         
         # Insert to database
         await db.documents.insert_one(document.dict())
+        schedule_thumbnail(storage_key)
         
         logger.info(f"Document uploaded: {file.filename} for patient {patient_id}")
         return document
         
     except Exception as e:
-        # Clean up file if database insert fails
-        if file_path.exists():
-            file_path.unlink()
+        # Give back the blob reference if database insert fails
+        await release_blob({"sha256": sha256, "storage_key": storage_key})
         logger.error(f"Error uploading document: {e}")
         raise HTTPException(status_code=500, detail="Error uploading document")
 
-@api_router.get("/patients/{patient_id}/documents", response_model=List[Document])
+# Resumable upload sessions
+async def get_upload_session(session_id: str, current_user: UserInDB) -> dict:
+    session = await db.upload_sessions.find_one({"id": session_id}, {"_id": 0})
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    if current_user.role != UserRole.ADMIN and session["created_by"] != current_user.id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    return session
+
+def assemble_parts(parts: List[Path], destination: Path):
+    """Concatenate part files in kernel space and hash the result; runs in a worker thread"""
+    with open(destination, "wb") as out:
+        for part in parts:
+            out.flush()
+            with open(part, "rb") as src:
+                remaining = os.fstat(src.fileno()).st_size
+                try:
+                    while remaining:
+                        copied = os.copy_file_range(src.fileno(), out.fileno(), remaining)
+                        if not copied:
+                            break
+                        remaining -= copied
+                except (AttributeError, OSError):
+                    # copy_file_range is Linux-only and not supported by every filesystem
+                    shutil.copyfileobj(src, out, UPLOAD_CHUNK_BYTES)
+    
+    digest = hashlib.sha256()
+    with open(destination, "rb") as f:
+        while chunk := f.read(UPLOAD_CHUNK_BYTES):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@api_router.post("/patients/{patient_id}/upload-sessions", response_model=UploadSession)
+async def create_upload_session(
+    patient_id: str,
+    session_data: UploadSessionCreate,
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
+):
+    """Start a resumable upload; chunks are then PUT at their offsets and the session finalized"""
+    if not await db.patients.find_one({"id": patient_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Patient not found")
+    if session_data.total_size <= 0:
+        raise HTTPException(status_code=400, detail="total_size must be positive")
+    if session_data.total_size > UPLOAD_SESSION_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="File is too large")
+    
+    session = UploadSession(
+        patient_id=patient_id,
+        original_filename=session_data.filename,
+        file_type=session_data.file_type or "application/octet-stream",
+        total_size=session_data.total_size,
+        description=session_data.description,
+        created_by=current_user.id
+    )
+    await db.upload_sessions.insert_one(session.dict())
+    (UPLOAD_SESSIONS_DIR / session.id).mkdir()
+    return session
+
+@api_router.get("/upload-sessions/{session_id}", response_model=UploadSession)
+async def get_upload_session_status(
+    session_id: str,
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
+):
+    """Received parts, so an interrupted client knows which offsets to resend"""
+    return UploadSession(**await get_upload_session(session_id, current_user))
+
+@api_router.put("/upload-sessions/{session_id}/chunks", response_model=UploadSession)
+async def upload_session_chunk(
+    session_id: str,
+    offset: int,
+    request: Request,
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
+):
+    """Store the raw request body as the part starting at offset; resending a part replaces it"""
+    session = await get_upload_session(session_id, current_user)
+    if session["status"] != UploadSessionStatus.OPEN.value:
+        raise HTTPException(status_code=409, detail="Upload session is already finalized")
+    if offset < 0 or offset >= session["total_size"]:
+        raise HTTPException(status_code=400, detail="Offset is outside the file")
+    limit = min(UPLOAD_SESSION_MAX_CHUNK_BYTES, session["total_size"] - offset)
+    
+    # Written under a temporary name of its own, so a dropped connection never leaves a truncated
+    # part and concurrent resends of the same offset never write into one file; the last to finish wins
+    part_path = UPLOAD_SESSIONS_DIR / session_id / f"{offset:016d}.part"
+    temp_path = part_path.with_name(f"{offset:016d}.{uuid.uuid4().hex}.tmp")
+    size = 0
+    out = await asyncio.to_thread(open, temp_path, "wb")
+    try:
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > limit:
+                raise HTTPException(status_code=413, detail="Chunk exceeds the file size or the chunk limit")
+            await asyncio.to_thread(out.write, chunk)
+    except BaseException:
+        await asyncio.to_thread(out.close)
+        temp_path.unlink(missing_ok=True)
+        raise
+    await asyncio.to_thread(out.close)
+    if not size:
+        temp_path.unlink()
+        raise HTTPException(status_code=400, detail="Empty chunk")
+    await asyncio.to_thread(os.replace, temp_path, part_path)
+    
+    previous = session["parts"].get(str(offset), 0)
+    updated = await db.upload_sessions.find_one_and_update(
+        {"id": session_id, "status": UploadSessionStatus.OPEN.value},
+        {
+            "$set": {
+                f"parts.{offset}": size,
+                "expires_at": datetime.utcnow() + timedelta(hours=UPLOAD_SESSION_TTL_HOURS)
+            },
+            "$inc": {"bytes_received": size - previous}
+        },
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not updated:
+        raise HTTPException(status_code=409, detail="Upload session is already finalized")
+    return UploadSession(**updated)
+
+@api_router.post("/upload-sessions/{session_id}/finalize", response_model=Document)
+async def finalize_upload_session(
+    session_id: str,
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
+):
+    """Assemble the parts into the final file and create the document record"""
+    session = await get_upload_session(session_id, current_user)
+    
+    # Parts must tile the file exactly: a chain from 0 where each part starts
+    # where the previous ended, and no part off that chain (overlapping ones would be assembled too)
+    offsets = []
+    position = 0
+    while str(position) in session["parts"] and position < session["total_size"]:
+        offsets.append(position)
+        position += session["parts"][str(position)]
+    if position != session["total_size"]:
+        raise HTTPException(status_code=400, detail=f"Upload is incomplete, next expected offset is {position}")
+    stray = sorted(set(int(offset) for offset in session["parts"]) - set(offsets))
+    if stray:
+        raise HTTPException(
+            status_code=400, detail=f"Parts at offsets {stray} overlap the rest, cancel and upload again"
+        )
+    
+    # Claim the session so concurrent finalize calls cannot assemble it twice
+    claimed = await db.upload_sessions.find_one_and_update(
+        {"id": session_id, "status": UploadSessionStatus.OPEN.value, "parts": session["parts"]},
+        {"$set": {"status": UploadSessionStatus.FINALIZING.value}}
+    )
+    if not claimed:
+        raise HTTPException(status_code=409, detail="Upload session changed or is already being finalized")
+    
+    session_dir = UPLOAD_SESSIONS_DIR / session_id
+    file_extension = os.path.splitext(session["original_filename"])[1]
+    # Assembled next to the uploads directory, so moving it into storage is a rename
+    temp_path = UPLOAD_DIR / f".{session_id}.upload"
+    storage_key = None
+    
+    try:
+        sha256 = await asyncio.to_thread(
+            assemble_parts, [session_dir / f"{offset:016d}.part" for offset in offsets], temp_path
+        )
+        storage_key = await store_blob(temp_path, sha256, session["total_size"], file_extension, session["file_type"])
+        document = Document(
+            patient_id=session["patient_id"],
+            filename=f"{uuid.uuid4()}{file_extension}",
+            original_filename=session["original_filename"],
+            file_path=storage.location(storage_key),
+            file_size=session["total_size"],
+            file_type=session["file_type"],
+            uploaded_by=current_user.id,
+            uploaded_by_name=current_user.full_name,
+            description=session["description"],
+            sha256=sha256,
+            storage_key=storage_key
+        )
+        await db.documents.insert_one(document.dict())
+        schedule_thumbnail(storage_key)
+    except Exception as e:
+        if storage_key:
+            await release_blob({"sha256": sha256, "storage_key": storage_key})
+        temp_path.unlink(missing_ok=True)
+        await db.upload_sessions.update_one(
+            {"id": session_id}, {"$set": {"status": UploadSessionStatus.OPEN.value}}
+        )
+        logger.error(f"Error finalizing upload session {session_id}: {e}")
+        raise HTTPException(status_code=500, detail="Error finalizing upload")
+    
+    await db.upload_sessions.update_one(
+        {"id": session_id},
+        {"$set": {"status": UploadSessionStatus.COMPLETED.value, "document_id": document.id}}
+    )
+    await asyncio.to_thread(shutil.rmtree, session_dir, True)
+    
+    logger.info(f"Document uploaded in {len(offsets)} parts: {document.original_filename} for patient {document.patient_id}")
+    return document
+
+@api_router.delete("/upload-sessions/{session_id}")
+async def abort_upload_session(
+    session_id: str,
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
+):
+    session = await get_upload_session(session_id, current_user)
+    if session["status"] != UploadSessionStatus.OPEN.value:
+        raise HTTPException(status_code=409, detail="Upload session is already finalized")
+    await db.upload_sessions.delete_one({"id": session_id})
+    await asyncio.to_thread(shutil.rmtree, UPLOAD_SESSIONS_DIR / session_id, True)
+    return {"message": "Upload session aborted"}
+
+@api_router.get("/documents/storage-report")
+async def get_document_storage_report(
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN]))
+):
+    """Bytes referenced by documents versus bytes actually stored after deduplication"""
+    documents = await db.documents.aggregate([
+        {"$group": {"_id": None, "count": {"$sum": 1}, "bytes": {"$sum": "$file_size"}}}
+    ]).to_list(1)
+    blobs = await db.blobs.aggregate([
+        {"$group": {
+            "_id": None,
+            "count": {"$sum": 1},
+            "bytes": {"$sum": "$size"},
+            "references": {"$sum": "$refcount"},
+            "saved": {"$sum": {"$multiply": ["$size", {"$subtract": ["$refcount", 1]}]}}
+        }}
+    ]).to_list(1)
+    documents = documents[0] if documents else {"count": 0, "bytes": 0}
+    blobs = blobs[0] if blobs else {"count": 0, "bytes": 0, "references": 0, "saved": 0}
+    
+    # Documents uploaded before deduplication each own their file
+    stored_bytes = documents["bytes"] - blobs["saved"]
+    return {
+        "documents": documents["count"],
+        "document_bytes": documents["bytes"],
+        "blobs": blobs["count"],
+        "blob_references": blobs["references"],
+        "stored_bytes": stored_bytes,
+        "bytes_saved": blobs["saved"],
+        "dedup_ratio": round(documents["bytes"] / stored_bytes, 3) if stored_bytes else None
+    }
+
+DOCUMENT_LIST_PROJECTION = {"_id": 0, **{field: 1 for field in [
+    "id", "patient_id", "filename", "original_filename", "file_size", "file_type",
+    "uploaded_by_name", "description", "created_at"
+]}}
+
+@api_router.get("/patients/{patient_id}/documents", response_model=DocumentsPage)
 async def get_patient_documents(
     patient_id: str,
+    file_type: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 50,
     current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR, UserRole.PATIENT]))
 ):
-    """Get all documents for a patient"""
-    # Check if patient exists
-    patient = await db.patients.find_one({"id": patient_id})
-    if not patient:
+    """Newest-first page of a patient's documents, keyset-paginated on (created_at, id).
+
+    file_type matches exactly, or by major type as in "image/*". date_from and
+    date_to (YYYY-MM-DD, both inclusive) bound the upload date.
+    """
+    # Patients can only access their own documents
+    if current_user.role == UserRole.PATIENT and current_user.patient_id != patient_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    limit = max(1, min(limit, 200))
+    
+    query = {"patient_id": patient_id}
+    if file_type:
+        if file_type.endswith("/*"):
+            query["file_type"] = {"$regex": f"^{re.escape(file_type[:-1])}"}
+        else:
+            query["file_type"] = file_type
+    if date_from or date_to:
+        created = {}
+        try:
+            if date_from:
+                created["$gte"] = datetime.fromisoformat(date_from)
+            if date_to:
+                created["$lt"] = datetime.fromisoformat(date_to) + timedelta(days=1)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Dates must be in YYYY-MM-DD format")
+        query["created_at"] = created
+    if cursor:
+        position = decode_cursor(cursor)
+        try:
+            after_date = datetime.fromisoformat(position["created_at"])
+            after_id = position["id"]
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query["$or"] = [
+            {"created_at": {"$lt": after_date}},
+            {"created_at": after_date, "id": {"$lt": after_id}}
+        ]
+    
+    # Bounded scan of the (patient_id[, file_type], created_at, id) index; one extra row tells if there is a next page
+    documents = await db.documents.find(query, DOCUMENT_LIST_PROJECTION).sort(
+        [("created_at", -1), ("id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    
+    # Only an empty first page needs to tell an unknown patient from one without documents
+    if not documents and not cursor and not await db.patients.find_one({"id": patient_id}, {"_id": 0, "id": 1}):
         raise HTTPException(status_code=404, detail="Patient not found")
     
+    has_more = len(documents) > limit
+    documents = documents[:limit]
+    next_cursor = encode_cursor(
+        {"created_at": documents[-1]["created_at"], "id": documents[-1]["id"]}
+    ) if has_more else None
+    return DocumentsPage(items=[DocumentListItem(**doc) for doc in documents], next_cursor=next_cursor)
+
+class ZipSink(io.RawIOBase):
+    """Write-only, unseekable target for zipfile; the archive is read back in pieces with drain()"""
+    def __init__(self):
+        self.chunks = []
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+EXPORT_MANIFEST_FIELDS = [
+    "archive_name", "included", "id", "original_filename", "file_type", "file_size",
+    "sha256", "description", "uploaded_by_name", "created_at"
+]
+
+CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+def csv_safe(value):
+    """Quote text a spreadsheet would run as a formula (CSV injection) with a leading apostrophe"""
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def export_archive_name(document: dict) -> str:
+    """Name inside the export; the id prefix keeps documents with the same original name apart"""
+    original = re.sub(r'[\\/:*?"<>|\x00-\x1f]', "_", document["original_filename"]).strip(". ") or "document"
+    return f"documents/{document['id'][:8]}-{original}"
+
+async def iter_documents_zip(patient_id: str):
+    """ZIP of a patient's documents, produced while it is sent.
+
+    Files are stored as they are (no recompression) and copied through in
+    storage-sized chunks; sizes and CRCs go into data descriptors, so nothing
+    is buffered beyond one chunk and the archive's central directory.
+    """
+    sink = ZipSink()
+    archive = zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED)
+    query = {"patient_id": patient_id}
+    order = [("created_at", 1), ("id", 1)]
+    missing = set()
+    
+    async for document in db.documents.find(query, {"_id": 0}).sort(order):
+        name = stored_name(document)
+        if name.startswith(".") or await asyncio.to_thread(storage.stat, name) is None:
+            missing.add(document["id"])
+            continue
+        entry = zipfile.ZipInfo(export_archive_name(document), max(document["created_at"], datetime(1980, 1, 1)).timetuple()[:6])
+        entry.compress_type = zipfile.ZIP_STORED
+        entry.file_size = document["file_size"]
+        # The declared size also decides whether the entry needs ZIP64 fields
+        with archive.open(entry, "w") as out:
+            async for chunk in iter_stored_range(name, 0, document["file_size"]):
+                await asyncio.to_thread(out.write, chunk)
+                yield sink.drain()
+        yield sink.drain()
+    
+    # Manifest from a second pass over the rows, so they are never all held at once
+    with archive.open("manifest.csv", "w") as out:
+        text = io.TextIOWrapper(out, encoding="utf-8-sig", newline="")
+        writer = csv.DictWriter(text, EXPORT_MANIFEST_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        async for document in db.documents.find(query, {"_id": 0}).sort(order):
+            row = {
+                **document,
+                "archive_name": export_archive_name(document),
+                "included": "no" if document["id"] in missing else "yes",
+                "created_at": document["created_at"].isoformat()
+            }
+            # File names, descriptions and types come from uploaders
+            writer.writerow({field: csv_safe(row.get(field)) for field in EXPORT_MANIFEST_FIELDS})
+            text.flush()
+            yield sink.drain()
+        text.flush()
+        text.detach()
+    archive.close()
+    yield sink.drain()
+
+@api_router.get("/patients/{patient_id}/documents/export.zip")
+async def export_patient_documents(
+    patient_id: str,
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR, UserRole.PATIENT]))
+):
+    """Download all documents of a patient as one ZIP archive with a manifest.csv"""
     # Patients can only access their own documents
     if current_user.role == UserRole.PATIENT and current_user.patient_id != patient_id:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    documents = await db.documents.find({"patient_id": patient_id}).sort("created_at", -1).to_list(100)
-    return [Document(**doc) for doc in documents]
+    patient = await db.patients.find_one({"id": patient_id}, {"_id": 0, "id": 1})
+    if not patient:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    
+    return StreamingResponse(
+        iter_documents_zip(patient_id),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": f'attachment; filename="patient-{patient_id}-documents.zip"',
+            "Cache-Control": "private, no-store"
+        }
+    )
 
 @api_router.delete("/documents/{document_id}")
 async def delete_document(
@@ -2527,47 +5074,162 @@ async def delete_document(
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
     
-    # Delete file from disk
-    file_path = Path(document["file_path"])
-    if file_path.exists():
-        file_path.unlink()
-    
-    # Delete from database
+    # Delete from database, then the file once no other document shares it
     await db.documents.delete_one({"id": document_id})
+    await release_blob(document)
     
     logger.info(f"Document deleted: {document_id}")
     return {"message": "Document deleted successfully"}
 
+DOCUMENT_CONTENT_TYPES = {
+    '.pdf': 'application/pdf',
+    '.doc': 'application/msword',
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.txt': 'text/plain',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.mp4': 'video/mp4',
+    '.webm': 'video/webm'
+}
+
+def parse_byte_range(header: str, size: int):
+    """(start, end) of a single `bytes=` range, None to serve the whole file, raises ValueError if unsatisfiable"""
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        # Other units and multipart ranges are not supported; a full response is valid
+        return None
+    first, _, last = spec.strip().partition("-")
+    if not first:
+        if not last.isdigit():
+            return None
+        # Suffix range: the last N bytes
+        start, end = max(0, size - int(last)), size - 1
+    elif not first.isdigit() or (last and not last.isdigit()):
+        return None
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    # Nothing of an empty file is satisfiable, nor a suffix of zero bytes or a start past the end
+    if size == 0 or start >= size or end < start:
+        raise ValueError(header)
+    return start, end
+
+async def iter_stored_range(filename: str, start: int, length: int):
+    chunks = storage.read_range(filename, start, length)
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        # Also closes the file or object stream when the client goes away mid-download
+        await asyncio.to_thread(chunks.close)
+
+async def redirect_to_storage(filename: str, download_name: Optional[str], media_type: str):
+    """Redirect to a pre-signed storage URL, or None when the app has to serve the file itself"""
+    url = await asyncio.to_thread(storage.presigned_url, filename, download_name, media_type)
+    if url is None:
+        return None
+    # The URL expires, so the redirect itself must not be cached
+    return RedirectResponse(url, status_code=307, headers={"Cache-Control": "private, no-store"})
+
 @api_router.get("/uploads/{filename}")
-async def download_file(filename: str):
-    """Serve uploaded files through API endpoint (workaround for ingress routing)"""
-    file_path = UPLOAD_DIR / filename
-    
-    if not file_path.exists():
+async def download_file(filename: str, request: Request):
+    """Serve uploaded files through API endpoint (workaround for ingress routing).
+
+    Files are only reachable by the random per-document filename, never by
+    their content-addressed storage key. Stored files never change under
+    their name, so responses are cacheable forever and validated by an ETag
+    built from the content hash. With object storage the client is
+    redirected to a pre-signed URL and the bucket serves the bytes, ranges
+    included.
+    """
+    document = await db.documents.find_one({"filename": filename}, {"_id": 0, "sha256": 1, "storage_key": 1})
+    if not document:
         raise HTTPException(status_code=404, detail="File not found")
+    name = document.get("storage_key") or filename
+    media_type = DOCUMENT_CONTENT_TYPES.get(Path(filename).suffix.lower(), 'application/octet-stream')
+    redirect = await redirect_to_storage(name, filename, media_type)
+    if redirect:
+        return redirect
+    
+    stat = await asyncio.to_thread(storage.stat, name)
+    if stat is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    size, modified = stat
+    
+    sha256 = document.get("sha256")
+    etag = f'"{sha256}"' if sha256 else f'W/"{size:x}-{int(modified.timestamp() * 1_000_000):x}"'
     
-    # Import here to avoid circular imports
-    from fastapi.responses import FileResponse
-    
-    # Determine content type based on file extension
-    content_type_map = {
-        '.pdf': 'application/pdf',
-        '.doc': 'application/msword',
-        '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-        '.txt': 'text/plain',
-        '.jpg': 'image/jpeg',
-        '.jpeg': 'image/jpeg',
-        '.png': 'image/png',
-        '.gif': 'image/gif'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(modified, usegmt=True),
+        "Cache-Control": "private, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes"
     }
     
-    file_extension = file_path.suffix.lower()
-    media_type = content_type_map.get(file_extension, 'application/octet-stream')
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if etag.removeprefix("W/") in tags or "*" in tags:
+            return Response(status_code=304, headers=headers)
+    
+    headers["Content-Disposition"] = f'attachment; filename="{filename}"'
     
-    return FileResponse(
-        path=str(file_path),
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # A stale If-Range (or a weak ETag, which cannot validate ranges) gets the full file
+    if range_header and (not if_range or (if_range == etag and not etag.startswith("W/"))):
+        try:
+            byte_range = parse_byte_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    
+    start, end = byte_range or (0, size - 1)
+    headers["Content-Length"] = str(end - start + 1)
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return StreamingResponse(
+        iter_stored_range(name, start, end - start + 1),
+        status_code=206 if byte_range else 200,
         media_type=media_type,
-        filename=filename
+        headers=headers
+    )
+
+@api_router.get("/uploads/{filename}/thumbnail")
+async def download_thumbnail(filename: str, request: Request):
+    """Small WebP preview of an uploaded image or PDF.
+
+    Reachable the same way as the file itself, by the document's filename.
+    Thumbnails are made after upload (and by `python thumbnails.py` for older
+    files); this route never renders one, so requests cannot queue up work.
+    """
+    if not can_thumbnail(Path(filename)):
+        raise HTTPException(status_code=404, detail="Thumbnail not available")
+    document = await db.documents.find_one({"filename": filename}, {"_id": 0, "storage_key": 1})
+    if not document:
+        raise HTTPException(status_code=404, detail="Thumbnail not available")
+    name = document.get("storage_key") or filename
+    
+    thumbnail = name + THUMBNAIL_SUFFIX
+    stat = await asyncio.to_thread(storage.stat, thumbnail)
+    if stat is None:
+        raise HTTPException(status_code=404, detail="Thumbnail not available")
+    
+    redirect = await redirect_to_storage(thumbnail, None, "image/webp")
+    if redirect:
+        return redirect
+    size, modified = stat
+    etag = f'"{size:x}-{int(modified.timestamp() * 1_000_000):x}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=31536000, immutable"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return StreamingResponse(
+        iter_stored_range(thumbnail, 0, size), media_type="image/webp",
+        headers={**headers, "Content-Length": str(size)}
     )
 
 @api_router.put("/documents/{document_id}", response_model=Document)
@@ -2922,15 +5584,25 @@ async def update_treatment_plan(
     
     # Update treatment plan
     update_dict = update_data.dict(exclude_unset=True)
-    if update_dict:
-        update_dict["updated_at"] = datetime.utcnow()
-        await db.treatment_plans.update_one(
+    if not update_dict:
+        return TreatmentPlan(**treatment_plan)
+    update_dict["updated_at"] = datetime.utcnow()
+    
+    async def apply_update(session):
+        updated = await db.treatment_plans.find_one_and_update(
             {"id": plan_id},
-            {"$set": update_dict}
+            {"$set": update_dict},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER,
+            session=session
         )
+        if not updated:
+            raise HTTPException(status_code=404, detail="Treatment plan not found")
+        await revision_writer.record("treatment_plans", treatment_plan, updated, current_user.id, session=session)
+        return updated
     
     # Return updated treatment plan
-    updated_plan = await db.treatment_plans.find_one({"id": plan_id})
+    updated_plan = await run_in_transaction(apply_update)
     return TreatmentPlan(**updated_plan)
 
 @api_router.delete("/treatment-plans/{plan_id}")
@@ -2949,6 +5621,64 @@ async def delete_treatment_plan(
     logger.info(f"Treatment plan deleted: {plan_id}")
     return {"message": "Treatment plan deleted successfully"}
 
+# Revision history endpoints
+@api_router.get("/revisions/{collection}/{record_id}")
+async def get_record_revisions(
+    collection: str,
+    record_id: str,
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
+):
+    """Change log of a record: changed fields of every revision, oldest first"""
+    if collection not in REVISIONED_COLLECTIONS:
+        raise HTTPException(status_code=404, detail="No revision history for this collection")
+    
+    revisions = await db.revisions.find(
+        {"collection": collection, "record_id": record_id},
+        {"_id": 0, "snapshot": 0}
+    ).sort("version", 1).to_list(None)
+    return jsonable_encoder(revisions)
+
+@api_router.get("/revisions/{collection}/{record_id}/{version}")
+async def get_record_version(
+    collection: str,
+    record_id: str,
+    version: int,
+    current_user: UserInDB = Depends(require_role([UserRole.ADMIN, UserRole.DOCTOR]))
+):
+    """The record as it was after the given revision"""
+    if collection not in REVISIONED_COLLECTIONS:
+        raise HTTPException(status_code=404, detail="No revision history for this collection")
+    
+    # Nearest full snapshot at or before the version, then its diffs replayed forward
+    query = {"collection": collection, "record_id": record_id}
+    base = await db.revisions.find(
+        {**query, "version": {"$lte": version}, "snapshot": {"$exists": True}}, {"_id": 0}
+    ).sort("version", -1).limit(1).to_list(1)
+    if not base:
+        raise HTTPException(status_code=404, detail="Revision not found")
+    base = base[0]
+    
+    document = dict(base["snapshot"])
+    revisions = await db.revisions.find(
+        {**query, "version": {"$gt": base["version"], "$lte": version}},
+        {"_id": 0, "version": 1, "changes": 1, "removed": 1, "created_at": 1, "changed_by": 1}
+    ).sort("version", 1).to_list(None)
+    if (revisions[-1]["version"] if revisions else base["version"]) != version:
+        raise HTTPException(status_code=404, detail="Revision not found")
+    
+    for revision in revisions:
+        document.update(revision["changes"])
+        for field in revision["removed"]:
+            document.pop(field, None)
+    
+    last = revisions[-1] if revisions else base
+    return jsonable_encoder({
+        "version": version,
+        "created_at": last["created_at"],
+        "changed_by": last["changed_by"],
+        "document": document
+    })
+
 # Service endpoints
 @api_router.get("/services", response_model=List[Service])
 async def get_services(
@@ -3028,6 +5758,7 @@ async def initialize_default_services(
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(UploadSizeLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -3043,6 +5774,117 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_indexes():
+    # Slot conflict checks and bulk moves look up (doctor, date, time)
+    await db.appointments.create_index([("doctor_id", 1), ("appointment_date", 1), ("appointment_time", 1)])
+    await db.appointments.create_index("id")
+    # Lookups by id, also the anti-joins of reconcile_orphans.py
+    await db.patients.create_index("id")
+    await db.medical_records.create_index("id")
+    await db.treatment_plans.create_index("id")
+    # Full-text search, Russian stemming
+    await db.medical_entries.create_index(
+        [("title", "text"), ("description", "text")],
+        weights={"title": 3}, default_language="russian", name="medical_entries_text"
+    )
+    await db.diagnoses.create_index(
+        [("diagnosis_name", "text"), ("description", "text")],
+        weights={"diagnosis_name": 3}, default_language="russian", name="diagnoses_text"
+    )
+    await db.appointments.create_index(
+        [("notes", "text"), ("reason", "text")], default_language="russian", name="appointments_text"
+    )
+    await db.patients.create_index([("notes", "text")], default_language="russian", name="patients_text")
+    # Patient timeline: one (patient_id, date, id) index per source
+    await db.appointments.create_index([("patient_id", 1), ("appointment_date", -1), ("appointment_time", -1), ("id", -1)])
+    await db.diagnoses.create_index([("patient_id", 1), ("diagnosed_date", -1), ("id", -1)])
+    await db.medications.create_index([("patient_id", 1), ("start_date", -1), ("id", -1)])
+    await db.documents.create_index([("patient_id", 1), ("created_at", -1), ("id", -1)])
+    await db.treatment_plans.create_index([("patient_id", 1), ("created_at", -1), ("id", -1)])
+    # Medical entries timeline pages
+    await db.medical_entries.create_index([("patient_id", 1), ("date", -1), ("id", -1)])
+    await db.medical_entries.create_index([("patient_id", 1), ("entry_type", 1), ("date", -1), ("id", -1)])
+    # Document list filtered by type
+    await db.documents.create_index([("patient_id", 1), ("file_type", 1), ("created_at", -1), ("id", -1)])
+    # Month overview counts, covered by these indexes
+    await db.appointments.create_index([("appointment_date", 1), ("status", 1)])
+    await db.appointments.create_index([("doctor_id", 1), ("appointment_date", 1), ("status", 1)])
+    # Polling fallback of the appointment change feed
+    await db.appointments.create_index("updated_at")
+    await db.appointment_tombstones.create_index("deleted_at", expireAfterSeconds=24 * 3600)
+    # ICS feed validators
+    await db.appointment_tombstones.create_index([("doctor_id", 1), ("deleted_at", -1)])
+
+@app.on_event("startup")
+async def load_icd10_dictionary():
+    global icd10_dictionary
+    if not ICD10_PATH.exists():
+        logger.warning(f"ICD-10 dictionary not found at {ICD10_PATH}, code search is disabled")
+        return
+    icd10_dictionary = Icd10Dictionary.load(ICD10_PATH)
+    logger.info(f"Loaded {len(icd10_dictionary)} ICD-10 codes")
+    if not ICD10_STRICT:
+        # The bundled data/icd10.tsv is only a seed subset, so unknown codes cannot be rejected by default
+        logger.info("ICD10_STRICT is off: diagnosis codes are only checked for their format")
+
+@app.on_event("startup")
+async def load_allergen_index():
+    global allergen_index
+    await db.allergies.create_index([("patient_id", 1), ("is_active", 1)])
+    if not ALLERGENS_PATH.exists():
+        logger.warning(f"Allergen mapping not found at {ALLERGENS_PATH}, only direct name matches are checked")
+        return
+    allergen_index = AllergenIndex.load(ALLERGENS_PATH)
+    logger.info(f"Loaded {len(allergen_index)} allergen terms")
+
+@app.on_event("startup")
+async def load_waitlist_index():
+    await db.waitlist.create_index([("status", 1), ("created_at", 1)])
+    await db.waitlist_offers.create_index([("status", 1), ("appointment_date", 1)])
+    # Locks left behind by a crash mid-accept free themselves
+    await db.waitlist_slot_locks.create_index("created_at", expireAfterSeconds=60)
+    await db.waitlist.create_index("updated_at")
+    await sync_waitlist_index()
+    await prune_waitlist(datetime.utcnow().strftime("%Y-%m-%d"))
+    logger.info(f"Loaded {len(waitlist_index.entries)} waitlist entries")
+
+@app.on_event("startup")
+async def create_blob_indexes():
+    await db.blobs.create_index("id", unique=True)
+    # Downloads look up documents by their own filename, reconcile_orphans.py by their blob
+    await db.documents.create_index("filename")
+    await db.documents.create_index("storage_key", sparse=True)
+
+@app.on_event("startup")
+async def create_upload_session_indexes():
+    # Abandoned sessions disappear from Mongo; reconcile_orphans.py removes their part directories
+    await db.upload_sessions.create_index("expires_at", expireAfterSeconds=0)
+    await db.upload_sessions.create_index("id")
+
+@app.on_event("startup")
+async def start_revision_writer():
+    await db.revisions.create_index([("collection", 1), ("record_id", 1), ("version", 1)], unique=True)
+    await db.revisions.create_index("change_id")
+    await db.revision_outbox.create_index([("claimed_by", 1), ("created_at", 1)])
+    await db.revision_outbox.create_index("claimed_until")
+    revision_writer.start()
+
+@app.on_event("startup")
+async def start_medication_expiry():
+    global medication_expiry_task
+    await db.medications.create_index([("is_active", 1), ("end_date", 1)])
+    await db.medications.create_index(
+        [("expired_at", 1), ("id", 1)],
+        partialFilterExpression={"expired_at": {"$exists": True}}
+    )
+    medication_expiry_task = asyncio.create_task(medication_expiry_loop())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    if medication_expiry_task:
+        medication_expiry_task.cancel()
+    # Pending revisions must reach the database before the client closes
+    await revision_writer.stop()
+    thumbnail_executor.shutdown(wait=False, cancel_futures=True)
     client.close()
\ No newline at end of file
@@ -0,0 +1,228 @@
+"""Where uploaded documents live: the local uploads directory or an S3-compatible bucket.
+
+Both backends store files under their flat name (the content hash plus
+extension); the server only ever talks to the StorageBackend interface.
+Methods block, so the server calls them from worker threads.
+
+Locally, files are fanned out into two directory levels taken from the start
+of their name (ab/cd/abcd...), which keeps every directory small. Files
+stored before the sharded layout stay directly under the uploads root until
+migrate_uploads.py moves them.
+
+Switching an existing installation to STORAGE_BACKEND=s3 needs its local
+files copied into the bucket first (migrate_uploads.py --to-storage); S3
+storage does not look at the uploads directory.
+
+S3 storage works with AWS and with S3-compatible servers (MinIO, moto's
+server mode) through S3_ENDPOINT_URL. Downloads are handed to the bucket via
+pre-signed URLs, so file bytes do not pass through the app process.
+"""
+import os
+import tempfile
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+from thumbnails import THUMBNAIL_SUFFIX, generate_thumbnail
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.exceptions import ClientError
+except ImportError:  # Only needed for STORAGE_BACKEND=s3
+    boto3 = None
+
+CHUNK_BYTES = 1024 * 1024
+
+
+def shard_path(root: Path, filename: str) -> Path:
+    if len(filename) < 5:
+        return root / filename
+    return root / filename[:2] / filename[2:4] / filename
+
+
+def resolve_path(root: Path, filename: str) -> Path:
+    """Sharded location if the file is there, otherwise the flat pre-sharding one"""
+    sharded = shard_path(root, filename)
+    if sharded.exists():
+        return sharded
+    return root / filename
+
+
+class StorageBackend(ABC):
+    @abstractmethod
+    def location(self, name: str) -> str:
+        """Where the file is stored, as recorded on its document"""
+
+    @abstractmethod
+    def save(self, name: str, source: Path, content_type: Optional[str] = None):
+        """Take over a finished local file; the source is gone afterwards"""
+
+    def exists(self, name: str) -> bool:
+        return self.stat(name) is not None
+
+    @abstractmethod
+    def stat(self, name: str) -> Optional[Tuple[int, datetime]]:
+        """(size, last modified) or None if the file does not exist"""
+
+    @abstractmethod
+    def read_range(self, name: str, start: int, length: int) -> Iterator[bytes]:
+        """Up to length bytes from offset start, in chunks"""
+
+    @abstractmethod
+    def delete(self, name: str):
+        """Remove the file; a missing file is not an error"""
+
+    @abstractmethod
+    def names(self) -> Iterator[str]:
+        """Names of all stored files, thumbnails included"""
+
+    def presigned_url(self, name: str, download_name: Optional[str] = None,
+                      content_type: Optional[str] = None) -> Optional[str]:
+        """Time-limited direct download URL, None if files must be served by the app"""
+        return None
+
+    @abstractmethod
+    def make_thumbnail(self, name: str) -> bool:
+        """Store <name>.thumb.webp unless it exists; False if no thumbnail can be made"""
+
+
+class LocalStorage(StorageBackend):
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(exist_ok=True)
+
+    def path(self, name: str) -> Path:
+        return resolve_path(self.root, name)
+
+    def location(self, name: str) -> str:
+        return str(shard_path(self.root, name))
+
+    def save(self, name: str, source: Path, content_type: Optional[str] = None):
+        target = shard_path(self.root, name)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(source, target)
+
+    def stat(self, name: str):
+        path = self.path(name)
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        if not path.is_file():
+            return None
+        return stat.st_size, datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+
+    def read_range(self, name: str, start: int, length: int):
+        with open(self.path(name), "rb") as f:
+            f.seek(start)
+            while length > 0:
+                chunk = f.read(min(CHUNK_BYTES, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+
+    def delete(self, name: str):
+        self.path(name).unlink(missing_ok=True)
+
+    def names(self):
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not filename.startswith("."):
+                    yield filename
+
+    def make_thumbnail(self, name: str) -> bool:
+        path = self.path(name)
+        return path.is_file() and generate_thumbnail(path) is not None
+
+
+class S3Storage(StorageBackend):
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None,
+                 region: Optional[str] = None, url_expires_seconds: int = 300):
+        if boto3 is None:
+            raise RuntimeError("boto3 is required for S3 document storage")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.url_expires_seconds = url_expires_seconds
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        # Files above 8 MB are sent as a multipart upload, parts in parallel
+        self.transfer = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024)
+
+    def key(self, name: str) -> str:
+        return f"{self.prefix}{name}"
+
+    def location(self, name: str) -> str:
+        return f"s3://{self.bucket}/{self.key(name)}"
+
+    def save(self, name: str, source: Path, content_type: Optional[str] = None):
+        extra = {"ContentType": content_type} if content_type else None
+        self.client.upload_file(str(source), self.bucket, self.key(name), ExtraArgs=extra, Config=self.transfer)
+        source.unlink()
+
+    def stat(self, name: str):
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return head["ContentLength"], head["LastModified"]
+
+    def read_range(self, name: str, start: int, length: int):
+        if length <= 0:
+            return
+        response = self.client.get_object(
+            Bucket=self.bucket, Key=self.key(name), Range=f"bytes={start}-{start + length - 1}"
+        )
+        yield from response["Body"].iter_chunks(CHUNK_BYTES)
+
+    def delete(self, name: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def names(self):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get("Contents", []):
+                yield item["Key"][len(self.prefix):]
+
+    def presigned_url(self, name: str, download_name: Optional[str] = None, content_type: Optional[str] = None):
+        params = {"Bucket": self.bucket, "Key": self.key(name)}
+        if download_name:
+            params["ResponseContentDisposition"] = f'attachment; filename="{download_name}"'
+        if content_type:
+            params["ResponseContentType"] = content_type
+        return self.client.generate_presigned_url("get_object", Params=params, ExpiresIn=self.url_expires_seconds)
+
+    def make_thumbnail(self, name: str) -> bool:
+        if self.exists(name + THUMBNAIL_SUFFIX):
+            return True
+        # Thumbnails are rendered from a local copy, then uploaded next to the original
+        with tempfile.TemporaryDirectory() as directory:
+            local = Path(directory) / name
+            try:
+                self.client.download_file(self.bucket, self.key(name), str(local))
+            except ClientError:
+                return False
+            thumbnail = generate_thumbnail(local)
+            if thumbnail is None:
+                return False
+            self.client.upload_file(
+                str(thumbnail), self.bucket, self.key(name + THUMBNAIL_SUFFIX),
+                ExtraArgs={"ContentType": "image/webp"}
+            )
+        return True
+
+
+def storage_from_env(uploads_dir: Path) -> StorageBackend:
+    """The backend selected by STORAGE_BACKEND (local or s3) and the S3_* settings"""
+    if os.environ.get("STORAGE_BACKEND", "local") == "s3":
+        return S3Storage(
+            os.environ["S3_BUCKET"],
+            prefix=os.environ.get("S3_PREFIX", ""),
+            endpoint_url=os.environ.get("S3_ENDPOINT_URL"),
+            region=os.environ.get("S3_REGION"),
+            url_expires_seconds=int(os.environ.get("PRESIGNED_URL_SECONDS", "300"))
+        )
+    return LocalStorage(uploads_dir)
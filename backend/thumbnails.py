@@ -0,0 +1,118 @@
+"""Thumbnails of uploaded documents, stored next to the originals as <name>.thumb.webp.
+
+Images are handled by Pillow; the first page of a PDF is rasterized when
+PyMuPDF is installed. Without Pillow no thumbnails are made at all.
+
+The server only serves thumbnails that exist. Backfill for files uploaded
+before thumbnails existed, in whichever backend STORAGE_BACKEND selects:
+
+    python thumbnails.py [uploads_dir] [--workers N]
+"""
+import argparse
+import io
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional
+    Image = None
+
+try:
+    import fitz  # PyMuPDF, optional
+except ImportError:
+    fitz = None
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZE = (320, 320)
+THUMBNAIL_SUFFIX = ".thumb.webp"
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff"}
+
+
+def thumbnail_path(path: Path) -> Path:
+    return path.with_name(path.name + THUMBNAIL_SUFFIX)
+
+
+def can_thumbnail(path: Path) -> bool:
+    if Image is None or path.name.endswith(THUMBNAIL_SUFFIX) or path.name.startswith("."):
+        return False
+    suffix = path.suffix.lower()
+    return suffix in IMAGE_EXTENSIONS or (suffix == ".pdf" and fitz is not None)
+
+
+def _open_pdf_first_page(path: Path):
+    with fitz.open(path) as pdf:
+        if not pdf.page_count:
+            return None
+        page = pdf[0]
+        # Render just large enough for the thumbnail
+        zoom = max(THUMBNAIL_SIZE) / max(page.rect.width, page.rect.height, 1)
+        pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        return Image.open(io.BytesIO(pixmap.tobytes("png")))
+
+
+def generate_thumbnail(path: Path) -> Optional[Path]:
+    """Write the thumbnail of path unless it exists; returns its path, or None if none can be made"""
+    target = thumbnail_path(path)
+    if target.exists():
+        return target
+    if not can_thumbnail(path):
+        return None
+
+    try:
+        if path.suffix.lower() == ".pdf":
+            image = _open_pdf_first_page(path)
+            if image is None:
+                return None
+        else:
+            image = Image.open(path)
+            # Decode at a reduced size where the format allows it (JPEG)
+            image.draft("RGB", THUMBNAIL_SIZE)
+            image = ImageOps.exif_transpose(image)
+        image.thumbnail(THUMBNAIL_SIZE)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+        # Written under a temporary name so a reader never sees a half-written file
+        temp = target.with_name(f".{target.name}.{uuid.uuid4().hex}.tmp")
+        image.save(temp, "WEBP", quality=80)
+        temp.replace(target)
+        return target
+    except Exception as e:
+        logger.warning(f"Cannot make a thumbnail of {path.name}: {e}")
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate missing thumbnails for uploaded documents")
+    parser.add_argument("uploads_dir", nargs="?", type=Path, default=Path("uploads"))
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    if Image is None:
+        parser.error("Pillow is not installed")
+
+    # storage imports this module
+    from dotenv import load_dotenv
+    from storage import storage_from_env
+
+    load_dotenv(Path(__file__).parent / ".env")
+    storage = storage_from_env(args.uploads_dir)
+    stored = set(storage.names())
+    names = [name for name in stored if can_thumbnail(Path(name))]
+    missing = [name for name in names if name + THUMBNAIL_SUFFIX not in stored]
+    print(f"{len(names)} files can have thumbnails, {len(missing)} missing")
+
+    made = 0
+    with ThreadPoolExecutor(args.workers) as pool:
+        for result in pool.map(storage.make_thumbnail, missing):
+            made += result
+    print(f"Generated {made} thumbnails, {len(missing) - made} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Measure upload throughput and event-loop lag of a running server under concurrent uploads.
+
+Usage: python upload_benchmark.py --url http://localhost:8001 --token <JWT> --patient-id <id>
+                                  [--concurrency 8] [--uploads 16] [--size-mb 50]
+
+While the uploads run, a probe requests the lightweight GET /api/ every 50 ms.
+Its latency is dominated by how long the event loop is blocked, so a handler
+doing synchronous disk I/O shows up as p99/max probe latency in the hundreds
+of milliseconds.
+"""
+import argparse
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def upload(url: str, token: str, patient_id: str, payload: bytes) -> float:
+    started = time.perf_counter()
+    response = requests.post(
+        f"{url}/api/patients/{patient_id}/documents",
+        headers={"Authorization": f"Bearer {token}"},
+        files={"file": ("benchmark.bin", payload, "application/octet-stream")},
+        data={"description": "upload benchmark"},
+    )
+    response.raise_for_status()
+    # Remove the benchmark document again
+    requests.delete(
+        f"{url}/api/documents/{response.json()['id']}", headers={"Authorization": f"Bearer {token}"}
+    )
+    return time.perf_counter() - started
+
+
+def probe(url: str, stop: threading.Event, latencies: list):
+    session = requests.Session()
+    while not stop.is_set():
+        started = time.perf_counter()
+        session.get(f"{url}/api/")
+        latencies.append((time.perf_counter() - started) * 1000)
+        time.sleep(0.05)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--token", required=True)
+    parser.add_argument("--patient-id", required=True)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--uploads", type=int, default=16)
+    parser.add_argument("--size-mb", type=float, default=50)
+    args = parser.parse_args()
+
+    payload = os.urandom(int(args.size_mb * 1024 * 1024))
+
+    idle = []
+    stop = threading.Event()
+    prober = threading.Thread(target=probe, args=(args.url, stop, idle))
+    prober.start()
+    time.sleep(2)
+    stop.set()
+    prober.join()
+
+    loaded = []
+    stop = threading.Event()
+    prober = threading.Thread(target=probe, args=(args.url, stop, loaded))
+    prober.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        durations = list(pool.map(
+            lambda _: upload(args.url, args.token, args.patient_id, payload), range(args.uploads)
+        ))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    prober.join()
+
+    total_mb = args.uploads * args.size_mb
+    print(f"Uploads:      {args.uploads} x {args.size_mb:g} MB, concurrency {args.concurrency}")
+    print(f"Throughput:   {total_mb / elapsed:.1f} MB/s ({elapsed:.1f} s total)")
+    print(f"Per upload:   p50 {statistics.median(durations):.2f} s  max {max(durations):.2f} s")
+    for name, latencies in (("Probe idle", idle), ("Probe loaded", loaded)):
+        print(f"{name + ':':14}p50 {statistics.median(latencies):6.1f} ms  "
+              f"p99 {percentile(latencies, 0.99):6.1f} ms  max {max(latencies):6.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
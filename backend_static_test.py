@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 """
-Test backend static file serving on internal port to verify functionality
+Test backend file serving on internal port to verify functionality.
+
+Uploaded files are only served by GET /api/uploads/{filename}: they are stored
+in sharded directories (or S3), so there is no static /uploads mount.
 """
 
 import requests
@@ -66,8 +69,14 @@ def test_backend_static_serving():
     filename = doc_data['filename']
     print(f"✅ Document uploaded: {filename}")
     
-    # Test static file access on internal port
-    static_response = requests.get(f"{backend_url}/uploads/{filename}")
+    # The old static mount is gone: files are not reachable outside the API
+    legacy_response = requests.get(f"{backend_url}/uploads/{filename}")
+    if legacy_response.status_code != 404:
+        print(f"❌ /uploads/{filename} should be 404, got {legacy_response.status_code}")
+        return False
+    
+    # Test file access on internal port
+    static_response = requests.get(f"{backend_url}/api/uploads/{filename}")
     
     if static_response.status_code == 200:
         if static_response.content == test_content:
@@ -94,13 +103,13 @@ def test_external_routing_issue():
     api_response = requests.get(f"{external_url}/api/")
     print(f"API Access: {api_response.status_code} (Expected: 405 Method Not Allowed)")
     
-    # Test uploads access (currently broken)
-    uploads_response = requests.get(f"{external_url}/uploads/nonexistent.txt")
+    # Test uploads access through the API route
+    uploads_response = requests.get(f"{external_url}/api/uploads/nonexistent.txt")
     print(f"Uploads Access: {uploads_response.status_code}")
     print(f"Content-Type: {uploads_response.headers.get('content-type')}")
     
     if 'text/html' in uploads_response.headers.get('content-type', ''):
-        print("❌ CRITICAL ISSUE: /uploads requests are being served by frontend React app")
+        print("❌ CRITICAL ISSUE: /api/uploads requests are being served by frontend React app")
         print("   This means the Kubernetes ingress is not routing /uploads to backend")
         return False
     else:
@@ -115,11 +124,11 @@ if __name__ == "__main__":
     print("SUMMARY")
     print("=" * 60)
     print(f"Backend Static Serving (Internal): {'✅ WORKING' if backend_works else '❌ BROKEN'}")
-    print(f"External Routing (/uploads):       {'✅ WORKING' if routing_works else '❌ BROKEN'}")
+    print(f"External Routing (/api/uploads):   {'✅ WORKING' if routing_works else '❌ BROKEN'}")
     
     if backend_works and not routing_works:
         print("\n🔧 DIAGNOSIS: Backend static file serving is implemented correctly,")
         print("   but external routing configuration needs to be fixed to route")
-        print("   /uploads requests to the backend instead of the frontend.")
+        print("   /api/uploads requests to the backend instead of the frontend.")
     
     sys.exit(0 if backend_works else 1)
\ No newline at end of file
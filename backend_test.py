@@ -689,19 +689,28 @@ class ClinicAPITester:
             return False, None
 
     def test_get_patient_documents(self, patient_id):
-        """Get all documents for a patient"""
-        success, response = self.run_test(
-            f"Get Documents for Patient {patient_id}",
-            "GET",
-            f"patients/{patient_id}/documents",
-            200
-        )
-        if success and response:
-            print(f"Found {len(response)} documents for patient {patient_id}")
-            if len(response) > 0:
-                doc = response[0]
-                print(f"Sample document: {doc['original_filename']} ({doc['file_type']}, {doc['file_size']} bytes)")
-        return success, response
+        """Get all documents for a patient, following next_cursor through every page"""
+        documents = []
+        params = {}
+        while True:
+            success, response = self.run_test(
+                f"Get Documents for Patient {patient_id}",
+                "GET",
+                f"patients/{patient_id}/documents",
+                200,
+                params=params
+            )
+            if not success or not response:
+                return False, None
+            documents += response["items"]
+            if not response["next_cursor"]:
+                break
+            params = {"cursor": response["next_cursor"]}
+        print(f"Found {len(documents)} documents for patient {patient_id}")
+        if len(documents) > 0:
+            doc = documents[0]
+            print(f"Sample document: {doc['original_filename']} ({doc['file_type']}, {doc['file_size']} bytes)")
+        return True, documents
 
     def test_update_document_description(self, document_id, new_description):
         """Update document description"""
@@ -733,8 +742,8 @@ class ClinicAPITester:
         return success
 
     def test_access_uploaded_file(self, filename):
-        """Test accessing uploaded file via static file serving"""
-        url = f"{self.base_url}/uploads/{filename}"
+        """Test accessing uploaded file via the /api/uploads endpoint"""
+        url = f"{self.base_url}/api/uploads/{filename}"
         headers = {}
         
         # Add authorization token if available (though static files might not need it)
@@ -73,13 +73,13 @@ class DocumentDownloadTester:
     def test_uploads_directory_exists(self):
         """Test that uploads directory is properly configured"""
         # Check if uploads directory exists on the server by trying to access a non-existent file
-        response = requests.get(f"{self.base_url}/uploads/nonexistent-file.pdf")
+        response = requests.get(f"{self.base_url}/api/uploads/nonexistent-file.pdf")
         
-        # We expect 404 for non-existent file, which means the endpoint is mounted
+        # We expect 404 for non-existent file, which means the endpoint is routed
         if response.status_code == 404:
-            return self.log_test("Uploads Directory Mount", True, "/uploads endpoint is properly mounted")
+            return self.log_test("Uploads Endpoint", True, "/api/uploads endpoint is properly routed")
         else:
-            return self.log_test("Uploads Directory Mount", False, f"Unexpected status: {response.status_code}")
+            return self.log_test("Uploads Endpoint", False, f"Unexpected status: {response.status_code}")
     
     def upload_test_documents(self):
         """Upload various document types for testing"""
@@ -127,7 +127,7 @@ class DocumentDownloadTester:
             content_type = file_info['content_type']
             
             # Test direct download
-            response = requests.get(f"{self.base_url}/uploads/{filename}")
+            response = requests.get(f"{self.base_url}/api/uploads/{filename}")
             
             if response.status_code == 200:
                 # Check content
@@ -187,7 +187,7 @@ class DocumentDownloadTester:
             return self.log_test("CORS Headers Test", False, "No uploaded files to test")
         
         filename = self.uploaded_files[0]['filename']
-        response = requests.get(f"{self.base_url}/uploads/{filename}")
+        response = requests.get(f"{self.base_url}/api/uploads/{filename}")
         
         cors_headers = {
             'access-control-allow-origin': response.headers.get('access-control-allow-origin'),
@@ -201,7 +201,7 @@ class DocumentDownloadTester:
     
     def test_file_not_found_error(self):
         """Test 404 error for non-existent files"""
-        response = requests.get(f"{self.base_url}/uploads/nonexistent-file-12345.pdf")
+        response = requests.get(f"{self.base_url}/api/uploads/nonexistent-file-12345.pdf")
         
         return self.log_test("404 Error for Non-existent File", 
                            response.status_code == 404,
@@ -215,7 +215,7 @@ class DocumentDownloadTester:
         filename = self.uploaded_files[0]['filename']
         
         # Make request without Authorization header
-        response = requests.get(f"{self.base_url}/uploads/{filename}")
+        response = requests.get(f"{self.base_url}/api/uploads/{filename}")
         
         return self.log_test("File Download Without Authentication", 
                            response.status_code == 200,
@@ -226,16 +226,16 @@ class DocumentDownloadTester:
         headers = {'Authorization': f'Bearer {self.token}'}
         
         response = requests.get(f"{self.base_url}/api/patients/{self.patient_id}/documents", 
-                              headers=headers)
+                              headers=headers, params={"limit": 200})
         
         if response.status_code == 200:
-            documents = response.json()
+            documents = response.json()["items"]
             
             if len(documents) == len(self.uploaded_files):
                 # Check that each document has the correct filename for download URL construction
                 all_correct = True
                 for doc in documents:
-                    expected_url = f"{self.base_url}/uploads/{doc['filename']}"
+                    expected_url = f"{self.base_url}/api/uploads/{doc['filename']}"
                     # Test that the URL would work
                     test_response = requests.get(expected_url)
                     if test_response.status_code != 200:
@@ -264,7 +264,7 @@ class DocumentDownloadTester:
         filename = test_file['filename']
         
         # First, verify file exists
-        response = requests.get(f"{self.base_url}/uploads/{filename}")
+        response = requests.get(f"{self.base_url}/api/uploads/{filename}")
         if response.status_code != 200:
             return self.log_test("File Cleanup After Deletion", False, 
                                "Test file not accessible before deletion")
@@ -278,7 +278,7 @@ class DocumentDownloadTester:
                                f"Document deletion failed: {delete_response.status_code}")
         
         # Try to access the file after deletion - should return 404
-        post_delete_response = requests.get(f"{self.base_url}/uploads/{filename}")
+        post_delete_response = requests.get(f"{self.base_url}/api/uploads/{filename}")
         
         cleanup_success = post_delete_response.status_code == 404
         return self.log_test("File Cleanup After Deletion", cleanup_success,
@@ -294,7 +294,7 @@ class DocumentDownloadTester:
         
         def download_file(file_info):
             filename = file_info['filename']
-            response = requests.get(f"{self.base_url}/uploads/{filename}")
+            response = requests.get(f"{self.base_url}/api/uploads/{filename}")
             return response.status_code == 200 and response.content == file_info['expected_content']
         
         # Download multiple files concurrently
@@ -192,20 +192,31 @@ class DocumentUploadTester:
             return False
 
     def test_unique_filename_generation(self):
-        """Test that files are saved with unique UUID-based filenames"""
-        if len(self.uploaded_documents) < 2:
-            self.log_test("Unique Filename Generation", False, "Need at least 2 uploaded documents to verify")
+        """Test that every upload gets its own UUID-based filename, even for identical content.
+
+        Identical content is stored once on the server, but that stays internal:
+        the public filename never repeats and never carries the content hash.
+        """
+        first = self.test_document_upload_with_form_data("same.txt", b"Identical content", "text/plain")[1]
+        second = self.test_document_upload_with_form_data("same.txt", b"Identical content", "text/plain")[1]
+        if not first or not second:
+            self.log_test("Unique Filename Generation", False, "Could not upload the same file twice")
             return False
         
         filenames = [doc['filename'] for doc in self.uploaded_documents]
         unique_filenames = set(filenames)
-        
-        if len(filenames) == len(unique_filenames):
-            self.log_test("Unique Filename Generation", True, f"All {len(filenames)} filenames are unique")
-            return True
-        else:
+        if len(filenames) != len(unique_filenames):
             self.log_test("Unique Filename Generation", False, f"Duplicate filenames found: {len(filenames)} total, {len(unique_filenames)} unique")
             return False
+        if first.get('sha256') != second.get('sha256'):
+            self.log_test("Unique Filename Generation", False, "Identical uploads got different content hashes")
+            return False
+        if first['sha256'] in first['filename'] or first['sha256'] in second['filename']:
+            self.log_test("Unique Filename Generation", False, f"Filename exposes the content hash: {first['filename']}")
+            return False
+        
+        self.log_test("Unique Filename Generation", True, f"All {len(filenames)} filenames are unique, identical content included")
+        return True
 
     def test_document_retrieval(self):
         """Test document retrieval after upload"""
@@ -213,9 +224,13 @@ class DocumentUploadTester:
         headers = {'Authorization': f'Bearer {self.token}'}
         
         try:
-            response = requests.get(url, headers=headers)
+            response = requests.get(url, headers=headers, params={"limit": 200})
             if response.status_code == 200:
-                documents = response.json()
+                page = response.json()
+                documents = page["items"]
+                if page["next_cursor"] is not None:
+                    self.log_test("Document Retrieval", False, f"Expected one page, got next_cursor after {len(documents)} documents")
+                    return False, None
                 if len(documents) >= len(self.uploaded_documents):
                     self.log_test("Document Retrieval", True, f"Retrieved {len(documents)} documents")
                     return True, documents
@@ -230,7 +245,7 @@ class DocumentUploadTester:
             return False, None
 
     def test_static_file_serving(self):
-        """Test static file serving via /uploads endpoint"""
+        """Test file serving via the /api/uploads endpoint (files are stored in sharded directories)"""
         if not self.uploaded_documents:
             self.log_test("Static File Serving", False, "No uploaded documents to test")
             return False
@@ -238,12 +253,12 @@ class DocumentUploadTester:
         # Test accessing the first uploaded file
         doc = self.uploaded_documents[0]
         filename = doc['filename']
-        url = f"{self.base_url}/uploads/{filename}"
+        url = f"{self.base_url}/api/uploads/{filename}"
         
         try:
             response = requests.get(url)
             if response.status_code == 200:
-                self.log_test("Static File Serving", True, f"File {filename} accessible via /uploads endpoint")
+                self.log_test("Static File Serving", True, f"File {filename} accessible via /api/uploads endpoint")
                 return True
             else:
                 self.log_test("Static File Serving", False, f"Status: {response.status_code} for file {filename}")
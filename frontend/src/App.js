@@ -451,6 +451,32 @@ function ClinicApp() {
     fetchAppointments();
   }, []);
 
+  // Живые изменения записей (создание/обновление/удаление) через server-sent events
+  useEffect(() => {
+    const token = localStorage.getItem('token');
+    if (!token) return;
+
+    const source = new EventSource(`${API}/appointments/changes?token=${encodeURIComponent(token)}`);
+    const upsertAppointment = (event) => {
+      const changed = JSON.parse(event.data);
+      setAppointments(prevAppointments => {
+        const others = prevAppointments.filter(apt => apt.id !== changed.id);
+        return [...others, changed].sort((a, b) =>
+          (a.appointment_date + a.appointment_time).localeCompare(b.appointment_date + b.appointment_time)
+        );
+      });
+    };
+    const removeAppointment = (event) => {
+      const { id } = JSON.parse(event.data);
+      setAppointments(prevAppointments => prevAppointments.filter(apt => apt.id !== id));
+    };
+
+    source.addEventListener('create', upsertAppointment);
+    source.addEventListener('update', upsertAppointment);
+    source.addEventListener('delete', removeAppointment);
+    return () => source.close();
+  }, []);
+
   // Функции для диагнозов
 
   const handleAddDiagnosis = (patientId) => {
@@ -497,7 +523,16 @@ function ClinicApp() {
     setErrorMessage(null);
     
     try {
-      await createMedication(medicationForm);
+      try {
+        await createMedication(medicationForm);
+      } catch (error) {
+        // Сервер не сохраняет назначение, пока врач не подтвердит предупреждения об аллергии
+        const warnings = error.response?.status === 409 && error.response.data?.detail?.allergy_warnings;
+        if (!warnings) throw error;
+        const allergens = warnings.map(w => `${w.allergen} (${w.reaction})`).join(', ');
+        if (!window.confirm(`Внимание: у пациента аллергия — ${allergens}. Всё равно назначить?`)) return;
+        await createMedication({ ...medicationForm, acknowledged_allergy_ids: warnings.map(w => w.allergy_id) });
+      }
       await medical.fetchMedicalSummary(medicationForm.patient_id);
       
       setShowAddMedicationModal(false);
@@ -17,6 +17,7 @@ const AppointmentModal = ({
   const [showNewPatientForm, setShowNewPatientForm] = useState(false);
   const [activeTab, setActiveTab] = useState('appointment');
   const [documents, setDocuments] = useState([]);
+  const [documentsCursor, setDocumentsCursor] = useState(null);
   const [treatmentPlans, setTreatmentPlans] = useState([]);
   const [uploading, setUploading] = useState(false);
   const [selectedFile, setSelectedFile] = useState(null);
@@ -238,12 +239,14 @@ const AppointmentModal = ({
     }
   }, [selectedPatient, activeTab]);
 
-  const fetchDocuments = async () => {
+  // Без курсора загружается первая страница, с курсором - следующая дописывается к списку
+  const fetchDocuments = async (cursor = null) => {
     if (!selectedPatient) return;
     
     try {
       const token = localStorage.getItem('token');
-      const response = await fetch(`${API}/api/patients/${selectedPatient.id}/documents`, {
+      const params = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+      const response = await fetch(`${API}/api/patients/${selectedPatient.id}/documents${params}`, {
         headers: {
           'Authorization': `Bearer ${token}`,
           'Content-Type': 'application/json'
@@ -251,8 +254,9 @@ const AppointmentModal = ({
       });
       
       if (response.ok) {
-        const docs = await response.json();
-        setDocuments(docs);
+        const page = await response.json();
+        setDocuments((prev) => (cursor ? [...prev, ...page.items] : page.items));
+        setDocumentsCursor(page.next_cursor);
       }
     } catch (error) {
       console.error('Error fetching documents:', error);
@@ -965,6 +969,15 @@ const AppointmentModal = ({
                   ))}
                 </div>
               )}
+              {documentsCursor && (
+                <button
+                  type="button"
+                  onClick={() => fetchDocuments(documentsCursor)}
+                  className="mt-3 w-full px-4 py-2 text-blue-600 border border-blue-600 rounded-lg hover:bg-blue-50 text-sm"
+                >
+                  Показать ещё
+                </button>
+              )}
             </div>
 
             <div className="flex justify-end">
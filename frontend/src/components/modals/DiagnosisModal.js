@@ -1,4 +1,7 @@
-import React from 'react';
+import React, { useState, useEffect } from 'react';
+import axios from 'axios';
+
+const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
 
 const DiagnosisModal = ({ 
   show, 
@@ -9,8 +12,37 @@ const DiagnosisModal = ({
   loading, 
   errorMessage 
 }) => {
+  const [icdQuery, setIcdQuery] = useState('');
+  const [icdSuggestions, setIcdSuggestions] = useState([]);
+
+  // Подсказки МКБ-10 по коду или названию
+  useEffect(() => {
+    if (!show || icdQuery.trim().length < 2) {
+      setIcdSuggestions([]);
+      return;
+    }
+    const timer = setTimeout(async () => {
+      try {
+        const response = await axios.get(`${API}/icd10/search`, { params: { q: icdQuery, limit: 8 } });
+        setIcdSuggestions(response.data);
+      } catch (error) {
+        console.error('Error searching ICD-10:', error);
+      }
+    }, 200);
+    return () => clearTimeout(timer);
+  }, [icdQuery, show]);
+
   if (!show) return null;
 
+  const selectIcdCode = (item) => {
+    setDiagnosisForm({
+      ...diagnosisForm,
+      diagnosis_code: item.code,
+      diagnosis_name: diagnosisForm.diagnosis_name || item.name_ru
+    });
+    setIcdSuggestions([]);
+  };
+
   return (
     <div className="fixed inset-0 bg-black bg-opacity-50 flex items-center justify-center z-50">
       <div className="bg-white rounded-lg p-6 w-full max-w-md mx-4">
@@ -29,7 +61,10 @@ const DiagnosisModal = ({
             type="text"
             placeholder="Название диагноза *"
             value={diagnosisForm.diagnosis_name}
-            onChange={(e) => setDiagnosisForm({...diagnosisForm, diagnosis_name: e.target.value})}
+            onChange={(e) => {
+              setDiagnosisForm({...diagnosisForm, diagnosis_name: e.target.value});
+              setIcdQuery(e.target.value);
+            }}
             className="w-full px-3 py-2 border border-gray-300 rounded-lg focus:ring-2 focus:ring-purple-500"
             required
           />
@@ -38,9 +73,26 @@ const DiagnosisModal = ({
             type="text"
             placeholder="Код МКБ-10 (например: I10)"
             value={diagnosisForm.diagnosis_code}
-            onChange={(e) => setDiagnosisForm({...diagnosisForm, diagnosis_code: e.target.value})}
+            onChange={(e) => {
+              setDiagnosisForm({...diagnosisForm, diagnosis_code: e.target.value});
+              setIcdQuery(e.target.value);
+            }}
             className="w-full px-3 py-2 border border-gray-300 rounded-lg focus:ring-2 focus:ring-purple-500"
           />
+
+          {icdSuggestions.length > 0 && (
+            <ul className="border border-gray-200 rounded-lg max-h-48 overflow-y-auto">
+              {icdSuggestions.map((item) => (
+                <li
+                  key={item.code}
+                  onClick={() => selectIcdCode(item)}
+                  className="px-3 py-2 text-sm cursor-pointer hover:bg-purple-50"
+                >
+                  <span className="font-mono font-semibold text-purple-700">{item.code}</span> {item.name_ru}
+                </li>
+              ))}
+            </ul>
+          )}
           
           <textarea
             placeholder="Описание диагноза"
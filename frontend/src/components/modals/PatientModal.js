@@ -13,6 +13,7 @@ const PatientModal = ({
 }) => {
   const [activeTab, setActiveTab] = useState('info');
   const [documents, setDocuments] = useState([]);
+  const [documentsCursor, setDocumentsCursor] = useState(null);
   const [treatmentPlans, setTreatmentPlans] = useState([]);
   const [uploading, setUploading] = useState(false);
   const [selectedFile, setSelectedFile] = useState(null);
@@ -42,12 +43,14 @@ const PatientModal = ({
     }
   }, [editingItem, activeTab]);
 
-  const fetchDocuments = async () => {
+  // Без курсора загружается первая страница, с курсором - следующая дописывается к списку
+  const fetchDocuments = async (cursor = null) => {
     if (!editingItem) return;
     
     try {
       const token = localStorage.getItem('token');
-      const response = await fetch(`${API}/api/patients/${editingItem.id}/documents`, {
+      const params = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+      const response = await fetch(`${API}/api/patients/${editingItem.id}/documents${params}`, {
         headers: {
           'Authorization': `Bearer ${token}`,
           'Content-Type': 'application/json'
@@ -55,8 +58,9 @@ const PatientModal = ({
       });
       
       if (response.ok) {
-        const docs = await response.json();
-        setDocuments(docs);
+        const page = await response.json();
+        setDocuments((prev) => (cursor ? [...prev, ...page.items] : page.items));
+        setDocumentsCursor(page.next_cursor);
       }
     } catch (error) {
       console.error('Error fetching documents:', error);
@@ -505,6 +509,16 @@ const PatientModal = ({
                 <div className="space-y-2">
                   {documents.map((doc) => (
                     <div key={doc.id} className="flex items-center justify-between p-3 border rounded-lg">
+                      {/* Миниатюра для изображений и PDF */}
+                      {(doc.file_type?.startsWith('image/') || doc.file_type === 'application/pdf') && (
+                        <img
+                          src={`${API}/api/uploads/${doc.filename}/thumbnail`}
+                          alt=""
+                          loading="lazy"
+                          onError={(e) => { e.currentTarget.style.display = 'none'; }}
+                          className="w-16 h-16 object-cover rounded mr-3 border"
+                        />
+                      )}
                       <div className="flex-1">
                         <div className="font-medium">{doc.original_filename}</div>
                         <div className="text-sm text-gray-500">
@@ -537,6 +551,15 @@ const PatientModal = ({
                   ))}
                 </div>
               )}
+              {documentsCursor && (
+                <button
+                  type="button"
+                  onClick={() => fetchDocuments(documentsCursor)}
+                  className="mt-3 w-full px-4 py-2 text-blue-600 border border-blue-600 rounded-lg hover:bg-blue-50 text-sm"
+                >
+                  Показать ещё
+                </button>
+              )}
             </div>
 
             <div className="flex justify-end">
@@ -0,0 +1,23 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+# server.py reads these at import; no test here talks to MongoDB
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "clinic_test")
+
+
+@pytest.fixture(scope="session")
+def server(tmp_path_factory):
+    """The backend module, imported from a scratch directory as it creates its upload folders in the working one"""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("server"))
+    try:
+        import server
+    finally:
+        os.chdir(cwd)
+    return server
@@ -0,0 +1,71 @@
+"""Allergen group mapping and the prescription cross-check"""
+from pathlib import Path
+
+import pytest
+
+from allergens import AllergenIndex
+
+SEED = Path(__file__).parent.parent / "backend" / "data" / "allergens.tsv"
+
+
+@pytest.fixture(scope="module")
+def index():
+    return AllergenIndex.load(SEED)
+
+
+@pytest.fixture
+def small():
+    index = AllergenIndex()
+    index.add("пенициллин", ["penicillins"])
+    index.add("амоксициллин", ["penicillins"])
+    index.add("лактам", ["penicillins", "cephalosporins"])
+    index.add("цефазолин", ["cephalosporins"])
+    return index
+
+
+def test_add_rejects_short_and_multiword_terms():
+    index = AllergenIndex()
+    with pytest.raises(ValueError):
+        index.add("йо", ["iodine"])
+    with pytest.raises(ValueError):
+        index.add("бета лактам", ["penicillins"])
+
+
+def test_terms_merge_groups(small):
+    small.add("Амоксициллин", ["beta_lactams"])
+    assert small.groups("амоксициллин") == {"penicillins", "beta_lactams"}
+
+
+def test_inflected_forms_match_by_prefix(small):
+    assert small.groups("Амоксициллина 500 мг") == {"penicillins"}
+    assert small.groups("Пенициллины") == {"penicillins"}
+    assert small.groups("парацетамол") == set()
+
+
+def test_shared_groups_through_a_class(small):
+    assert small.shared_groups("Амоксициллин", "Пенициллины") == {"penicillins"}
+    assert small.shared_groups("Цефазолин", "Бета-лактамы") == {"cephalosporins"}
+    assert small.shared_groups("Цефазолин", "Пенициллин") == set()
+
+
+def test_unmapped_allergen_falls_back_to_the_name(small):
+    assert small.shared_groups("Хлоргексидин 0,05%", "хлоргексидин") == {"хлоргексидин"}
+    # Too short to match by name alone
+    assert small.shared_groups("Йодинол", "йо") == set()
+
+
+def test_seed_mapping(index):
+    assert len(index) > 50
+    assert index.shared_groups("Ибупрофен", "НПВС") == {"nsaids"}
+    assert index.shared_groups("Артикаин", "Лидокаин") == {"amide_anesthetics"}
+
+
+def test_check_medication_allergies(server, monkeypatch, small):
+    monkeypatch.setattr(server, "allergen_index", small)
+    allergies = [
+        {"id": "a1", "allergen": "Пенициллины", "reaction": "Сыпь", "severity": "medium"},
+        {"id": "a2", "allergen": "Латекс", "reaction": "Отёк", "severity": "high"},
+    ]
+    warnings = server.check_medication_allergies("Амоксициллин", allergies)
+    assert [(w.allergy_id, w.allergen_groups) for w in warnings] == [("a1", ["penicillins"])]
+    assert server.check_medication_allergies("Парацетамол", allergies) == []
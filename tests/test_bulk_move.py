@@ -0,0 +1,62 @@
+"""Slot resolution and schedule checks of POST /appointments/bulk-move"""
+
+
+def appointment(appointment_id, doctor_id, time, status="confirmed", date="2026-01-05"):
+    return {
+        "id": appointment_id, "doctor_id": doctor_id, "appointment_date": date,
+        "appointment_time": time, "status": status
+    }
+
+
+def to_doctor(appointments, doctor_id):
+    return {a["id"]: (doctor_id, a["appointment_date"], a["appointment_time"]) for a in appointments}
+
+
+def test_free_slots_move(server):
+    appointments = [appointment("a", "d1", "10:00"), appointment("b", "d1", "11:00")]
+    assert server.resolve_bulk_move(appointments, to_doctor(appointments, "d2"), set(), {}) == {}
+
+
+def test_slot_booked_outside_the_batch(server):
+    appointments = [appointment("a", "d1", "10:00"), appointment("b", "d1", "11:00")]
+    occupied = {("d2", "2026-01-05", "11:00")}
+    failed = server.resolve_bulk_move(appointments, to_doctor(appointments, "d2"), occupied, {})
+    assert failed == {"b": "Time slot already booked"}
+
+
+def test_swap_inside_the_batch(server):
+    # Both move to the day after, so neither blocks the other
+    appointments = [appointment("a", "d1", "10:00"), appointment("b", "d1", "11:00")]
+    targets = {a["id"]: ("d1", "2026-01-06", a["appointment_time"]) for a in appointments}
+    assert server.resolve_bulk_move(appointments, targets, set(), {}) == {}
+
+
+def test_failed_move_keeps_its_slot(server):
+    # b cannot leave d2 10:00, so a cannot take it
+    appointments = [appointment("a", "d1", "10:00"), appointment("b", "d2", "10:00")]
+    targets = {"a": ("d2", "2026-01-05", "10:00"), "b": ("d3", "2026-01-05", "10:00")}
+    failed = server.resolve_bulk_move(appointments, targets, set(), {"b": "Врач не работает в этот день недели"})
+    assert failed == {"b": "Врач не работает в этот день недели", "a": "Time slot already booked"}
+
+
+def test_closed_appointments_do_not_move(server):
+    appointments = [
+        appointment("a", "d1", "10:00", status="completed"),
+        appointment("b", "d1", "11:00", status="cancelled"),
+        appointment("c", "d1", "12:00", status="no_show"),
+    ]
+    failed = server.resolve_bulk_move(appointments, to_doctor(appointments, "d2"), set(), {})
+    assert failed == {
+        "a": "Appointment is already completed",
+        "b": "Appointment is cancelled or marked as no-show",
+        "c": "Appointment is cancelled or marked as no-show",
+    }
+
+
+def test_schedule_allows(server):
+    schedule = {"start_time": "09:00", "end_time": "11:30"}
+    assert server.schedule_allows(schedule, "09:00")[0]
+    assert server.schedule_allows(schedule, "11:30")[0]
+    available, message = server.schedule_allows(schedule, "12:00")
+    assert not available and "09:00-11:30" in message
+    assert not server.schedule_allows(None, "10:00")[0]
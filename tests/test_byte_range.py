@@ -0,0 +1,32 @@
+"""Parsing of Range headers for file downloads"""
+import pytest
+
+
+@pytest.mark.parametrize("header, size, expected", [
+    ("bytes=0-99", 1000, (0, 99)),
+    ("bytes=100-", 1000, (100, 999)),  # open-ended
+    ("bytes=900-5000", 1000, (900, 999)),  # end clamped to the file
+    ("bytes=-5", 1000, (995, 999)),  # suffix
+    ("bytes=-5000", 1000, (0, 999)),  # suffix longer than the file
+    (" Bytes = 0-0", 1000, (0, 0)),
+])
+def test_satisfiable(server, header, size, expected):
+    assert server.parse_byte_range(header, size) == expected
+
+
+@pytest.mark.parametrize("header, size", [
+    ("bytes=1000-", 1000),  # starts past the end
+    ("bytes=1000-1200", 1000),
+    ("bytes=-0", 1000),  # zero-length suffix
+    ("bytes=5-2", 1000),  # end before start
+    ("bytes=-5", 0),  # nothing of an empty file
+    ("bytes=0-", 0),
+])
+def test_unsatisfiable(server, header, size):
+    with pytest.raises(ValueError):
+        server.parse_byte_range(header, size)
+
+
+@pytest.mark.parametrize("header", ["items=0-5", "bytes=0-5,10-15", "bytes=a-5", "bytes=0-b", "bytes=-x"])
+def test_unsupported_or_malformed_ranges_get_the_whole_file(server, header):
+    assert server.parse_byte_range(header, 1000) is None
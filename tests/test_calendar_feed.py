@@ -0,0 +1,47 @@
+"""iCalendar text helpers and calendar feed tokens"""
+
+
+def test_ics_escape(server):
+    assert server.ics_escape("Кариес; пломба, верх\\низ") == "Кариес\\; пломба\\, верх\\\\низ"
+    assert server.ics_escape("строка 1\r\nстрока 2\nстрока 3") == "строка 1\\nстрока 2\\nстрока 3"
+
+
+def test_short_lines_are_not_folded(server):
+    line = "SUMMARY:" + "x" * 67
+    assert len(line.encode()) == 75
+    assert server.ics_fold(line) == line
+
+
+def test_fold_ascii(server):
+    line = "DESCRIPTION:" + "x" * 200
+    folded = server.ics_fold(line)
+    parts = folded.split("\r\n ")
+    assert [len(p.encode()) for p in parts] == [75, 74, 63]
+    assert "".join(parts) == line
+
+
+def test_fold_never_splits_utf8_sequences(server):
+    line = "SUMMARY:" + "Иванов Иван — кариес " * 10
+    parts = server.ics_fold(line).split("\r\n ")
+    assert "".join(parts) == line
+    assert len(parts[0].encode()) <= 75
+    assert all(len(p.encode()) <= 74 for p in parts[1:])
+
+
+def test_calendar_token(server):
+    doctor = {"id": "d1", "calendar_token_version": 0}
+    token = server.create_calendar_token(doctor)
+    assert server.verify_calendar_token(token, doctor)
+    assert not server.verify_calendar_token(token, {"id": "d2", "calendar_token_version": 0})
+    assert not server.verify_calendar_token("not a token", doctor)
+
+
+def test_rotation_revokes_old_tokens(server):
+    token = server.create_calendar_token({"id": "d1"})
+    assert server.verify_calendar_token(token, {"id": "d1"})
+    assert not server.verify_calendar_token(token, {"id": "d1", "calendar_token_version": 1})
+
+
+def test_access_tokens_are_not_calendar_tokens(server):
+    token = server.create_access_token({"sub": "d1"})
+    assert not server.verify_calendar_token(token, {"id": "d1"})
@@ -0,0 +1,23 @@
+"""Names and manifest cells of the documents ZIP export"""
+import pytest
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("=HYPERLINK(\"http://x\")", "'=HYPERLINK(\"http://x\")"),
+    ("+1", "'+1"),
+    ("-2+3", "'-2+3"),
+    ("@SUM(A1)", "'@SUM(A1)"),
+    ("\tcmd", "'\tcmd"),
+    ("снимок.png", "снимок.png"),
+    ("a=b", "a=b"),
+    (1024, 1024),
+    (None, None),
+])
+def test_csv_safe(server, value, expected):
+    assert server.csv_safe(value) == expected
+
+
+def test_archive_name(server):
+    document = {"id": "12345678-aaaa", "original_filename": 'a/b:c*?.pdf'}
+    assert server.export_archive_name(document) == "documents/12345678-a_b_c__.pdf"
+    assert server.export_archive_name({"id": "12345678", "original_filename": " .. "}) == "documents/12345678-document"
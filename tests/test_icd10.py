@@ -0,0 +1,94 @@
+"""МКБ-10 dictionary: code normalization, code and name search, diagnosis code validation"""
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+
+from icd10 import Icd10Dictionary, is_valid_code_format, normalize_code
+
+SEED = Path(__file__).parent.parent / "backend" / "data" / "icd10.tsv"
+
+
+@pytest.fixture(scope="module")
+def dictionary():
+    return Icd10Dictionary.load(SEED)
+
+
+@pytest.fixture
+def small():
+    dictionary = Icd10Dictionary()
+    dictionary.add("K02", "Кариес зубов")
+    dictionary.add("K02.1", "Кариес дентина", "Дентин кариесі")
+    dictionary.add("K02.0", "Кариес эмали")
+    dictionary.add("K04.0", "Пульпит")
+    return dictionary
+
+
+@pytest.mark.parametrize("typed, code", [
+    ("k02.1", "K02.1"),
+    ("к02,1 ", "K02.1"),  # Cyrillic К and a decimal comma
+    ("K 02.1", "K02.1"),
+    ("A09+", "A09"),
+])
+def test_normalize_code(typed, code):
+    assert normalize_code(typed) == code
+
+
+@pytest.mark.parametrize("code, valid", [
+    ("K02", True), ("K02.1", True), ("S02.51", True),
+    ("K2", False), ("K02.", False), ("K02.123", False), ("02.1", False),
+])
+def test_code_format(code, valid):
+    assert is_valid_code_format(code) is valid
+
+
+def test_get(small):
+    assert small.get("к02,1") == {"code": "K02.1", "name_ru": "Кариес дентина", "name_kk": "Дентин кариесі"}
+    assert small.get("K02.0")["name_kk"] is None
+    assert small.get("K02.2") is None
+    # A prefix that is not itself a code
+    assert small.get("K0") is None
+
+
+def test_code_prefix_search_in_code_order(small):
+    assert [e["code"] for e in small.search("K02")] == ["K02", "K02.0", "K02.1"]
+    assert [e["code"] for e in small.search("K0", limit=2)] == ["K02", "K02.0"]
+    assert small.search("Z99") == []
+
+
+def test_name_search(small):
+    assert small.search("кариес дентина")[0]["code"] == "K02.1"
+    assert small.search("пульпит")[0]["code"] == "K04.0"
+    # Kazakh names are searchable too
+    assert small.search("дентин кариесі")[0]["code"] == "K02.1"
+    assert small.search("   ") == []
+
+
+def test_name_search_prefers_shorter_names_on_ties(small):
+    assert small.search("кариес")[0]["code"] == "K02"
+
+
+def test_seed_dictionary_loads(dictionary):
+    assert len(dictionary) > 100
+    assert dictionary.get("K02.1")["name_ru"] == "Кариес дентина"
+    assert dictionary.search("гипертензия")[0]["code"] == "I10"
+
+
+def test_validate_format_only_by_default(server, monkeypatch, small):
+    monkeypatch.setattr(server, "icd10_dictionary", small)
+    monkeypatch.setattr(server, "ICD10_STRICT", False)
+    assert server.validate_icd10_code("к02,1") == "K02.1"
+    # Unknown but well formed: accepted, the bundled dictionary is only a seed subset
+    assert server.validate_icd10_code("Z99.9") == "Z99.9"
+    with pytest.raises(HTTPException) as error:
+        server.validate_icd10_code("K2")
+    assert error.value.status_code == 400
+
+
+def test_validate_strict(server, monkeypatch, small):
+    monkeypatch.setattr(server, "icd10_dictionary", small)
+    monkeypatch.setattr(server, "ICD10_STRICT", True)
+    assert server.validate_icd10_code("K02.1") == "K02.1"
+    with pytest.raises(HTTPException) as error:
+        server.validate_icd10_code("Z99.9")
+    assert error.value.status_code == 400
@@ -0,0 +1,57 @@
+"""Diffs and version numbering of record revisions"""
+from datetime import datetime
+
+import pytest
+
+
+def test_record_diff(server):
+    before = {"_id": 1, "id": "r", "weight": 70, "height": 180, "notes": "x"}
+    after = {"_id": 2, "id": "r", "weight": 72, "height": 180, "blood_type": "A"}
+    changes, removed = server.record_diff(before, after)
+    assert changes == {"weight": 72, "blood_type": "A"}
+    assert removed == ["notes"]
+
+
+def test_record_diff_without_changes(server):
+    record = {"id": "r", "weight": 70}
+    assert server.record_diff(record, dict(record)) == ({}, [])
+
+
+@pytest.fixture
+def writer(server, monkeypatch):
+    monkeypatch.setattr(server, "REVISION_SNAPSHOT_INTERVAL", 2)
+    return server.RevisionWriter()
+
+
+def change(server, before, after, changed_by="editor"):
+    changes, removed = server.record_diff(before, after)
+    return {
+        "id": f"c{after['weight']}", "collection": "medical_records", "record_id": after["id"],
+        "before": before, "after": after, "changes": changes, "removed": removed,
+        "changed_by": changed_by, "created_at": datetime(2030, 1, 2)
+    }
+
+
+def test_first_change_writes_version_zero_by_the_creator(server, writer):
+    before = {"id": "r", "weight": 70, "created_by": "creator", "created_at": datetime(2030, 1, 1)}
+    writer.versions[("medical_records", "r")] = None
+    zero, first = writer.revision(change(server, before, {**before, "weight": 71}))
+    assert (zero["version"], zero["changed_by"], zero["created_at"]) == (0, "creator", datetime(2030, 1, 1))
+    assert zero["snapshot"] == before and zero["changes"] is None
+    assert (first["version"], first["changed_by"], first["changes"]) == (1, "editor", {"weight": 71})
+    assert first["change_id"] == zero["change_id"] == "c71"
+
+
+def test_version_zero_of_records_without_a_creator(server, writer):
+    writer.versions[("medical_records", "r")] = None
+    zero, _ = writer.revision(change(server, {"id": "r", "weight": 70}, {"id": "r", "weight": 71}))
+    assert zero["changed_by"] is None
+
+
+def test_later_versions_and_snapshots(server, writer):
+    writer.versions[("medical_records", "r")] = 1
+    second, = writer.revision(change(server, {"id": "r", "weight": 71}, {"id": "r", "weight": 72}))
+    third, = writer.revision(change(server, {"id": "r", "weight": 72}, {"id": "r", "weight": 73}))
+    assert (second["version"], second["snapshot"]) == (2, {"id": "r", "weight": 72})
+    assert third["version"] == 3 and "snapshot" not in third
+    assert writer.versions[("medical_records", "r")] == 3
@@ -0,0 +1,71 @@
+"""S3Storage against moto's in-memory S3"""
+from urllib.parse import parse_qs, urlparse
+
+import boto3
+import moto
+import pytest
+
+from storage import S3Storage
+
+BUCKET = "clinic-documents"
+CONTENT = bytes(range(256)) * 64
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with moto.mock_aws():
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket=BUCKET)
+        yield S3Storage(BUCKET, prefix="documents/", region="us-east-1", url_expires_seconds=60)
+
+
+@pytest.fixture
+def saved(storage, tmp_path):
+    source = tmp_path / "upload"
+    source.write_bytes(CONTENT)
+    storage.save("abcdef.pdf", source, "application/pdf")
+    assert not source.exists()
+    return "abcdef.pdf"
+
+
+def test_save_and_stat(storage, saved):
+    size, modified = storage.stat(saved)
+    assert size == len(CONTENT)
+    assert modified.tzinfo is not None
+    assert storage.exists(saved)
+    assert storage.location(saved) == f"s3://{BUCKET}/documents/{saved}"
+    head = storage.client.head_object(Bucket=BUCKET, Key=f"documents/{saved}")
+    assert head["ContentType"] == "application/pdf"
+
+
+def test_stat_missing(storage):
+    assert storage.stat("missing.pdf") is None
+    assert not storage.exists("missing.pdf")
+
+
+def test_read_range(storage, saved):
+    assert b"".join(storage.read_range(saved, 0, len(CONTENT))) == CONTENT
+    assert b"".join(storage.read_range(saved, 100, 1000)) == CONTENT[100:1100]
+    assert b"".join(storage.read_range(saved, 0, 0)) == b""
+
+
+def test_delete(storage, saved):
+    storage.delete(saved)
+    assert storage.stat(saved) is None
+    # Deleting again is not an error
+    storage.delete(saved)
+
+
+def test_names(storage, saved):
+    assert list(storage.names()) == [saved]
+
+
+def test_presigned_url(storage, saved):
+    url = storage.presigned_url(saved, download_name="report.pdf", content_type="application/pdf")
+    parsed = urlparse(url)
+    query = parse_qs(parsed.query)
+    assert parsed.path.endswith(f"/documents/{saved}")
+    assert query["response-content-disposition"] == ['attachment; filename="report.pdf"']
+    assert query["response-content-type"] == ["application/pdf"]
+    assert "Expires" in query or "X-Amz-Expires" in query
@@ -0,0 +1,76 @@
+"""Size bound, LRU order and invalidation races of the medical summary cache"""
+import pytest
+
+
+@pytest.fixture
+def cache(server):
+    return server.SummaryCache(max_bytes=10)
+
+
+def fill(cache, patient_id, payload):
+    cache.put(patient_id, payload, cache.version())
+
+
+def test_disabled_by_default(server):
+    assert server.MEDICAL_SUMMARY_CACHE_BYTES == 0
+    cache = server.SummaryCache(0)
+    fill(cache, "p", b"x")
+    assert cache.get("p") is None and not cache.entries
+
+
+def test_get_and_stats(cache):
+    assert cache.get("p") is None
+    fill(cache, "p", b"abc")
+    assert cache.get("p") == b"abc"
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["bytes"], stats["hit_ratio"]) == (1, 1, 3, 0.5)
+
+
+def test_evicts_least_recently_used(cache):
+    fill(cache, "a", b"aaaa")
+    fill(cache, "b", b"bbbb")
+    cache.get("a")
+    fill(cache, "c", b"cccc")
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.size == 8 and cache.evictions == 1
+
+
+def test_oversized_payload_is_not_stored(cache):
+    fill(cache, "p", b"x" * 11)
+    assert cache.get("p") is None and cache.size == 0
+
+
+def test_replacing_a_payload_keeps_the_size_right(cache):
+    fill(cache, "p", b"xxxx")
+    fill(cache, "p", b"yy")
+    assert cache.get("p") == b"yy" and cache.size == 2
+
+
+def test_rebuild_racing_with_invalidation_is_dropped(cache):
+    version = cache.version()
+    cache.invalidate("p")
+    cache.put("p", b"stale", version)
+    assert cache.get("p") is None
+    # Other patients' rebuilds from the same moment are still fine
+    cache.put("q", b"fresh", version)
+    assert cache.get("q") == b"fresh"
+
+
+def test_rebuild_racing_with_clear_is_dropped(cache):
+    version = cache.version()
+    cache.clear()
+    cache.put("p", b"stale", version)
+    assert cache.get("p") is None
+    fill(cache, "p", b"fresh")
+    assert cache.get("p") == b"fresh"
+
+
+def test_invalidations_roll_into_a_new_generation(server, monkeypatch, cache):
+    monkeypatch.setattr(server.SummaryCache, "MAX_INVALIDATIONS", 2)
+    version = cache.version()
+    for patient_id in ("a", "b", "c"):
+        cache.invalidate(patient_id)
+    assert cache.invalidated == {}
+    # Forgetting the ticks must not let an older rebuild through
+    cache.put("a", b"stale", version)
+    assert cache.get("a") is None
@@ -0,0 +1,89 @@
+"""Keyset positions of the patient timeline"""
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+
+def matches(document, query):
+    """The subset of MongoDB query semantics the timeline keyset filters use"""
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(matches(document, branch) for branch in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = document[field]
+            for operator, operand in condition.items():
+                if operator == "$lt" and not value < operand:
+                    return False
+                if operator == "$lte" and not value <= operand:
+                    return False
+        elif document[field] != condition:
+            return False
+    return True
+
+
+@pytest.fixture
+def sources(server):
+    return {source.kind: source for source in server.TIMELINE_SOURCES}
+
+
+def position(server, source, document):
+    return server.timeline_key(source.date_of(document)), source.kind, document["id"]
+
+
+def appointments():
+    return [
+        {"id": f"a{i}", "appointment_date": day, "appointment_time": time}
+        for i, (day, time) in enumerate([
+            ("2030-01-01", "09:00"), ("2030-01-01", "10:00"), ("2030-01-01", "10:00"),
+            ("2030-01-02", "09:00"), ("2029-12-31", "23:59"),
+        ])
+    ]
+
+
+def diagnoses():
+    return [
+        {"id": f"d{i}", "diagnosed_date": date}
+        for i, date in enumerate([
+            datetime(2030, 1, 1, 10), datetime(2030, 1, 1, 10), datetime(2030, 1, 1, 9, 30),
+            datetime(2030, 1, 1, 10, 0, 0, 1), datetime(2029, 6, 1),
+        ])
+    ]
+
+
+@pytest.mark.parametrize("kind, documents", [("appointment", appointments), ("diagnosis", diagnoses)])
+def test_keyset_filter_selects_everything_after_any_position(server, sources, kind, documents):
+    source = sources[kind]
+    documents = documents()
+    # Positions from every source, so ties across kinds and positions between minutes are covered
+    positions = [position(server, source, d) for d in documents] + [
+        (server.timeline_key(datetime(2030, 1, 1, 10)), "appointment", "zzz"),
+        (server.timeline_key(datetime(2030, 1, 1, 10)), "medication", ""),
+        (server.timeline_key(datetime(2030, 1, 1, 9, 30, 15)), "document", "x"),
+    ]
+    for after in positions:
+        expected = {d["id"] for d in documents if position(server, source, d) < after}
+        assert {d["id"] for d in documents if matches(d, source.before(*after))} == expected, after
+
+
+def test_timeline_key_orders_like_dates(server):
+    dates = [datetime(2030, 1, 1), datetime(2030, 1, 1, 0, 0, 0, 1), datetime(2030, 1, 1, 10), datetime(2031, 1, 1)]
+    keys = [server.timeline_key(d) for d in dates]
+    assert keys == sorted(keys) and len({len(k) for k in keys}) == 1
+
+
+def test_appointment_date_combines_date_and_time(sources):
+    document = {"appointment_date": "2030-01-02", "appointment_time": "09:15"}
+    assert sources["appointment"].date_of(document) == datetime(2030, 1, 2, 9, 15)
+
+
+def test_cursor_round_trip(server):
+    cursor = server.encode_cursor({"date": datetime(2030, 1, 1, 10), "kind": "diagnosis", "id": "d1"})
+    assert server.decode_cursor(cursor) == {"date": "2030-01-01T10:00:00", "kind": "diagnosis", "id": "d1"}
+
+
+def test_garbled_cursor(server):
+    with pytest.raises(HTTPException) as error:
+        server.decode_cursor("not base64 json")
+    assert error.value.status_code == 400
@@ -0,0 +1,86 @@
+"""Matching and pruning of the in-memory waitlist index"""
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def index(server):
+    return server.WaitlistIndex()
+
+
+@pytest.fixture
+def entry(server):
+    created = datetime(2030, 1, 1)
+
+    def make(minutes=0, **fields):
+        fields.setdefault("patient_id", "p")
+        fields.setdefault("earliest_date", "2030-01-01")
+        return server.WaitlistEntry(created_at=created + timedelta(minutes=minutes), **fields)
+    return make
+
+
+def match(index, date="2030-02-04", time="10:00", doctor_id="d1", specialty="Терапевт", limit=10):
+    return [e.id for e in index.match(doctor_id, specialty, date, time, limit)]
+
+
+def test_preferred_doctor_then_specialty_then_anyone(index, entry):
+    anyone = entry(minutes=0, id="anyone")
+    by_specialty = entry(minutes=1, id="specialty", specialty="Терапевт")
+    by_doctor = entry(minutes=2, id="doctor", doctor_id="d1")
+    other_doctor = entry(minutes=3, id="other", doctor_id="d2")
+    for e in (anyone, by_specialty, by_doctor, other_doctor):
+        index.add(e)
+    assert match(index) == ["doctor", "specialty", "anyone"]
+    assert match(index, limit=2) == ["doctor", "specialty"]
+
+
+def test_first_come_first_served_within_a_bucket(index, entry):
+    index.add(entry(minutes=5, id="late", doctor_id="d1"))
+    index.add(entry(minutes=1, id="early", doctor_id="d1"))
+    assert match(index) == ["early", "late"]
+
+
+def test_date_bounds(index, entry):
+    index.add(entry(id="later", earliest_date="2030-03-01"))
+    index.add(entry(id="until", latest_date="2030-02-03"))
+    index.add(entry(id="fits", earliest_date="2030-02-04", latest_date="2030-02-04"))
+    assert match(index) == ["fits"]
+
+
+def test_time_windows(server, index, entry):
+    window = server.WaitlistTimeWindow
+    index.add(entry(minutes=0, id="morning", time_windows=[window(start_time="09:00", end_time="10:00")]))
+    index.add(entry(minutes=1, id="monday", time_windows=[window(start_time="09:00", end_time="12:00", days_of_week=[0])]))
+    index.add(entry(minutes=2, id="friday", time_windows=[window(start_time="09:00", end_time="12:00", days_of_week=[4])]))
+    # 2030-02-04 is a Monday; window end times are exclusive
+    assert match(index, time="10:00") == ["monday"]
+    assert match(index, time="09:30") == ["morning", "monday"]
+
+
+def test_remove_and_apply(server, index, entry):
+    waiting = entry(id="a", doctor_id="d1")
+    index.add(waiting)
+    index.apply(waiting.copy(update={"status": server.WaitlistStatus.BOOKED}))
+    assert match(index) == []
+    index.apply(waiting)
+    assert match(index) == ["a"]
+    index.remove("a")
+    index.remove("a")
+    assert match(index) == [] and not index.entries
+
+
+def test_prune(index, entry):
+    index.add(entry(id="past", latest_date="2030-01-31"))
+    index.add(entry(id="today", latest_date="2030-02-01"))
+    index.add(entry(id="open"))
+    assert index.prune("2030-02-01") == ["past"]
+    assert sorted(index.entries) == ["open", "today"]
+    assert index.prune("2030-02-01") == []
+
+
+def test_prune_skips_entries_re_added_with_a_new_deadline(index, entry):
+    index.add(entry(id="a", latest_date="2030-01-10"))
+    index.add(entry(id="a", latest_date="2030-03-01"))
+    assert index.prune("2030-02-01") == []
+    assert list(index.entries) == ["a"]